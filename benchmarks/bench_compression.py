@@ -0,0 +1,114 @@
+"""Compare the chunk compression codecs
+
+Usage:
+  python benchmarks/bench_compression.py [FILE ...]
+
+For each sample (the given files, or generated text, binary and random
+samples) and each available codec, report the CPU time spent compressing
+and decompressing every chunk and the number of bytes which would be
+stored. The legacy zip wrapper is included for reference.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from cStringIO import StringIO
+import os
+import random
+import struct
+import sys
+import zipfile
+
+from drastic.compression import (
+    available_codecs,
+    compress,
+    decompress,
+    unzip_legacy,
+)
+
+
+CHUNK_SIZE = 1024 * 1024
+SAMPLE_SIZE = 16 * CHUNK_SIZE
+REPEAT = 3
+
+
+def cpu_time():
+    """User + system CPU time of the process"""
+    t = os.times()
+    return t[0] + t[1]
+
+
+def zip_legacy(data):
+    """Wrap data in a zip archive the way chunks used to be stored"""
+    buf = StringIO()
+    z = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr("data", data)
+    z.close()
+    return buf.getvalue()
+
+
+def generated_samples():
+    """Return a list of (name, data) samples"""
+    rnd = random.Random(42)
+    words = ["archive", "collection", "resource", "metadata", "drastic",
+             "cassandra", "chunk", "object", "value", "12.5", "2016-05-03"]
+    text = []
+    size = 0
+    while size < SAMPLE_SIZE:
+        line = ",".join(rnd.choice(words) for _ in xrange(12)) + "\n"
+        text.append(line)
+        size += len(line)
+    # Slowly varying 16 bits samples, like an instrument recording
+    values = []
+    v = 0
+    for _ in xrange(SAMPLE_SIZE // 2):
+        v = max(-30000, min(30000, v + rnd.randint(-64, 64)))
+        values.append(v)
+    binary = struct.pack("<{}h".format(len(values)), *values)
+    return [("text/csv", "".join(text)[:SAMPLE_SIZE]),
+            ("binary", binary),
+            ("random", os.urandom(SAMPLE_SIZE))]
+
+
+def chunks(data):
+    return [data[i:i + CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE)]
+
+
+def measure(pack, unpack, parts):
+    """Return (stored bytes, compression cpu time, decompression cpu time)"""
+    best_c = best_d = None
+    for _ in xrange(REPEAT):
+        t0 = cpu_time()
+        stored = [pack(p) for p in parts]
+        t1 = cpu_time()
+        for s in stored:
+            unpack(s)
+        t2 = cpu_time()
+        best_c = t1 - t0 if best_c is None else min(best_c, t1 - t0)
+        best_d = t2 - t1 if best_d is None else min(best_d, t2 - t1)
+    return sum(len(s) for s in stored), best_c, best_d
+
+
+def main(paths):
+    if paths:
+        samples = [(os.path.basename(p), open(p, 'rb').read()) for p in paths]
+    else:
+        samples = generated_samples()
+    print "{:<20} {:<8} {:>12} {:>7} {:>9} {:>9}".format(
+        "sample", "codec", "stored", "ratio", "comp s", "decomp s")
+    for name, data in samples:
+        parts = chunks(data)
+        candidates = [(c, lambda d, c=c: compress(d, c),
+                       lambda d, c=c: decompress(d, c))
+                      for c in available_codecs()]
+        candidates.append(("zip", zip_legacy, unzip_legacy))
+        for codec, pack, unpack in candidates:
+            stored, t_comp, t_decomp = measure(pack, unpack, parts)
+            print "{:<20} {:<8} {:>12} {:>7.3f} {:>9.3f} {:>9.3f}".format(
+                name[:20], codec, stored, float(stored) / max(len(data), 1),
+                t_comp, t_decomp)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,13 +10,13 @@ import abc
 import collections
 import os
 from collections import OrderedDict
+from mimetypes import guess_type
 from os.path import abspath
 
 from cassandra.cqlengine.query import BatchQuery
-from drastic.models.blob import BlobPart
-from drastic.models.blob import Blob
 from drastic.models.collection import Collection
-from drastic.models.errors import (ResourceConflictError, NoSuchCollectionError)
+from drastic.models.data_object import DataObject
+from drastic.models.errors import ResourceConflictError
 from drastic.models.resource import Resource
 from drastic.models.search import SearchIndex
 from socket import error as SocketError
@@ -26,7 +26,7 @@ class CollectionManager(OrderedDict):
     def __init__(self, size=1000):
         super(CollectionManager, self).__init__()
         self.maxcount = size
-        self.root = Collection.get_root_collection()
+        self.root = Collection.find('/')
 
 
     def cache(self, p, c):
@@ -44,22 +44,10 @@ class CollectionManager(OrderedDict):
             c = self[path]
             self[path] = c  # Move back to top of FIFO ... so it stays here.
             return c
-        # Otherwise find it, cache it and return it
-        c = Collection.find_by_path(path)
-        if c:
-            return self.cache(path, c)
-
-        #### Ok, doesn't exist iterate up until it sticks
-
-        p1, p2 = os.path.split(path)
-        try:
-            rcd = dict(container=p1, name=p2)
-            c = Collection.create(**rcd)
-            self.cache(path, c)
-            return c
-        except NoSuchCollectionError as e:
-            self.collection(p1)  # create parent ( and implicitly grandparents &c )
-            return self.collection(path)  # and now should be ok...
+        # Otherwise find it or create it with its missing parents, cache it
+        # and return it
+        c = Collection.create_path(path)
+        return self.cache(path, c)
 
 
 class writer:
@@ -132,37 +120,27 @@ class CopyWriter(writer):
             print 'FAILED:', p1,n1
             raise e
 
-        # We should have a valid resource at this point.... so create the blob.
+        # We should have a valid resource at this point.... so create the data object.
         with open(fullpath, 'rb') as f:
-            size = os.fstat(f.fileno()).st_size
-            blob = Blob.create_from_file(f, size)
-            if blob:
-                # If everything works  ...
-                url = self.pattern(id=blob.id)
-                try :
-                    resource.update(url=url, size=size)
-                    ## So now tidy up the old blob
-                    if old_resource_id:
-                        from drastic.models.id_index import IDIndex
-                        blob = Blob.find(old_resource_id)
-                        if blob:
-                            for k in blob.parts :
-
-                                part_id = BlobPart.find(k)
-                                if part_id : part_id.delete()
-                            blob.delete()
-                    ## End Tidy...      This really should be in the model
-                except SocketError as e :
-                    pass
-
-                except Exception as e :
-                    pass
-                #try: b.execute()
-                #except Exception as e :
-                #    pass
-                return resource
-            else:
-                return None
+            mimetype, _ = guess_type(fullpath)
+            data_object = DataObject.create_from_stream(f, mimetype=mimetype)
+            url = self.pattern(id=data_object.uuid)
+            try :
+                resource.update(url=url, size=data_object.size)
+                ## So now tidy up the old data object (deduplicated chunks are
+                ## only released, they are reclaimed later)
+                if old_resource_id:
+                    DataObject.delete_id(old_resource_id)
+                ## End Tidy...      This really should be in the model
+            except SocketError as e :
+                pass
+
+            except Exception as e :
+                pass
+            #try: b.execute()
+            #except Exception as e :
+            #    pass
+            return resource
 
 
 ########### function to create embedded object remotely ( same as load, but uses CDMI instead ).
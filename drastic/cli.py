@@ -39,6 +39,16 @@ def parse_arguments():
                         help='Specify the IP address for this machine (subnets/private etc)')
     parser.add_argument('--include', dest='include', action='store',
                         help='include ONLY paths that include this string')
+    parser.add_argument('--resumable', dest='resumable', action='store_true',
+                        help='Upload the files with upload sessions, a failed upload is resumed when it is retried')
+    parser.add_argument('--rate', dest='rate', action='store', type=int,
+                        help='Maximum number of bytes read per second by the scrubber')
+    parser.add_argument('--workers', dest='workers', action='store', type=int,
+                        help='Number of threads used by scrub, delete-tree, stats-reconcile or index')
+    parser.add_argument('--continuous', dest='continuous', action='store_true',
+                        help='Start a new scrub or index pass when the previous one is finished')
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        help='Ignore the checkpoints of a previous scrub or delete-tree')
     return parser.parse_args()
 
 
@@ -148,6 +158,118 @@ def group_list(cfg):
                 user.uuid, user.name, ("N", "Y")[user.administrator])
 
 
+# noinspection PyUnusedLocal
+def chunk_reclaim(cfg):
+    """Delete the chunks of the chunk store which aren't referenced anymore"""
+    from drastic.models import ChunkStore
+    count = ChunkStore.reclaim()
+    print "Reclaimed {} chunks".format(count)
+
+
+def bucket_migrate(cfg, args):
+    """Move the data objects stored in a single partition to buckets"""
+    from drastic.models import DataObject
+    bucket_size = args.command[1:] and int(args.command[1])
+    bucket_size = bucket_size or cfg.get('CHUNK_BUCKET_SIZE')
+    if not bucket_size:
+        print "ERROR: A bucket size is required (or CHUNK_BUCKET_SIZE)"
+        sys.exit(1)
+    count = DataObject.migrate_all_to_buckets(bucket_size)
+    print "Migrated {} data objects".format(count)
+
+
+def scrub(cfg, args):
+    """Verify the checksums of the stored data objects"""
+    from drastic.scrub import (
+        DEFAULT_WORKERS,
+        Scrubber
+    )
+    scrubber = Scrubber(workers=args.workers or DEFAULT_WORKERS,
+                        rate=args.rate)
+    if args.continuous:
+        scrubber.run_forever(restart=args.restart)
+    else:
+        stats = scrubber.run(restart=args.restart)
+        print "Verified {} data objects, {} mismatches".format(
+            stats.get('objects', 0), stats.get('mismatches', 0))
+
+
+def delete_tree(cfg, args):
+    """Delete a collection and everything below it"""
+    from drastic.subtree_delete import (
+        DEFAULT_WORKERS,
+        SubtreeDelete
+    )
+    if len(args.command) < 2:
+        print "ERROR: The path of a collection is required"
+        sys.exit(1)
+    job = SubtreeDelete(args.command[1].decode('utf-8'),
+                        workers=args.workers or DEFAULT_WORKERS)
+    stats = job.run(restart=args.restart)
+    print "Deleted {} collections and {} resources".format(
+        stats.get('collections', 0), stats.get('resources', 0))
+    if stats.get('failed_collections'):
+        print "ERROR: {} collections failed, run the command again to resume".format(
+            stats['failed_collections'])
+        sys.exit(1)
+
+
+def stats_reconcile(cfg, args):
+    """Rebuild the counters of the collections from a scan of the tree"""
+    from drastic.reconcile import (
+        DEFAULT_WORKERS,
+        StatsReconciler
+    )
+    path = args.command[1].decode('utf-8') if args.command[1:] else u'/'
+    reconciler = StatsReconciler(path, workers=args.workers or DEFAULT_WORKERS)
+    stats = reconciler.run()
+    print "{} resources, {} bytes below {}".format(stats['resources'],
+                                                  stats['size'], path)
+
+
+def index(cfg, args):
+    """Index the objects of the index queue"""
+    from drastic.indexer import (
+        DEFAULT_WORKERS,
+        Indexer
+    )
+    indexer = Indexer(workers=args.workers or DEFAULT_WORKERS)
+    if args.continuous:
+        indexer.run_forever()
+    else:
+        stats = indexer.run()
+        print "Indexed {} objects, removed {}, {} failed".format(
+            stats.get('indexed', 0), stats.get('removed', 0),
+            stats.get('failed', 0))
+
+
+# noinspection PyUnusedLocal
+def index_lag(cfg):
+    """Print how far behind the indexer is"""
+    from drastic.models import IndexQueue
+    lag = IndexQueue.lag()
+    if lag is None:
+        print "The indexer hasn't processed the whole queue yet"
+    else:
+        print "Index lag: {:.1f} seconds".format(lag)
+
+
+def upload_reap(cfg, args):
+    """Remove the old upload sessions"""
+    from drastic.models import UploadSession
+    max_age = args.command[1:] and int(args.command[1])
+    count = UploadSession.reap(max_age or None)
+    print "Removed {} upload sessions".format(count)
+
+
+# noinspection PyUnusedLocal
+def index_grams(cfg):
+    """Index the prefixes and n-grams of the terms of the search index"""
+    from drastic.models import SearchGram
+    count = SearchGram.rebuild()
+    print "Indexed the grams of {} terms".format(count)
+
+
 def root_collection_create(cfg):
     from drastic.models.collection import Collection
     root = Collection.find("/")
@@ -191,5 +313,21 @@ def main():
         group_delete(cfg, args.command[1:])
     elif command == 'ingest':
         do_ingest(cfg, args)
+    elif command == 'chunk-reclaim':
+        chunk_reclaim(cfg)
+    elif command == 'bucket-migrate':
+        bucket_migrate(cfg, args)
+    elif command == 'scrub':
+        scrub(cfg, args)
+    elif command == 'delete-tree':
+        delete_tree(cfg, args)
+    elif command == 'stats-reconcile':
+        stats_reconcile(cfg, args)
+    elif command == 'index-grams':
+        index_grams(cfg)
     elif command == 'index':
-        pass  # do_index(cfg, args)
+        index(cfg, args)
+    elif command == 'index-lag':
+        index_lag(cfg)
+    elif command == 'upload-reap':
+        upload_reap(cfg, args)
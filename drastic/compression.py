@@ -0,0 +1,171 @@
+"""Chunk compression codecs
+
+Each chunk of a data object records the codec used to store it. zlib is
+always available, lz4 and zstd are used when the corresponding optional
+packages are installed (pip install drastic[lz4,zstd]).
+
+Chunks written before codecs were introduced are wrapped in a zip archive
+containing a single member called "data", they only have the 'compressed'
+flag set and are still decoded here.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from cStringIO import StringIO
+import zipfile
+import zlib
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODEC_NONE = "none"
+CODEC_ZLIB = "zlib"
+CODEC_LZ4 = "lz4"
+CODEC_ZSTD = "zstd"
+
+# Size of the sample compressed to decide if the data is worth compressing
+TRIAL_SIZE = 64 * 1024
+# A codec is only used if it saves at least 10% on the trial sample
+MIN_SAVING = 0.1
+
+# Mimetypes which are already compressed
+INCOMPRESSIBLE_MIMETYPES = (
+    "application/gzip",
+    "application/pdf",
+    "application/vnd.openxmlformats",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-gzip",
+    "application/x-rar-compressed",
+    "application/x-xz",
+    "application/zip",
+    "audio/mpeg",
+    "audio/ogg",
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+    "video/",
+)
+
+# Mimetypes which usually compress well, we favour the ratio over the speed
+TEXT_MIMETYPES = (
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "text/",
+)
+
+
+def _zlib_compress(data):
+    return zlib.compress(data, 6)
+
+
+def _zstd_compress(data):
+    # Compressor objects aren't thread safe, they are cheap to create
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _identity(data):
+    return data
+
+
+CODECS = {
+    CODEC_NONE: (_identity, _identity),
+    CODEC_ZLIB: (_zlib_compress, zlib.decompress),
+}
+if lz4_frame:
+    CODECS[CODEC_LZ4] = (lz4_frame.compress, lz4_frame.decompress)
+if zstandard:
+    CODECS[CODEC_ZSTD] = (_zstd_compress, _zstd_decompress)
+
+
+def available_codecs():
+    """Return the names of the codecs which can be used here"""
+    return sorted(CODECS)
+
+
+def _get_codec(codec):
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError(u"Compression codec '{}' is not available".format(codec))
+
+
+def compress(data, codec):
+    """Compress data with the given codec"""
+    return _get_codec(codec)[0](data)
+
+
+def decompress(data, codec):
+    """Decompress data stored with the given codec"""
+    return _get_codec(codec)[1](data)
+
+
+def unzip_legacy(data):
+    """Return the content of a chunk stored as a zip archive"""
+    buf = StringIO(data)
+    z = zipfile.ZipFile(buf, 'r')
+    try:
+        return z.read("data")
+    finally:
+        z.close()
+        buf.close()
+
+
+def choose_codec(mimetype, sample):
+    """Choose the codec for an object from its mimetype and a sample of its
+    content (usually the first chunk). CODEC_NONE is returned when a trial
+    compression of the sample doesn't save enough space."""
+    mimetype = (mimetype or "").lower()
+    if mimetype.startswith(INCOMPRESSIBLE_MIMETYPES):
+        return CODEC_NONE
+    if mimetype.startswith(TEXT_MIMETYPES):
+        preferred = (CODEC_ZSTD, CODEC_ZLIB)
+    else:
+        # Unknown content, favour the speed
+        preferred = (CODEC_LZ4, CODEC_ZSTD, CODEC_ZLIB)
+    codec = [c for c in preferred if c in CODECS][0]
+    sample = sample[:TRIAL_SIZE]
+    if not sample:
+        return CODEC_NONE
+    if len(compress(sample, codec)) > len(sample) * (1 - MIN_SAVING):
+        return CODEC_NONE
+    return codec
+
+
+def encode_chunk(data, codec):
+    """Compress a chunk, return the stored bytes and the codec actually used.
+    Chunks which don't get smaller are stored as is."""
+    if codec == CODEC_NONE or not data:
+        return data, CODEC_NONE
+    compressed = compress(data, codec)
+    if len(compressed) >= len(data):
+        return data, CODEC_NONE
+    return compressed, codec
+
+
+def decode_chunk(blob, codec, compressed=False):
+    """Return the content of a stored chunk"""
+    if blob is None:
+        return ''
+    if codec:
+        return decompress(blob, codec)
+    if compressed:
+        # Chunks written before we had codecs
+        return unzip_legacy(blob)
+    return blob
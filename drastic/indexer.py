@@ -0,0 +1,176 @@
+"""Background indexer
+
+Processes the index_queue table (see drastic.models.index_queue): the
+resources and collections created or updated are indexed in the search
+index after the request which changed them has returned.
+
+Each thread of the pool owns some buckets of the queue. A bucket is read
+from its checkpoint, window after window, INDEX_BATCH entries at a time.
+The entries of a batch are grouped by path, the current state of each
+object is indexed once (only the terms which changed are written, see
+SearchIndex.index) and the checkpoint moves after the batch. An object which
+doesn't exist anymore has its terms removed, the entries of the objects
+which couldn't be indexed are queued again. A window is deleted when the
+checkpoint leaves it.
+
+The entries queued less than SETTLE_DELAY seconds ago are left for the next
+pass, so the entries written late by a writer aren't skipped. A thread only
+reads a new batch when it's done with the previous one, and the writers
+themselves index synchronously when the indexer is more than INDEX_MAX_LAG
+seconds behind.
+
+Only one indexer should run at a time.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import threading
+import time
+
+from cassandra.util import min_uuid_from_time
+
+from drastic.models import (
+    Collection,
+    Resource,
+    SearchIndex,
+)
+from drastic.models.index_queue import (
+    IndexCheckpoint,
+    IndexQueue,
+    queue_buckets,
+    queue_window,
+)
+from drastic.models.tree_cache import tree_cache
+from drastic.util import split
+import log
+
+logger = log.init_log('indexer')
+
+DEFAULT_WORKERS = 4
+# Number of entries read from a partition of the queue at a time
+INDEX_BATCH = 100
+# Number of seconds to wait when the queue is empty, in continuous mode
+IDLE_INTERVAL = 1
+# Number of seconds after which the entries queued are processed
+SETTLE_DELAY = 10
+# Number of windows read in a bucket which has no checkpoint yet
+INITIAL_WINDOWS = 144
+
+
+class Indexer(object):
+    """Index the objects of the queue"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, batch=INDEX_BATCH):
+        self.buckets = queue_buckets()
+        self.workers = max(min(workers, self.buckets), 1)
+        self.batch = max(batch, 1)
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def run(self):
+        """Process the entries which are in the queue, return statistics
+        about the pass"""
+        self.stats = {}
+        threads = []
+        for worker in xrange(self.workers):
+            buckets = range(worker, self.buckets, self.workers)
+            t = threading.Thread(target=self.work, args=(buckets,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.stats['lag'] = IndexQueue.lag()
+        logger.info(u"Index pass finished: {}".format(self.stats))
+        return self.stats
+
+    def run_forever(self):
+        """Process the queue continuously"""
+        while True:
+            stats = self.run()
+            if not stats.get('entries'):
+                time.sleep(IDLE_INTERVAL)
+
+    def work(self, buckets):
+        for bucket in buckets:
+            try:
+                self.process_bucket(bucket)
+            except Exception:
+                # The entries stay in the queue for the next pass
+                logger.exception(u"Problem while reading index queue "
+                                 "partition {}".format(bucket))
+                self.count('failed_buckets')
+
+    def process_bucket(self, bucket):
+        """Index the objects queued in a bucket since its checkpoint"""
+        checkpoint = IndexCheckpoint.read_all().get(bucket)
+        horizon = time.time() - SETTLE_DELAY
+        last_window = queue_window(horizon)
+        before = min_uuid_from_time(horizon)
+        if checkpoint is None:
+            window, after, updated = last_window - INITIAL_WINDOWS, None, None
+        else:
+            window = checkpoint['window']
+            after = checkpoint['queued']
+            updated = checkpoint['updated']
+        while True:
+            rows = IndexQueue.read(bucket, window, after, before, self.batch)
+            if rows:
+                self.process_entries(rows)
+                after = rows[-1]['queued']
+                IndexCheckpoint.save(bucket, window, after, updated)
+                continue
+            if window >= last_window:
+                break
+            # The window is complete
+            IndexQueue.drop(bucket, window)
+            window += 1
+            after = None
+        IndexCheckpoint.save(bucket, window, after, horizon)
+
+    def process_entries(self, rows):
+        """Index the objects of a batch of entries, the latest type queued
+        for a path is used"""
+        objects = {}
+        for row in rows:
+            objects[row['object_path']] = row['object_type']
+        for path, object_type in objects.iteritems():
+            if not self.index_object(path, object_type):
+                IndexQueue.enqueue(path, object_type)
+                self.count('requeued')
+        self.count('entries', len(rows))
+
+    def load(self, path, object_type):
+        """Return an object from the database rather than from the cache,
+        None if it doesn't exist"""
+        if object_type == 'Collection':
+            tree_cache.invalidate(path, u'.')
+            return Collection.find(path)
+        container, name = split(path)
+        tree_cache.invalidate(container, name)
+        return Resource.find(path)
+
+    def index_object(self, path, object_type):
+        """Index the current state of an object, return False if it
+        failed. The object is checked again after it's indexed, if it was
+        deleted in between its terms are removed"""
+        try:
+            obj = self.load(path, object_type)
+            if obj is not None:
+                obj.index()
+                obj = self.load(path, object_type)
+                self.count('indexed')
+            if obj is None:
+                SearchIndex.reset(path)
+                self.count('removed')
+            return True
+        except Exception:
+            logger.exception(u"Problem while indexing '{}'".format(path))
+            self.count('failed')
+            return False
@@ -19,6 +19,8 @@ from cassandra.cqlengine.query import BatchQuery
 from drastic.models.search import SearchIndex
 from drastic.models import User
 from drastic.models import Group
+from drastic.models import DataObject
+from drastic.models import UploadSession
 #from drastic.models.collection import Collection
 #from drastic.models.resource import Resource
 from drastic.models.errors import (
@@ -81,19 +83,23 @@ def do_ingest(cfg, args):
 
     local_ip = args.local_ip
     skip_import = args.no_import
+    resumable = args.resumable
 
-    ingester = Ingester(user, group, path, local_ip=local_ip, skip_import=skip_import, include_pattern=include_pattern)
+    ingester = Ingester(user, group, path, local_ip=local_ip, skip_import=skip_import, include_pattern=include_pattern,
+                        resumable=resumable)
     ingester.start()
 
 
 class Ingester(object):
 
-    def __init__(self, user, group, folder, local_ip='127.0.0.1', skip_import=False, include_pattern=None):
+    def __init__(self, user, group, folder, local_ip='127.0.0.1', skip_import=False, include_pattern=None,
+                 resumable=False):
         self.groups = [group.uuid]
         self.user = user
         self.folder = folder
         self.collection_cache = {}
         self.skip_import = skip_import
+        self.resumable = resumable
         if local_ip:
             self.local_ip = local_ip
         else:
@@ -242,7 +248,8 @@ class Ingester(object):
                                    "container": current_collection.path(),
                                    "local_ip": self.local_ip,
                                    "path": path,
-                                   "entry": entry
+                                   "entry": entry,
+                                   "resumable": self.resumable
                                    },
                                   not self.skip_import)
                 timer.exit('push')
@@ -286,13 +293,24 @@ class ThreadClass(Thread):
             url = "file://{}{}/{}".format(context['local_ip'],
                                           context['path'],
                                           context['entry'])
+        elif context.get('resumable'):
+            # The upload session is kept in the context so a retry only
+            # sends the parts which weren't stored by the previous attempt
+            upload = None
+            if context.get('upload_id'):
+                upload = UploadSession.find(context['upload_id'])
+            if upload is None:
+                upload = UploadSession.start(mimetype=rdict['mimetype'])
+                context['upload_id'] = upload.uuid
+            with open(context['fullpath'], 'rb') as f:
+                data_object = upload.upload_stream(f)
+            UploadSession.delete_session(upload.uuid)
+            url = "cassandra://{}".format(data_object.uuid)
         else:
-            with open(context['fullpath'], 'r') as f:
-                blob = Blob.create_from_file(f, rdict['size'])
-                if blob:
-                    url = "cassandra://{}".format(blob.id)
-                else:
-                    return None
+            with open(context['fullpath'], 'rb') as f:
+                data_object = DataObject.create_from_stream(
+                    f, mimetype=rdict['mimetype'])
+            url = "cassandra://{}".format(data_object.uuid)
 
         try:
             # OK -- try to insert ( create ) the record...
@@ -23,11 +23,30 @@ from drastic.models.group import Group
 from drastic.models.user import User
 from drastic.models.tree_entry import TreeEntry
 from drastic.models.data_object import DataObject
+from drastic.models.data_chunk import DataChunk
+from drastic.models.chunk_store import (
+    ChunkReclaim,
+    ChunkRefCount,
+    ChunkStore,
+)
+from drastic.models.upload_session import UploadSession
 from drastic.models.listener_log import ListenerLog
+from drastic.models.collection_stats import CollectionStats
+from drastic.models.delete_job import DeleteFrontier
+from drastic.models.scrub_log import (
+    ScrubCheckpoint,
+    ScrubMismatch,
+)
 from drastic.models.resource import Resource
 from drastic.models.collection import Collection
 from drastic.models.search import SearchIndex
 from drastic.models.id_search import IDSearch
+from drastic.models.term_stats import TermStats
+from drastic.models.search_gram import SearchGram
+from drastic.models.index_queue import (
+    IndexCheckpoint,
+    IndexQueue,
+)
 from drastic.models.acl import Ace
 from drastic.models.notification import Notification
 
@@ -95,7 +114,10 @@ def create_keyspace(keyspace="drastic", hosts=('127.0.0.1',), strategy='SimpleSt
 def sync():
     """Create tables for the different models"""
     tables = (User, Group, SearchIndex, IDSearch, TreeEntry, DataObject,
-              Notification, ListenerLog)
+              DataChunk, Notification, ListenerLog, ChunkStore, ChunkRefCount,
+              ChunkReclaim, ScrubCheckpoint, ScrubMismatch, UploadSession, DeleteFrontier,
+              CollectionStats, TermStats, SearchGram, IndexQueue,
+              IndexCheckpoint)
 
     for table in tables:
         logger.info('Syncing table "{0}"'.format(table.__name__))
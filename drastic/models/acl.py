@@ -51,6 +51,9 @@ ACEMASK_WRITE_ACL = 0x00040000
 ACEMASK_WRITE_OWNER = 0x00080000
 ACEMASK_SYNCHRONIZE = 0x00100000
 
+# Actions a user can be authorized to perform on a resource or a collection
+ALL_ACTIONS = frozenset(["read", "write", "edit", "delete"])
+
 # Ace flags table
 ACEFLAG_TABLE = [
     (0x00000080, "INHERITED"),
@@ -282,6 +285,27 @@ def acl_list_to_cql(read_access, write_access):
     acl = u"{{{}}}".format(", ".join(ls_access))
     return acl
 
+
+def acl_to_actions(acl, gids, is_object):
+    """Return the set of actions an acl grants to a list of group ids"""
+    actions = set([])
+    for gid in gids:
+        if gid in acl:
+            level = acemask_to_str(acl[gid].acemask, is_object)
+            if level == "read":
+                actions.add("read")
+            elif level == "write":
+                actions.add("write")
+                actions.add("delete")
+                actions.add("edit")
+            elif level == "read/write":
+                actions.add("read")
+                actions.add("write")
+                actions.add("delete")
+                actions.add("edit")
+    return actions
+
+
 def str_to_acemask(lvl, is_object):
     """Return the acemask from a simplified access level"""
     if is_object:
@@ -0,0 +1,202 @@
+"""Content Addressed Chunk Store Model
+
+When deduplication is enabled (CHUNK_DEDUP in the configuration) the chunks
+of a data object aren't stored in the data_object partition. Each
+data_object row only holds the hash of its content and the bytes are stored
+once in the chunk_store table, whatever the number of objects using them.
+
+The number of data_object rows referencing a chunk is kept in a counter
+table. Deleting a data object decrements the counters and queues the chunks
+in chunk_reclaim, the chunks themselves are deleted later by
+ChunkStore.reclaim once nothing references them anymore.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from collections import deque
+from datetime import (
+    datetime,
+    timedelta
+)
+import hashlib
+import logging
+
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+
+from drastic.compression import encode_chunk
+from drastic.models.cql import (
+    get_session,
+    prepare,
+    wait_futures,
+    wait_futures_quietly,
+)
+from drastic.models.data_object import (
+    chunk_key,
+    insert_chunk_query,
+)
+
+
+# Chunks queued for less than this aren't reclaimed, to let the uploads
+# which may still reference them finish
+DEFAULT_RECLAIM_GRACE = timedelta(hours=1)
+
+
+def chunk_hash(data):
+    """Return the key of a chunk in the store"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ChunkRefCount(Model):
+    """Number of data_object rows referencing a chunk"""
+    hash = columns.Text(partition_key=True)
+    refcount = columns.Counter()
+
+
+class ChunkReclaim(Model):
+    """Chunks which may not be referenced anymore"""
+    hash = columns.Text(partition_key=True)
+    queued_ts = columns.DateTime(default=datetime.now)
+
+
+class ChunkStore(Model):
+    """A chunk of data, shared by all the data objects with the same
+    content"""
+    hash = columns.Text(partition_key=True)
+    blob = columns.Blob(required=False)
+    # The compression codec of the blob (see drastic.compression)
+    codec = columns.Text(required=False)
+    create_ts = columns.DateTime(default=datetime.now)
+
+    @classmethod
+    def fetch_async(cls, session, hash):
+        """Start fetching a chunk, the rows returned by the future have the
+        blob and the codec columns"""
+        query = prepare(u"""SELECT blob, codec FROM {keyspace}.chunk_store
+            WHERE hash=?""")
+        return session.execute_async(query, (hash,))
+
+    @classmethod
+    def release(cls, hashes, window=32):
+        """Drop a reference to each chunk in 'hashes' and queue them for
+        reclaim"""
+        session = get_session()
+        decrement = prepare(u"""UPDATE {keyspace}.chunk_ref_count
+            SET refcount = refcount - 1 WHERE hash=?""")
+        queue = prepare(u"""INSERT INTO {keyspace}.chunk_reclaim
+            (hash, queued_ts) VALUES (?, ?)""")
+        now = datetime.now()
+        futures = deque()
+        for hash in hashes:
+            futures.append(session.execute_async(decrement, (hash,)))
+            futures.append(session.execute_async(queue, (hash, now)))
+            wait_futures(futures, window)
+        wait_futures(futures)
+
+    @classmethod
+    def reclaim(cls, grace=DEFAULT_RECLAIM_GRACE):
+        """Delete the queued chunks which aren't referenced anymore, return
+        the number of chunks deleted"""
+        session = get_session()
+        list_queue = prepare(u"""SELECT hash, queued_ts
+            FROM {keyspace}.chunk_reclaim""")
+        get_count = prepare(u"""SELECT refcount FROM {keyspace}.chunk_ref_count
+            WHERE hash=?""")
+        get_chunk = prepare(u"""SELECT blob, codec, create_ts
+            FROM {keyspace}.chunk_store WHERE hash=?""")
+        delete_chunk = prepare(u"""DELETE FROM {keyspace}.chunk_store
+            WHERE hash=?""")
+        restore_chunk = prepare(u"""INSERT INTO {keyspace}.chunk_store
+            (hash, blob, codec, create_ts) VALUES (?, ?, ?, ?)""")
+        dequeue = prepare(u"""DELETE FROM {keyspace}.chunk_reclaim
+            WHERE hash=?""")
+
+        def refcount(hash):
+            rows = list(session.execute(get_count, (hash,)))
+            return rows[0]['refcount'] if rows else 0
+
+        deadline = datetime.now() - grace
+        reclaimed = 0
+        for entry in session.execute(list_queue):
+            hash = entry['hash']
+            if entry['queued_ts'] and entry['queued_ts'] > deadline:
+                continue
+            if refcount(hash) <= 0:
+                chunks = list(session.execute(get_chunk, (hash,)))
+                session.execute(delete_chunk, (hash,))
+                # An upload may have taken a new reference while we were
+                # deleting the chunk, put it back in that case
+                if chunks and refcount(hash) > 0:
+                    chunk = chunks[0]
+                    session.execute(restore_chunk, (hash, chunk['blob'],
+                                                    chunk['codec'],
+                                                    chunk['create_ts']))
+                    logging.warning(u"Chunk {} referenced during reclaim, "
+                                    "restored".format(hash))
+                elif chunks:
+                    reclaimed += 1
+            session.execute(dequeue, (hash,))
+        return reclaimed
+
+
+class ChunkStoreWriter(object):
+    """Write the chunks of a data object to the chunk store.
+
+    Each chunk takes a reference on its hash and is only stored if the hash
+    isn't already in the store. The requests are asynchronous, at most
+    'window' chunks are waiting for their existence check. The rows of the
+    data object are written in buckets of 'bucket_size' chunks if it's set."""
+
+    def __init__(self, uuid, window, bucket_size=None):
+        self.uuid = uuid
+        self.window = max(window, 1)
+        self.bucket_size = bucket_size
+        self.session = get_session()
+        self.increment = prepare(u"""UPDATE {keyspace}.chunk_ref_count
+            SET refcount = refcount + 1 WHERE hash=?""")
+        self.insert_row = insert_chunk_query(bucket_size, ("chunk_hash",))
+        self.exists = prepare(u"""SELECT hash FROM {keyspace}.chunk_store
+            WHERE hash=?""")
+        self.insert_chunk = prepare(u"""INSERT INTO {keyspace}.chunk_store
+            (hash, blob, codec, create_ts) VALUES (?, ?, ?, ?)""")
+        # Chunks waiting for the result of their existence check
+        self.checks = deque()
+        # Other requests in flight
+        self.futures = deque()
+
+    def put(self, sequence_number, data, codec):
+        """Store a chunk of the data object"""
+        hash = chunk_hash(data)
+        # The reference is taken before the existence check so a concurrent
+        # reclaim can't delete the chunk without noticing
+        self.futures.append(self.session.execute_async(self.increment, (hash,)))
+        key = chunk_key(self.uuid, sequence_number, self.bucket_size)
+        self.futures.append(self.session.execute_async(
+            self.insert_row, key + (hash,)))
+        self.checks.append((hash, data, codec,
+                            self.session.execute_async(self.exists, (hash,))))
+        self._store_missing(self.window - 1)
+        wait_futures(self.futures, 3 * self.window)
+
+    def _store_missing(self, pending):
+        """Store the chunks which aren't in the store yet, until at most
+        'pending' checks are in flight"""
+        while len(self.checks) > pending:
+            hash, data, codec, check = self.checks.popleft()
+            if not list(check.result()):
+                blob, used = encode_chunk(data, codec)
+                self.futures.append(self.session.execute_async(
+                    self.insert_chunk, (hash, blob, used, datetime.now())))
+
+    def close(self):
+        """Wait for all the requests"""
+        self._store_missing(0)
+        wait_futures(self.futures)
+
+    def abort(self):
+        """Wait for the requests in flight, ignoring errors"""
+        wait_futures_quietly(deque(check for _, _, _, check in self.checks))
+        self.checks.clear()
+        wait_futures_quietly(self.futures)
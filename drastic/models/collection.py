@@ -5,9 +5,14 @@ __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
+import base64
+from collections import deque
 from datetime import datetime
 from cassandra.cqlengine import connection
-from cassandra.query import SimpleStatement
+from cassandra.query import (
+    BatchStatement,
+    SimpleStatement,
+)
 import json
 
 from drastic import get_config
@@ -17,12 +22,29 @@ from drastic.models import (
 
 )
 from drastic.models.acl import (
+    ALL_ACTIONS,
     acemask_to_str,
+    acl_to_actions,
     serialize_acl_metadata
 )
+from drastic.models.collection_stats import CollectionStats
+from drastic.models.cql import (
+    get_session,
+    prepare,
+)
+from drastic.models.index_queue import queue_index
+from drastic.models.tree_cache import (
+    acl_cache,
+    tree_cache,
+)
+from drastic.models.tree_entry import (
+    insert_entry_query,
+    unset_nulls,
+)
 from drastic.util import (
     datetime_serializer,
     decode_meta,
+    default_cdmi_id,
     meta_cassandra_to_cdmi,
     meta_cdmi_to_cassandra,
     metadata_to_list,
@@ -31,6 +53,7 @@ from drastic.util import (
 )
 from drastic.models.errors import (
     CollectionConflictError,
+    InvalidMoveError,
     ResourceConflictError,
     NoSuchCollectionError
 )
@@ -38,6 +61,54 @@ from drastic.models.errors import (
 import logging
 
 
+# Kinds of children returned by Collection.list_children
+KIND_COLLECTION = "collection"
+KIND_RESOURCE = "resource"
+# Number of children returned by a call to Collection.list_children
+DEFAULT_PAGE_SIZE = 100
+# Number of tree_entry rows fetched per page when we go through all the
+# children of a collection
+LIST_FETCH_SIZE = 1000
+# Maximum number of names in the IN clause used by load_children
+IN_QUERY_LIMIT = 100
+# Number of partitions read concurrently by Collection.walk
+DEFAULT_WALK_WORKERS = 16
+
+
+def encode_cursor(name):
+    """Return the opaque cursor of the page following the row 'name'"""
+    return base64.urlsafe_b64encode(name.encode('utf-8'))
+
+
+def decode_cursor(cursor):
+    """Return the name of the row a cursor points after"""
+    try:
+        return base64.urlsafe_b64decode(str(cursor)).decode('utf-8')
+    except (TypeError, UnicodeError):
+        raise ValueError("Invalid cursor '{}'".format(cursor))
+
+
+def effective_acl(path, entry=None):
+    """Return the ACL which applies to the collection at 'path': its own
+    container_acl or the one of its closest ancestor which has one. The
+    results are cached for each collection (see drastic.models.tree_cache).
+    'entry' is the '.' row of the collection if it's already known"""
+    version = acl_cache.version
+    acl = acl_cache.get(path)
+    if acl is not None:
+        return acl
+    if entry is None:
+        entry = TreeEntry.find(path, ".")
+    if entry is not None and entry.container_acl:
+        acl = dict(entry.container_acl)
+    elif entry is None or path == '/':
+        acl = {}
+    else:
+        acl = effective_acl(split(path)[0])
+    acl_cache.put(path, acl, version)
+    return acl
+
+
 class Collection(object):
     """Collection model"""
 
@@ -59,44 +130,141 @@ class Collection(object):
     @classmethod
     def create(cls, name, container='/', metadata=None, username=None):
         """Create a new collection"""
-        from drastic.models import Notification
-        path = merge(container, name)
         # Check if parent collection exists
-        parent = Collection.find(container)
-        if parent is None:
+        if TreeEntry.find(container, '.') is None:
             raise NoSuchCollectionError(container)
-        resource = Resource.find(merge(container, name))
-        if resource is not None:
+        if TreeEntry.find(container, name) is not None:
             raise ResourceConflictError(container)
-        collection = Collection.find(path)
-        if collection is not None:
+        collection, created = cls._create_chain(container, [name], metadata,
+                                                username)[0]
+        if not created:
             raise CollectionConflictError(container)
-        now = datetime.now()
-        # If we try to create a tree enry with no metadata, cassandra-driver
-        # will fail as it tries to delete a static column
-        if metadata:
-            metadata = meta_cdmi_to_cassandra(metadata)
-            coll_entry = TreeEntry.create(container=path,
-                                          name='.',
-                                          container_create_ts=now,
-                                          container_modified_ts=now,
-                                          container_metadata=metadata)
+        return collection
+
+    @classmethod
+    def create_path(cls, path, metadata=None, username=None):
+        """Return the collection at 'path', create it and its missing
+        ancestors if needed (like mkdir -p). 'metadata' is only used if the
+        collection is created"""
+        if path == '/':
+            return Collection.find(path)
+        names = [name for name in path.split('/') if name]
+        # Find the deepest existing ancestor from the root, the rows of the
+        # collections we go through are usually in the path cache
+        container = '/'
+        for i, name in enumerate(names):
+            child = merge(container, name)
+            if TreeEntry.find(child, '.') is None:
+                break
+            container = child
         else:
-            coll_entry = TreeEntry.create(container=path,
-                                          name='.',
-                                          container_create_ts=now,
-                                          container_modified_ts=now)
-        coll_entry.update(uuid=coll_entry.container_uuid)
-        child_entry = TreeEntry.create(container=container,
-                                       name=name + '/',
-                                       uuid=coll_entry.container_uuid)
-        new = Collection.find(path)
-        state = new.mqtt_get_state()
-        payload = new.mqtt_payload({}, state)
-        Notification.create_collection(username, path, new.uuid, payload)
-        # Index the collection
-        new.index()
-        return new
+            return Collection.find(path)
+        if TreeEntry.find(container, names[i]) is not None:
+            raise ResourceConflictError(merge(container, names[i]))
+        collection, _ = cls._create_chain(container, names[i:], metadata,
+                                          username)[-1]
+        return collection
+
+    @classmethod
+    def _create_chain(cls, container, names, metadata=None, username=None):
+        """Create the collection container/names[0], then names[1] in it,
+        etc. The container has to exist. Return a list of (collection,
+        created) for each name, 'created' is False if it already existed.
+
+        The '.' row of each collection and the row linking it to its parent
+        are written with conditional inserts (IF NOT EXISTS). The two rows
+        written in the partition of an intermediate collection are sent in
+        a single conditional batch and all the partitions are written
+        concurrently."""
+        from drastic.models import Notification
+        session = get_session()
+        now = datetime.now()
+        paths = []
+        path = container
+        for name in names:
+            path = merge(path, name)
+            paths.append(path)
+        uuids = [default_cdmi_id() for _ in paths]
+        cassandra_metadata = meta_cdmi_to_cassandra(metadata) if metadata else None
+        insert_dot = insert_entry_query(["uuid",
+                                         "container_uuid",
+                                         "container_create_ts",
+                                         "container_modified_ts",
+                                         "container_metadata"],
+                                        if_not_exists=True)
+        insert_link = insert_entry_query(["uuid"], if_not_exists=True)
+        link = session.execute_async(insert_link, (container, names[0] + u'/',
+                                                   uuids[0]))
+        futures = []
+        for i, path in enumerate(paths):
+            values = [path, u'.'] + unset_nulls([
+                uuids[i], uuids[i], now, now,
+                cassandra_metadata if i == len(paths) - 1 else None])
+            if i + 1 < len(paths):
+                batch = BatchStatement()
+                batch.add(insert_dot, values)
+                batch.add(insert_link, (path, names[i + 1] + u'/',
+                                        uuids[i + 1]))
+                futures.append(session.execute_async(batch))
+            else:
+                futures.append(session.execute_async(insert_dot, values))
+        # Whether the '.' row and the link of each collection were inserted
+        dot_applied = []
+        link_applied = [list(link.result())[0]['[applied]']]
+        for i, future in enumerate(futures):
+            applied = list(future.result())[0]['[applied]']
+            if i + 1 == len(paths):
+                dot_applied.append(applied)
+            elif applied:
+                dot_applied.append(True)
+                link_applied.append(True)
+            else:
+                # One of the rows exists, the collection is being created
+                # concurrently. Insert them one by one
+                result = session.execute(insert_dot, [paths[i], u'.'] +
+                                         unset_nulls([uuids[i], uuids[i],
+                                                      now, now, None]))
+                dot_applied.append(list(result)[0]['[applied]'])
+                result = session.execute(insert_link,
+                                         (paths[i], names[i + 1] + u'/',
+                                          uuids[i + 1]))
+                link_applied.append(list(result)[0]['[applied]'])
+        set_uuid = prepare(u"""UPDATE {keyspace}.tree_entry SET uuid=?
+            WHERE container=? AND name=?""")
+        parents = [container] + paths[:-1]
+        collections = []
+        for i, path in enumerate(paths):
+            tree_cache.invalidate_container(path, True)
+            tree_cache.invalidate(parents[i], names[i] + u'/')
+            if link_applied[i]:
+                CollectionStats.add(parents[i], children=1)
+            if not dot_applied[i]:
+                collections.append((Collection.find(path), False))
+                continue
+            if not link_applied[i]:
+                # The link was written by a concurrent creation which lost
+                # the '.' row, it must point to our collection
+                session.execute(set_uuid, (uuids[i], parents[i],
+                                           names[i] + u'/'))
+            if i + 1 == len(paths):
+                entry_metadata = cassandra_metadata or {}
+            else:
+                entry_metadata = {}
+            entry = TreeEntry(container=path,
+                              name=u'.',
+                              uuid=uuids[i],
+                              container_uuid=uuids[i],
+                              container_create_ts=now,
+                              container_modified_ts=now,
+                              container_metadata=entry_metadata)
+            new = Collection(entry)
+            state = new.mqtt_get_state()
+            payload = new.mqtt_payload({}, state)
+            Notification.create_collection(username, path, new.uuid, payload)
+            # Index the collection
+            queue_index(new)
+            collections.append((new, True))
+        return collections
 
     def create_acl_list(self, read_access, write_access):
         """Create ACL in the tree entry table from two lists of groups id,
@@ -131,11 +299,13 @@ class Collection(object):
         session.set_keyspace(keyspace)
         query = SimpleStatement("""DELETE FROM tree_entry WHERE container=%s""")
         session.execute(query, (self.path,))
+        tree_cache.invalidate_container(self.path, True)
         # Get the row that describe the collection as a child of its parent
         child = TreeEntry.objects.filter(container=self.container,
                                          name=u"{}/".format(self.name)).first()
         if child:
             child.delete()
+        CollectionStats.remove_subtree(self.path)
         state = self.mqtt_get_state()
         payload = self.mqtt_payload(state, {})
         Notification.delete_collection(username, self.path, self.uuid, payload)
@@ -144,29 +314,76 @@ class Collection(object):
     @classmethod
     def delete_all(cls, path, username=None):
         """Delete recursively all sub-collections and all resources contained
-        in a collection at 'path'"""
-        from drastic.models import Resource
-        parent = Collection.find(path)
-        if not parent:
-            return
-        collections, resources = parent.get_child()
-        collections = [Collection.find(merge(path, c)) for c in collections]
-        resources = [Resource.find(merge(path, c)) for c in resources]
-        for resource in resources:
-            resource.delete(username)
-        for collection in collections:
-            Collection.delete_all(collection.path, username)
-        parent.delete(username)
+        in a collection at 'path' (see drastic.subtree_delete)"""
+        from drastic.subtree_delete import SubtreeDelete
+        SubtreeDelete(path, username).run()
 
     @classmethod
     def find(cls, path):
         """Find a collection by path, initialise the collection with the
         appropriate row in the tree_entry table"""
-        entries = TreeEntry.objects.filter(container=path, name=".")
-        if not entries:
+        entry = TreeEntry.find(path, ".")
+        if entry is None:
             return None
         else:
-            return cls(entries.first())
+            return cls(entry)
+
+    def load_children(self, page):
+        """Return the collections and the resources of a page returned by
+        list_children, in the same order.
+
+        The rows of the resources are read with IN queries on the names and
+        their data objects with DataObject.find_many, the rows of the child
+        collections are read concurrently."""
+        session = get_session()
+        entries = []
+        names = [name for name, kind in page if kind == KIND_RESOURCE]
+        query = prepare(u"""SELECT * FROM {keyspace}.tree_entry
+            WHERE container=? AND name IN ?""")
+        for i in xrange(0, len(names), IN_QUERY_LIMIT):
+            for row in session.execute(query, (self.path,
+                                               names[i:i + IN_QUERY_LIMIT])):
+                entries.append(TreeEntry._construct_instance(row))
+        resources = {}
+        for resource in Resource.load_many(entries):
+            resources[resource.name] = resource
+        query = prepare(u"""SELECT * FROM {keyspace}.tree_entry
+            WHERE container=? AND name='.'""")
+        futures = [(name, session.execute_async(query, (merge(self.path, name),)))
+                   for name, kind in page if kind == KIND_COLLECTION]
+        collections = {}
+        for name, future in futures:
+            for row in future.result():
+                collections[name] = Collection(TreeEntry._construct_instance(row))
+        children = []
+        for name, kind in page:
+            if kind == KIND_COLLECTION:
+                child = collections.get(name)
+            else:
+                child = resources.get(name)
+            if child is not None:
+                children.append(child)
+        return children
+
+    def move(self, path, username=None, workers=None):
+        """Move or rename the collection with its content, return the
+        collection at its new path (see drastic.subtree_move)"""
+        from drastic.subtree_move import (
+            DEFAULT_WORKERS,
+            SubtreeMove,
+        )
+        if self.is_root or path == self.path or path.startswith(self.path + '/'):
+            raise InvalidMoveError(self.path)
+        container, name = split(path)
+        if Collection.find(container) is None:
+            raise NoSuchCollectionError(container)
+        if Collection.find(path) is not None:
+            raise CollectionConflictError(path)
+        if Resource.find(path) is not None:
+            raise ResourceConflictError(path)
+        job = SubtreeMove(self.path, path, username,
+                          workers or DEFAULT_WORKERS)
+        return job.run()
 
     def get_acl(self):
         """Return a dictionary of acl based on the Collection schema"""
@@ -196,49 +413,124 @@ class Collection(object):
 
     def get_authorized_actions(self, user):
         """"Get available actions for user according to a group"""
-        # Check permission on the parent container if there's no action
-        # defined at this level
-        if not self.entry.container_acl:
-            if self.is_root:
-                return set([])
-            else:
-                parent_container = Collection.find(self.container)
-                return parent_container.get_authorized_actions(user)
-        actions = set([])
-        for gid in user.groups + ["AUTHENTICATED@"]:
-            if gid in self.entry.container_acl:
-                ace = self.entry.container_acl[gid]
-                level = acemask_to_str(ace.acemask, False)
-                if level == "read":
-                    actions.add("read")
-                elif level == "write":
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-                elif level == "read/write":
-                    actions.add("read")
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-        return actions
+        # The ACL are inherited from the parent container if there's no
+        # action defined at this level
+        acl = effective_acl(self.path, self.entry)
+        return acl_to_actions(acl, user.groups + ["AUTHENTICATED@"], False)
+
+    def _child_names(self, after=None, fetch_size=LIST_FETCH_SIZE):
+        """Iterate over the names of the tree_entry rows of the collection
+        in clustering order, after the name 'after' if it's given. The rows
+        are fetched lazily, 'fetch_size' at a time"""
+        if after is None:
+            query = prepare(u"""SELECT name FROM {keyspace}.tree_entry
+                WHERE container=?""")
+            bound = query.bind((self.path,))
+        else:
+            query = prepare(u"""SELECT name FROM {keyspace}.tree_entry
+                WHERE container=? AND name > ?""")
+            bound = query.bind((self.path, after))
+        bound.fetch_size = fetch_size
+        for row in get_session().execute(bound):
+            if row['name'] is not None and row['name'] != '.':
+                yield row['name']
 
     def get_child(self):
         """Return two lists for child container and child dataobjects"""
-        entries = TreeEntry.objects.filter(container=self.path)
         child_container = []
         child_dataobject = []
-        for entry in list(entries):
-            if entry.name == '.':
-                continue
-            elif entry.name.endswith('/'):
-                child_container.append(entry.name[:-1])
+        for name in self._child_names():
+            if name.endswith('/'):
+                child_container.append(name[:-1])
             else:
-                child_dataobject.append(entry.name)
+                child_dataobject.append(name)
         return (child_container, child_dataobject)
 
     def get_child_resource_count(self):
-        child_container, child_dataobject = self.get_child()
-        return len(child_dataobject)
+        """Count the resources of the collection, only their names are
+        fetched"""
+        count = 0
+        for name in self._child_names():
+            if not name.endswith('/'):
+                count += 1
+        return count
+
+    def list_children(self, limit=DEFAULT_PAGE_SIZE, after=None, kind=None):
+        """Return a page of at most 'limit' children, in name order, and the
+        cursor of the next page (None if it's the last page).
+
+        The page is a list of (name, kind) couples, kind is KIND_COLLECTION
+        or KIND_RESOURCE. 'after' is a cursor returned by a previous call,
+        only children of the given 'kind' are listed if it's set."""
+        if limit < 1:
+            raise ValueError("Invalid page size {}".format(limit))
+        if after is not None:
+            after = decode_cursor(after)
+        children = []
+        last = None
+        # Without a filter a page of rows is a page of children
+        fetch_size = limit + 1 if kind is None else LIST_FETCH_SIZE
+        for name in self._child_names(after, fetch_size):
+            if name.endswith('/'):
+                child = (name[:-1], KIND_COLLECTION)
+            else:
+                child = (name, KIND_RESOURCE)
+            if kind is not None and child[1] != kind:
+                continue
+            if len(children) == limit:
+                return children, encode_cursor(last)
+            children.append(child)
+            last = name
+        return children, None
+
+    def get_stats(self):
+        """Return the number of children of the collection, and the number
+        and the total size of the resources below it"""
+        return CollectionStats.get(self.path)
+
+    @classmethod
+    def walk(cls, path, workers=DEFAULT_WALK_WORKERS):
+        """Generate (collection path, subcollection names, resource names)
+        for the collection at 'path' and every collection below it, like
+        os.walk. A collection is generated before its subcollections and
+        the names can be removed from the subcollections list to skip them.
+
+        Up to 'workers' partitions are read concurrently. The collections
+        left to visit are kept on a stack: it holds the subcollections not
+        visited yet of each collection on the current branch, so it grows
+        with the depth of the tree times the number of subcollections of a
+        collection, not with the size of the tree. The names of a partition
+        are all read before it's generated."""
+        session = get_session()
+        query = prepare(u"""SELECT name FROM {keyspace}.tree_entry
+            WHERE container=?""")
+        pending = [path]
+        in_flight = deque()
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                container = pending.pop()
+                bound = query.bind((container,))
+                bound.fetch_size = LIST_FETCH_SIZE
+                in_flight.append((container, session.execute_async(bound)))
+            container, future = in_flight.popleft()
+            exists = False
+            collections = []
+            resources = []
+            for row in future.result():
+                exists = True
+                name = row['name']
+                if name == '.':
+                    continue
+                elif name.endswith('/'):
+                    collections.append(name[:-1])
+                else:
+                    resources.append(name)
+            if not exists:
+                continue
+            yield container, collections, resources
+            # The first subcollection is visited first
+            pending.extend(merge(container, name)
+                           for name in reversed(collections))
 
     def get_cdmi_metadata(self):
         """Return a dictionary of metadata"""
@@ -253,8 +545,9 @@ class Collection(object):
         return decode_meta(self.entry.container_metadata.get(key, ""))
 
     def index(self):
+        """Index the name and the metadata, only the terms which changed are
+        written"""
         from drastic.models import SearchIndex
-        self.reset()
         SearchIndex.index(self, ['name', 'metadata'])
 
     def mqtt_get_state(self):
@@ -290,10 +583,11 @@ class Collection(object):
             "metadata": self.get_list_metadata()
         }
         if user:
-            data['can_read'] = self.user_can(user, "read")
-            data['can_write'] = self.user_can(user, "write")
-            data['can_edit'] = self.user_can(user, "edit")
-            data['can_delete'] = self.user_can(user, "delete")
+            actions = self.user_actions(user)
+            data['can_read'] = "read" in actions
+            data['can_write'] = "write" in actions
+            data['can_edit'] = "edit" in actions
+            data['can_delete'] = "delete" in actions
         return data
 
     def update(self, **kwargs):
@@ -314,12 +608,16 @@ class Collection(object):
             del kwargs['username']
         else:
             username = None
+        # The entry is updated in place, all the fields go in one statement
         self.entry.update(**kwargs)
-        coll = Collection.find(self.path)
-        post_state = coll.mqtt_get_state()
-        payload = coll.mqtt_payload(pre_state, post_state)
-        Notification.update_collection(username, coll.path, coll.uuid, payload)
-        coll.index()
+        self.modified_ts = self.entry.container_modified_ts
+        post_state = self.mqtt_get_state()
+        payload = self.mqtt_payload(pre_state, post_state)
+        Notification.update_collection(username, self.path, self.uuid, payload)
+        # The terms only depend on the name and the metadata
+        if (post_state['name'] != pre_state['name'] or
+                post_state['metadata'] != pre_state['metadata']):
+            queue_index(self)
 
     def update_acl_list(self, read_access, write_access):
         """Update ACL in the tree entry table from two lists of groups id,
@@ -331,18 +629,20 @@ class Collection(object):
         of ACE dictionary), existing ACL are replaced"""
         self.entry.update_container_acl_cdmi(cdmi_acl)
 
+    def user_actions(self, user):
+        """Return the set of actions the user can perform, the ACL are only
+        checked once"""
+        if user.administrator:
+            # An administrator can do anything
+            return ALL_ACTIONS
+        return self.get_authorized_actions(user)
+
     def user_can(self, user, action):
         """
         User can perform the action if any of the user's group IDs
         appear in this list for 'action'_access in this object.
         """
-        if user.administrator:
-            # An administrator can do anything
-            return True
-        actions = self.get_authorized_actions(user)
-        if action in actions:
-            return True
-        return False
+        return action in self.user_actions(user)
 
     def get_modified_ts(self):
         return self.entry.modified_ts
@@ -0,0 +1,122 @@
+"""Collection Statistics Model
+
+Counters maintained for each collection so its size is known without
+walking it: the number of direct children (resources and collections), and
+the number of resources and their total size in bytes in the whole subtree.
+
+They are updated incrementally when resources and collections are created,
+deleted, moved or change size. An update of a resource changes the
+counters of all the ancestors of its container, in a single counter batch.
+The counters may drift after failures, StatsReconciler (see
+drastic.reconcile) rebuilds them from a scan of the tree.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+from cassandra.query import (
+    BatchStatement,
+    BatchType,
+)
+
+from drastic.models.cql import (
+    get_session,
+    prepare,
+)
+from drastic.util import split
+
+
+def ancestors(path):
+    """Return the path of a collection and the paths of its ancestors, up to
+    the root"""
+    paths = [path]
+    while path != '/':
+        path, _ = split(path)
+        paths.append(path)
+    return paths
+
+
+def increment_query():
+    """Return the prepared statement which adds values to the counters of
+    a collection"""
+    return prepare(u"""UPDATE {keyspace}.collection_stats
+        SET children = children + ?, resources = resources + ?,
+            size = size + ?
+        WHERE path=?""")
+
+
+class CollectionStats(Model):
+    """Counters of a collection, indexed by path"""
+    path = columns.Text(partition_key=True)
+    # Number of resources and collections directly in the collection
+    children = columns.Counter()
+    # Number of resources in the collection and below it ('objects' is
+    # reserved by cqlengine)
+    resources = columns.Counter()
+    # Total size of these resources, in bytes
+    size = columns.Counter()
+
+    @classmethod
+    def add(cls, container, children=0, resources=0, size=0):
+        """Change the number of children of a collection and add resources
+        to the collection and all its ancestors (negative values remove
+        them)"""
+        query = increment_query()
+        batch = BatchStatement(batch_type=BatchType.COUNTER)
+        batch.add(query, (children, resources, size or 0, container))
+        if resources or size:
+            for path in ancestors(container)[1:]:
+                batch.add(query, (0, resources, size or 0, path))
+        get_session().execute(batch)
+
+    @classmethod
+    def get(cls, path):
+        """Return the counters of a collection in a dictionary"""
+        query = prepare(u"""SELECT children, resources, size
+            FROM {keyspace}.collection_stats WHERE path=?""")
+        rows = list(get_session().execute(query, (path,)))
+        stats = {"children": 0, "resources": 0, "size": 0}
+        if rows:
+            for key in stats:
+                stats[key] = rows[0][key] or 0
+        return stats
+
+    @classmethod
+    def remove_subtree(cls, path):
+        """Account for the deletion of the collection at 'path' in the
+        counters of its ancestors and reset its own counters"""
+        stats = cls.get(path)
+        container, _ = split(path)
+        cls.add(container, -1, -stats['resources'], -stats['size'])
+        cls.reset(path, stats)
+        return stats
+
+    @classmethod
+    def reset(cls, path, stats=None):
+        """Set the counters of a collection back to 0, 'stats' are their
+        current values if they are known. Counters can't be deleted and
+        created again"""
+        if stats is None:
+            stats = cls.get(path)
+        if any(stats.values()):
+            get_session().execute(increment_query(),
+                                  (-stats['children'], -stats['resources'],
+                                   -stats['size'], path))
+
+    @classmethod
+    def transfer(cls, old_path, new_path):
+        """Move the counters of a collection to its new path, the ancestors
+        aren't changed"""
+        stats = cls.get(old_path)
+        if not any(stats.values()):
+            return
+        query = increment_query()
+        batch = BatchStatement(batch_type=BatchType.COUNTER)
+        batch.add(query, (stats['children'], stats['resources'], stats['size'],
+                          new_path))
+        batch.add(query, (-stats['children'], -stats['resources'],
+                          -stats['size'], old_path))
+        get_session().execute(batch)
@@ -0,0 +1,86 @@
+"""CQL helpers shared by the models
+
+cqlengine covers most of our needs, the helpers below are used when we need
+the raw driver (prepared statements, asynchronous execution).
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from cassandra.cqlengine import connection
+
+from drastic import get_config
+
+
+# Prepared statements, indexed by (session, query string)
+_prepared_statements = {}
+
+
+def get_keyspace():
+    """Return the name of the keyspace from the configuration"""
+    cfg = get_config(None)
+    return cfg.get('KEYSPACE', 'drastic')
+
+
+def get_session():
+    """Return the session used by cqlengine"""
+    return connection.get_session()
+
+
+def prepare(query):
+    """Return a prepared statement for a query.
+
+    Statements are prepared once per session. '{keyspace}' is replaced with
+    the name of the keyspace so we don't need to call set_keyspace before
+    executing the statement."""
+    session = get_session()
+    key = (id(session), query)
+    stmt = _prepared_statements.get(key)
+    if stmt is None:
+        stmt = session.prepare(query.format(keyspace=get_keyspace()))
+        _prepared_statements[key] = stmt
+    return stmt
+
+
+def wait_futures(futures, pending=0):
+    """Wait for the oldest futures of a deque until at most 'pending' are
+    still in flight. Errors are raised by ResponseFuture.result()"""
+    while len(futures) > pending:
+        futures.popleft().result()
+
+
+def wait_futures_quietly(futures):
+    """Wait for all the futures of a deque, ignoring errors. Used to drain
+    the requests still in flight before cleaning up after a failure"""
+    while futures:
+        try:
+            futures.popleft().result()
+        except Exception:
+            pass
+
+
+def execute_update(table, keys, values, conditions=None):
+    """Update several columns of a table with a single prepared statement.
+
+    'keys' is a list of (column, value) pairs for the WHERE clause and
+    'values' a dictionary of the columns to set. If 'conditions' is given
+    (a dictionary of expected values) the update is a lightweight
+    transaction, applied only if the current values match.
+
+    Return True if the update has been applied."""
+    names = sorted(values)
+    query = u"UPDATE {{keyspace}}.{} SET {} WHERE {}".format(
+        table,
+        u", ".join(u"{}=?".format(n) for n in names),
+        u" AND ".join(u"{}=?".format(k) for k, _ in keys))
+    params = [values[n] for n in names] + [v for _, v in keys]
+    if conditions:
+        cond_names = sorted(conditions)
+        query += u" IF {}".format(
+            u" AND ".join(u"{}=?".format(n) for n in cond_names))
+        params += [conditions[n] for n in cond_names]
+    result = get_session().execute(prepare(query), params)
+    if conditions:
+        return list(result)[0]['[applied]']
+    return True
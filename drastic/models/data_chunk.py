@@ -0,0 +1,27 @@
+"""Bucketed Data Chunk Model
+
+The chunks of a data object are normally stored in its data_object
+partition, which grows with the object. When the object has a bucket_size
+(see DataObject) its chunks are stored in this table instead, spread over
+partitions of at most bucket_size chunks: chunk n goes in the partition
+(uuid, n // bucket_size). The static columns stay in data_object.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+
+
+class DataChunk(Model):
+    """A chunk of a bucketed data object, the columns have the same meaning
+    as the per-row columns of DataObject"""
+    uuid = columns.Text(partition_key=True)
+    bucket = columns.Integer(partition_key=True)
+    sequence_number = columns.Integer(primary_key=True, partition_key=False)
+    blob = columns.Blob(required=False)
+    compressed = columns.Boolean(default=False)
+    codec = columns.Text(required=False)
+    chunk_hash = columns.Text(required=False)
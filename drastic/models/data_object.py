@@ -5,17 +5,22 @@ __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
-from cStringIO import StringIO
-import zipfile
+from collections import deque
+import hashlib
+import io
+import time
 from datetime import datetime
-from cassandra.cqlengine import (
-    columns,
-    connection
-)
+from cassandra.cqlengine import columns
 from cassandra.query import SimpleStatement
 from cassandra.cqlengine.models import Model
 
 from drastic import get_config
+from drastic.compression import (
+    CODEC_NONE,
+    choose_codec,
+    decode_chunk,
+    encode_chunk,
+)
 from drastic.models import (
     Group,
 )
@@ -27,7 +32,195 @@ from drastic.models.acl import (
     str_to_acemask,
     cdmi_str_to_acemask,
 )
-from drastic.util import default_cdmi_id
+from drastic.models.cql import (
+    execute_update,
+    get_keyspace,
+    get_session,
+    prepare,
+    wait_futures,
+    wait_futures_quietly,
+)
+from drastic.util import (
+    IterStreamer,
+    default_cdmi_id,
+)
+
+
+# Size of the chunks written by create_from_stream
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Maximum number of asynchronous chunk inserts in flight during an upload
+DEFAULT_WRITE_WINDOW = 8
+# Number of chunks fetched ahead of the consumer by chunk_content
+DEFAULT_READ_PREFETCH = 4
+# Maximum number of bytes chunk_content keeps in memory for prefetched chunks
+DEFAULT_READ_BUFFER = 16 * 1024 * 1024
+# Algorithm used for the checksum static column (see hashlib.new)
+CHECKSUM_ALGORITHM = "sha256"
+# Maximum number of objects read with a single IN query by find_many, larger
+# batches are read with concurrent queries
+IN_QUERY_LIMIT = 10
+# Maximum number of concurrent queries in flight in find_many
+DEFAULT_FIND_WINDOW = 32
+# Seconds between the switch of an object to buckets and the deletion of its
+# old chunks, for the readers which loaded the object before the switch
+DEFAULT_MIGRATION_GRACE = 60
+
+
+def chunk_range(offset, length, chunk_size):
+    """Return the first and the last sequence numbers of the chunks holding
+    'length' bytes from 'offset', and the position of 'offset' in the first
+    chunk. The last sequence number is None if length is None (read to the
+    end)"""
+    first = offset // chunk_size
+    if length is None:
+        last = None
+    else:
+        last = (offset + max(length, 1) - 1) // chunk_size
+    return first, last, offset - first * chunk_size
+
+
+def slice_chunks(chunks, skip, length):
+    """Yields the content of an iterator of chunks, skipping the first 'skip'
+    bytes and stopping after 'length' bytes (if length isn't None)"""
+    for data in chunks:
+        if skip:
+            if skip >= len(data):
+                skip -= len(data)
+                continue
+            data = data[skip:]
+            skip = 0
+        if length is not None:
+            if len(data) >= length:
+                if length:
+                    yield data[:length]
+                return
+            length -= len(data)
+        yield data
+
+
+def chunk_key(uuid, sequence_number, bucket_size):
+    """Return the primary key of a chunk, in data_chunk if the object is
+    bucketed (see drastic.models.data_chunk), in data_object otherwise"""
+    if bucket_size:
+        return (uuid, sequence_number // bucket_size, sequence_number)
+    return (uuid, sequence_number)
+
+
+def insert_chunk_query(bucket_size, names):
+    """Return a prepared statement inserting a chunk with the columns in
+    'names', the parameters are the chunk key followed by the values"""
+    if bucket_size:
+        table = "data_chunk"
+        keys = ("uuid", "bucket", "sequence_number")
+    else:
+        table = "data_object"
+        keys = ("uuid", "sequence_number")
+    names = keys + tuple(names)
+    return prepare(u"INSERT INTO {{keyspace}}.{} ({}) VALUES ({})".format(
+        table, u", ".join(names), u", ".join(u"?" for _ in names)))
+
+
+def read_chunk(fileobj, size):
+    """Read exactly 'size' bytes from a file-like object, unless the end of
+    the file is reached first"""
+    data = fileobj.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining > 0:
+        data = fileobj.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return ''.join(parts)
+
+
+class ChunkWriter(object):
+    """Write the chunks of a data object in its partition, or in buckets of
+    'bucket_size' chunks if it's set. The inserts are asynchronous, with at
+    most 'window' of them in flight"""
+
+    def __init__(self, uuid, window, bucket_size=None):
+        self.uuid = uuid
+        self.window = max(window, 1)
+        self.bucket_size = bucket_size
+        self.session = get_session()
+        self.insert = insert_chunk_query(bucket_size,
+                                         ("blob", "compressed", "codec"))
+        self.futures = deque()
+
+    def put(self, sequence_number, data, codec):
+        """Store a chunk of the data object"""
+        blob, used = encode_chunk(data, codec)
+        key = chunk_key(self.uuid, sequence_number, self.bucket_size)
+        self.futures.append(self.session.execute_async(
+            self.insert, key + (blob, used != CODEC_NONE, used)))
+        wait_futures(self.futures, self.window - 1)
+
+    def close(self):
+        """Wait for all the inserts"""
+        wait_futures(self.futures)
+
+    def abort(self):
+        """Wait for the inserts in flight, ignoring errors"""
+        wait_futures_quietly(self.futures)
+
+
+class DataObjectReader(IterStreamer):
+    """File-like reader over the content of a data object (see
+    DataObject.open). Seeking needs the chunk size of the object, only the
+    chunks from the new position are then read"""
+
+    def __init__(self, data_object):
+        IterStreamer.__init__(self, data_object.chunk_content())
+        self.data_object = data_object
+        self.position = 0
+
+    def __len__(self):
+        return self.data_object.size or 0
+
+    def next(self):
+        data = IterStreamer.next(self)
+        self.position += len(data)
+        return data
+
+    def _take(self, n):
+        view = IterStreamer._take(self, n)
+        self.position += len(view)
+        return view
+
+    def seekable(self):
+        return bool(self.data_object.chunk_size)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = (self.data_object.size or 0) + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        if position == self.position:
+            return position
+        if not self.seekable():
+            raise io.UnsupportedOperation("Unknown chunk size, can't seek")
+        skip = position - self.position
+        if 0 < skip < len(self.leftover):
+            # Still in the current chunk
+            self.leftover = self.leftover[skip:]
+        else:
+            self.iterator = iter(self.data_object.range_content(position))
+            self.leftover = memoryview('')
+        self.position = position
+        return position
 
 
 static_fields = ["checksum",
@@ -39,7 +232,12 @@ static_fields = ["checksum",
                  "modified_ts",
                  "type",
                  "acl",
-                 "treepath"]
+                 "treepath",
+                 "chunk_size",
+                 "bucket_size"]
+
+# Columns read to load the header of an object, without any chunk
+STATIC_COLUMNS = u", ".join(["uuid"] + static_fields)
 
 
 class DataObject(Model):
@@ -76,6 +274,13 @@ class DataObject(Model):
     acl = columns.Map(columns.Text, columns.UserDefinedType(Ace), static=True)
     # A general aid to integrity ...
     treepath = columns.Text(static=True, required=False)
+    # Size of every chunk but the last one, null if the chunks of the object
+    # don't have a fixed size (objects built with create and append_chunk).
+    # Used by read_range to find the chunks holding a range of bytes
+    chunk_size = columns.Integer(static=True, required=False)
+    # Number of chunks per partition of data_chunk, null if the chunks are
+    # stored in this partition (see drastic.models.data_chunk)
+    bucket_size = columns.Integer(static=True, required=False)
     #####################
     # And 'clever' bit -- 'here' data, These will be the only per-record-fields
     # in the partition (i.e. object)
@@ -84,51 +289,189 @@ class DataObject(Model):
     # This is the 'clustering' key...
     sequence_number = columns.Integer(primary_key=True, partition_key=False)
     blob = columns.Blob(required=False)
+    # True if the blob is compressed. Chunks written before the codec column
+    # existed are zip archives, the codec is then null
     compressed = columns.Boolean(default=False)
+    # The compression codec of the blob (see drastic.compression)
+    codec = columns.Text(required=False)
+    # For deduplicated objects the blob is null and the content is in the
+    # chunk store under this hash (see drastic.models.chunk_store)
+    chunk_hash = columns.Text(required=False)
     #####################
 
     @classmethod
-    def append_chunk(cls, uuid, data, sequence_number, compressed=False):
-        """Create a new blob for an existing data_object"""
+    def append_chunk(cls, uuid, data, sequence_number, compressed=False,
+                     codec=None):
+        """Create a new blob for an existing data_object. If a codec is given
+        the data is compressed here, otherwise 'compressed' flags data which
+        is already zip-compressed by the caller"""
+        if codec:
+            data, codec = encode_chunk(data, codec)
+            compressed = codec != CODEC_NONE
+        bucket_size = cls._read_bucket_size(uuid)
+        if bucket_size:
+            query = insert_chunk_query(bucket_size,
+                                       ("blob", "compressed", "codec"))
+            get_session().execute(
+                query, chunk_key(uuid, sequence_number, bucket_size) +
+                (data, compressed, codec))
+            return cls(uuid=uuid, sequence_number=sequence_number,
+                       bucket_size=bucket_size, blob=data,
+                       compressed=compressed, codec=codec)
         data_object = cls(uuid=uuid,
                           sequence_number=sequence_number,
                           blob=data,
-                          compressed=compressed)
+                          compressed=compressed,
+                          codec=codec)
         data_object.save()
         return data_object
 
 
-    def chunk_content(self):
+    @classmethod
+    def _read_bucket_size(cls, uuid):
+        """Read the bucket size of an object, None if its chunks are in its
+        data_object partition"""
+        query = prepare(u"""SELECT bucket_size FROM {keyspace}.data_object
+            WHERE uuid=? LIMIT 1""")
+        rows = list(get_session().execute(query, (uuid,)))
+        return rows[0]['bucket_size'] if rows else None
+
+
+    def _chunk_keys(self, first=0, last=None):
+        """Iterate over the keys and the chunk hashes of the chunks of the
+        object, from 'first' to 'last' (included)"""
+        if not self.bucket_size:
+            found = False
+            for row in self._partition_keys(first, last):
+                found = True
+                yield row
+            if found:
+                return
+            # The object may have been moved to buckets since it was loaded
+            self.bucket_size = self._read_bucket_size(self.uuid)
+            if not self.bucket_size:
+                return
+        for row in self._bucket_keys(first, last):
+            yield row
+
+
+    def _partition_keys(self, first=0, last=None):
+        """Iterate over the sequence numbers and the chunk hashes of the
+        chunks stored in the data_object partition"""
+        if last is None:
+            query = prepare(u"""SELECT sequence_number, chunk_hash
+                FROM {keyspace}.data_object
+                WHERE uuid=? AND sequence_number >= ?""")
+            params = (self.uuid, first)
+        else:
+            query = prepare(u"""SELECT sequence_number, chunk_hash
+                FROM {keyspace}.data_object
+                WHERE uuid=? AND sequence_number >= ? AND sequence_number <= ?""")
+            params = (self.uuid, first, last)
+        # Only the keys are listed here, the driver pages through them lazily
+        # so this doesn't depend on the size of the object
+        for row in get_session().execute(query, params):
+            if row['sequence_number'] is not None:
+                yield row
+
+
+    def _bucket_keys(self, first=0, last=None):
+        """Iterate over the buckets, the sequence numbers and the chunk hashes
+        of the chunks stored in data_chunk. The chunks are contiguous so we
+        stop at the first bucket which isn't full"""
+        query = prepare(u"""SELECT bucket, sequence_number, chunk_hash
+            FROM {keyspace}.data_chunk WHERE uuid=? AND bucket=?
+            AND sequence_number >= ? AND sequence_number <= ?""")
+        session = get_session()
+        bucket = first // self.bucket_size
+        start = first
+        while last is None or start <= last:
+            end = (bucket + 1) * self.bucket_size - 1
+            if last is not None:
+                end = min(end, last)
+            count = 0
+            for row in session.execute(query, (self.uuid, bucket, start, end)):
+                count += 1
+                yield row
+            if count < end - start + 1:
+                return
+            bucket += 1
+            start = bucket * self.bucket_size
+
+
+    def _fetch_chunks(self, keys, prefetch, max_buffer):
+        """Yields the content of the chunks listed in 'keys', in order.
+
+        Up to 'prefetch' chunks are fetched concurrently ahead of the
+        consumer, as long as the chunks held in memory (fetched or in flight)
+        are estimated to stay under 'max_buffer' bytes. At least one chunk is
+        always fetched, whatever its size."""
+        from drastic.models.chunk_store import ChunkStore
+        session = get_session()
+        chunk_query = prepare(u"""SELECT blob, compressed, codec
+            FROM {keyspace}.data_object WHERE uuid=? AND sequence_number=?""")
+        bucket_query = prepare(u"""SELECT blob, compressed, codec
+            FROM {keyspace}.data_chunk
+            WHERE uuid=? AND bucket=? AND sequence_number=?""")
+        pending = deque()
+        # Size of the largest chunk seen so far, used to estimate the memory
+        # needed by the chunks in flight
+        largest = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max(prefetch, 1):
+                if pending and (not largest or
+                                (len(pending) + 1) * largest > max_buffer):
+                    break
+                try:
+                    key = next(keys)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if key['chunk_hash']:
+                    future = ChunkStore.fetch_async(session, key['chunk_hash'])
+                elif 'bucket' in key:
+                    future = session.execute_async(
+                        bucket_query, (self.uuid, key['bucket'],
+                                       key['sequence_number']))
+                else:
+                    future = session.execute_async(
+                        chunk_query, (self.uuid, key['sequence_number']))
+                pending.append(future)
+            if not pending:
+                break
+            for row in pending.popleft().result():
+                largest = max(largest, len(row['blob'] or ''))
+                yield decode_chunk(row['blob'], row['codec'],
+                                   row.get('compressed'))
+
+
+    def chunk_content(self, prefetch=DEFAULT_READ_PREFETCH,
+                      max_buffer=DEFAULT_READ_BUFFER):
         """
-        Yields the content for the driver's URL, if any
-        a chunk at a time.  The value yielded is the size of
-        the chunk and the content chunk itself.
+        Yields the content of the data object a chunk at a time, in order.
+
+        Up to 'prefetch' chunks are fetched concurrently ahead of the
+        consumer, within a budget of 'max_buffer' bytes.
         """
-        entries = DataObject.objects.filter(uuid=self.uuid)
-        for entry in entries:
-            if entry.blob is None:
-                yield ''
-            if entry.compressed:
-                data = StringIO(entry.blob)
-                z = zipfile.ZipFile(data, 'r')
-                content = z.read("data")
-                data.close()
-                z.close()
-                yield content
-            else:
-                yield entry.blob
+        return self._fetch_chunks(self._chunk_keys(), prefetch, max_buffer)
 
 
     @classmethod
-    def create(cls, data, compressed=False, metadata=None, create_ts=None, acl=None):
+    def create(cls, data, compressed=False, metadata=None, create_ts=None, acl=None,
+               codec=None):
         """data: initial data"""
         new_id = default_cdmi_id()
         now = datetime.now()
+        if codec:
+            data, codec = encode_chunk(data, codec)
+            compressed = codec != CODEC_NONE
         kwargs = {
             "uuid": new_id,
             "sequence_number": 0,
             "blob": data,
             "compressed": compressed,
+            "codec": codec,
             "modified_ts": now
         }
         if metadata:
@@ -143,14 +486,90 @@ class DataObject(Model):
         return new
 
 
+    @classmethod
+    def create_from_stream(cls, fileobj, chunk_size=DEFAULT_CHUNK_SIZE,
+                           window=DEFAULT_WRITE_WINDOW, metadata=None,
+                           mimetype=None, create_ts=None, codec=None,
+                           dedup=None, bucket_size=None):
+        """Create a new data object from the content of a file-like object.
+
+        The content is read in chunks of 'chunk_size' bytes, each chunk is
+        inserted asynchronously with at most 'window' inserts in flight. The
+        size and the checksum are computed as we go and the static columns
+        are written once, after the last chunk.
+
+        Chunks are compressed with 'codec', by default it is chosen from the
+        mimetype and a trial compression of the first chunk.
+
+        If 'dedup' is True the chunks go to the content addressed chunk store,
+        by default CHUNK_DEDUP from the configuration is used. The chunks are
+        spread over partitions of 'bucket_size' chunks if it's set, by
+        default CHUNK_BUCKET_SIZE from the configuration is used."""
+        from drastic.models.chunk_store import ChunkStoreWriter
+        cfg = get_config(None)
+        if dedup is None:
+            dedup = cfg.get('CHUNK_DEDUP', False)
+        if bucket_size is None:
+            bucket_size = cfg.get('CHUNK_BUCKET_SIZE') or None
+        new_id = default_cdmi_id()
+        if dedup:
+            writer = ChunkStoreWriter(new_id, window, bucket_size)
+        else:
+            writer = ChunkWriter(new_id, window, bucket_size)
+        checksum = hashlib.new(CHECKSUM_ALGORITHM)
+        size = 0
+        sequence_number = 0
+        try:
+            data = read_chunk(fileobj, chunk_size)
+            if codec is None:
+                codec = choose_codec(mimetype, data)
+            while True:
+                checksum.update(data)
+                size += len(data)
+                writer.put(sequence_number, data, codec)
+                sequence_number += 1
+                data = read_chunk(fileobj, chunk_size)
+                if not data:
+                    break
+            writer.close()
+        except Exception:
+            # Don't leave a partial object behind. The references taken in the
+            # chunk store are leaked rather than risking to release a
+            # reference which wasn't taken
+            writer.abort()
+            cls.delete_partition(new_id)
+            if bucket_size:
+                cls.delete_buckets(new_id, sequence_number // bucket_size + 1)
+            raise
+
+        session = get_session()
+        now = datetime.now()
+        statics = {
+            "checksum": checksum.hexdigest(),
+            "size": size,
+            "chunk_size": chunk_size,
+            "create_ts": create_ts or now,
+            "modified_ts": now,
+        }
+        if bucket_size:
+            statics['bucket_size'] = bucket_size
+        if metadata:
+            statics['metadata'] = metadata
+        if mimetype:
+            statics['mimetype'] = mimetype
+        # Only set the columns we have, a null value would create a tombstone
+        names = sorted(statics)
+        update = prepare(u"""UPDATE {{keyspace}}.data_object SET {}
+            WHERE uuid=?""".format(", ".join(u"{}=?".format(n) for n in names)))
+        session.execute(update, [statics[n] for n in names] + [new_id])
+        return cls.find(new_id)
+
+
     def create_acl(self, acl_cql):
         """Replace the static acl with the given cql string"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE data_object SET acl = {}
-            WHERE uuid=%s""".format(acl_cql))
+        session = get_session()
+        query = SimpleStatement(u"""UPDATE {}.data_object SET acl = {}
+            WHERE uuid=%s""".format(get_keyspace(), acl_cql))
         session.execute(query, (self.uuid,))
 
 
@@ -168,53 +587,266 @@ class DataObject(Model):
 
     @classmethod
     def delete_id(cls, uuid):
-        """Delete all blobs for the specified uuid"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement("""DELETE FROM data_object WHERE uuid=%s""")
-        session.execute(query, (uuid,))
+        """Delete all blobs for the specified uuid. Chunks in the chunk store
+        are released, they are deleted later by ChunkStore.reclaim"""
+        from drastic.models.chunk_store import ChunkStore
+        obj = cls(uuid=uuid, bucket_size=cls._read_bucket_size(uuid))
+        # While an object is migrated its chunks are in both layouts, only
+        # the current one holds the references
+        if obj.bucket_size:
+            keys = list(obj._bucket_keys())
+        else:
+            keys = list(obj._partition_keys())
+        ChunkStore.release(key['chunk_hash'] for key in keys
+                           if key['chunk_hash'])
+        if obj.bucket_size and keys:
+            cls.delete_buckets(uuid, keys[-1]['bucket'] + 1)
+        cls.delete_partition(uuid)
+
+
+    @classmethod
+    def delete_partition(cls, uuid):
+        """Delete the data_object partition of the specified uuid"""
+        query = prepare(u"""DELETE FROM {keyspace}.data_object WHERE uuid=?""")
+        get_session().execute(query, (uuid,))
+
+
+    @classmethod
+    def delete_buckets(cls, uuid, count, window=DEFAULT_WRITE_WINDOW):
+        """Delete the first 'count' data_chunk partitions of an object"""
+        session = get_session()
+        query = prepare(u"""DELETE FROM {keyspace}.data_chunk
+            WHERE uuid=? AND bucket=?""")
+        futures = deque()
+        for bucket in xrange(count):
+            futures.append(session.execute_async(query, (uuid, bucket)))
+            wait_futures(futures, window)
+        wait_futures(futures)
+
+
+    @classmethod
+    def migrate_to_buckets(cls, uuid, bucket_size,
+                           window=DEFAULT_WRITE_WINDOW):
+        """Copy the chunks stored in the data_object partition of an object
+        to buckets of 'bucket_size' chunks and switch the object to the
+        bucketed layout. Return the number of buckets written, 0 if the
+        object wasn't migrated (already bucketed, still being uploaded,
+        deleted or rewritten during the copy).
+
+        The object stays readable during the copy. The switch is a
+        lightweight transaction on the bucket size and the modification time
+        read before the copy, if it isn't applied the copied chunks are
+        deleted. The old chunks are kept, delete_partition_chunks removes
+        them once the readers which loaded the object before the switch are
+        done."""
+        session = get_session()
+        query = prepare(u"""SELECT bucket_size, modified_ts
+            FROM {keyspace}.data_object WHERE uuid=? LIMIT 1""")
+        rows = list(session.execute(query, (uuid,)))
+        # Objects without a modified_ts are still being uploaded
+        if not rows or rows[0]['bucket_size'] or not rows[0]['modified_ts']:
+            return 0
+        modified_ts = rows[0]['modified_ts']
+        select = prepare(u"""SELECT sequence_number, blob, compressed, codec,
+            chunk_hash FROM {keyspace}.data_object WHERE uuid=?""")
+        insert = insert_chunk_query(bucket_size, ("blob", "compressed",
+                                                  "codec", "chunk_hash"))
+        rows = select.bind((uuid,))
+        # Don't fetch more chunks than we can have in flight
+        rows.fetch_size = max(window, 1)
+        futures = deque()
+        last = 0
+        for row in session.execute(rows):
+            if row['sequence_number'] is None:
+                continue
+            last = row['sequence_number']
+            key = chunk_key(uuid, last, bucket_size)
+            futures.append(session.execute_async(
+                insert, key + (row['blob'], row['compressed'], row['codec'],
+                               row['chunk_hash'])))
+            wait_futures(futures, window)
+        wait_futures(futures)
+        buckets = last // bucket_size + 1
+        if execute_update("data_object", [("uuid", uuid)],
+                          {"bucket_size": bucket_size},
+                          {"bucket_size": None, "modified_ts": modified_ts}):
+            return buckets
+        if not cls._read_bucket_size(uuid):
+            # The object was deleted or rewritten, nothing refers to the copy
+            cls.delete_buckets(uuid, buckets)
+        return 0
+
+
+    @classmethod
+    def delete_partition_chunks(cls, uuid):
+        """Delete the chunks stored in the data_object partition of an
+        object, the static columns are kept"""
+        query = prepare(u"""DELETE FROM {keyspace}.data_object
+            WHERE uuid=? AND sequence_number >= 0""")
+        get_session().execute(query, (uuid,))
+
+
+    @classmethod
+    def migrate_all_to_buckets(cls, bucket_size,
+                               grace=DEFAULT_MIGRATION_GRACE, batch=1000):
+        """Move every object still stored in a single partition to buckets of
+        'bucket_size' chunks, the objects which fit in a single bucket are
+        left as they are. The old chunks of a batch of migrated objects are
+        deleted 'grace' seconds after the first switch of the batch.
+        Return the number of objects migrated"""
+        query = prepare(u"""SELECT DISTINCT uuid, bucket_size, modified_ts,
+            size, chunk_size FROM {keyspace}.data_object""")
+        migrated = 0
+        # (uuid, number of buckets) of the objects switched in the batch
+        pending = []
+        started = None
+
+        def drop_pending():
+            if started is not None:
+                time.sleep(max(0, started + grace - time.time()))
+            for uuid, buckets in pending:
+                if cls._read_bucket_size(uuid):
+                    cls.delete_partition_chunks(uuid)
+                else:
+                    # Deleted by a delete_id which read the layout before
+                    # the switch, only the data_object partition was deleted
+                    cls.delete_buckets(uuid, buckets)
+            del pending[:]
+
+        for row in get_session().execute(query):
+            # Objects without a modified_ts are still being uploaded
+            if row['bucket_size'] or not row['modified_ts']:
+                continue
+            if (row['chunk_size'] and
+                    (row['size'] or 0) <= bucket_size * row['chunk_size']):
+                continue
+            buckets = cls.migrate_to_buckets(row['uuid'], bucket_size)
+            if buckets:
+                if not pending:
+                    started = time.time()
+                pending.append((row['uuid'], buckets))
+                migrated += 1
+            if len(pending) >= batch:
+                drop_pending()
+        drop_pending()
+        return migrated
 
 
     @classmethod
     def find(cls, uuid):
-        """Find an object by uuid"""
-        entries = cls.objects.filter(uuid=uuid)
-        if not entries:
+        """Find an object by uuid. Only the static columns are read, the
+        per-row columns (the blob of the first chunk) are left empty"""
+        query = prepare(u"""SELECT DISTINCT {} FROM {{keyspace}}.data_object
+            WHERE uuid=?""".format(STATIC_COLUMNS))
+        rows = list(get_session().execute(query, (uuid,)))
+        if not rows:
             return None
         else:
-            return entries.first()
+            return cls._construct_instance(rows[0])
+
+
+    @classmethod
+    def find_many(cls, uuids, window=DEFAULT_FIND_WINDOW):
+        """Find several objects, return a dictionary indexed by uuid. Only
+        the static columns are read.
+
+        Small batches are read with a single IN query, larger ones with one
+        query per object, at most 'window' of them in flight."""
+        uuids = list(set(uuids))
+        session = get_session()
+        found = {}
+
+        def collect(future):
+            for row in future.result():
+                found[row['uuid']] = cls._construct_instance(row)
+
+        if len(uuids) <= IN_QUERY_LIMIT:
+            if uuids:
+                query = prepare(u"""SELECT DISTINCT {} FROM {{keyspace}}.data_object
+                    WHERE uuid IN ?""".format(STATIC_COLUMNS))
+                collect(session.execute_async(query, (uuids,)))
+            return found
+        query = prepare(u"""SELECT DISTINCT {} FROM {{keyspace}}.data_object
+            WHERE uuid=?""".format(STATIC_COLUMNS))
+        pending = deque()
+        for uuid in uuids:
+            pending.append(session.execute_async(query, (uuid,)))
+            while len(pending) >= max(window, 1):
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+        return found
+
+
+    def range_content(self, offset, length=None):
+        """Yields the content of the object from 'offset' (and at most 'length'
+        bytes) a chunk at a time.
+
+        When the chunk size of the object is known only the chunks holding the
+        range are read, they are listed with a clustering range query.
+        Otherwise the object is streamed from the beginning."""
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError("Invalid range ({}, {})".format(offset, length))
+        if length == 0:
+            return iter([])
+        if not self.chunk_size:
+            return slice_chunks(self.chunk_content(), offset, length)
+        first, last, skip = chunk_range(offset, length, self.chunk_size)
+        chunks = self._fetch_chunks(self._chunk_keys(first, last),
+                                    DEFAULT_READ_PREFETCH, DEFAULT_READ_BUFFER)
+        return slice_chunks(chunks, skip, length)
+
+
+    def open(self):
+        """Return a file-like object (io.RawIOBase) reading the content of
+        the object"""
+        return DataObjectReader(self)
+
+
+    def read_range(self, offset, length=None):
+        """Return 'length' bytes of content from 'offset' (to the end of the
+        object if length is None). Fewer bytes are returned if the range goes
+        past the end of the object"""
+        return ''.join(self.range_content(offset, length))
+
+
+    def _update(self, values, conditions=None):
+        """Write the columns in 'values' with a single statement, static
+        columns can be set in the same statement as the per-row columns"""
+        keys = [("uuid", self.uuid)]
+        if any(name not in static_fields for name in values):
+            # The instances returned by find() only hold the static columns
+            if self.sequence_number is None:
+                raise ValueError("No sequence number to update the chunk "
+                                 "columns of {}".format(self.uuid))
+            keys.append(("sequence_number", self.sequence_number))
+        applied = execute_update("data_object", keys, values, conditions)
+        if applied:
+            for name, value in values.items():
+                setattr(self, name, value)
+        return applied
 
 
     def update(self, **kwargs):
         """Update a data object"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        for arg in kwargs:
-            # For static fields we can't use the name in the where condition
-            if arg in static_fields:
-                query = SimpleStatement("""UPDATE data_object SET {}=%s
-                    WHERE uuid=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.uuid))
-            else:
-                query = SimpleStatement("""UPDATE data_object SET {}=%s
-                    WHERE uuid=%s and sequence_number=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.uuid, self.sequence_number))
+        if kwargs:
+            self._update(kwargs)
         return self
 
 
+    def update_if(self, conditions, **kwargs):
+        """Update a data object if the current values of the columns in
+        'conditions' match (compare and set). Return True if the update has
+        been applied"""
+        return self._update(kwargs, conditions)
+
+
     def update_acl(self, acl_cql):
         """Update the static acl with the given cql string
         """
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE data_object SET acl = acl + {}
-            WHERE uuid=%s""".format(acl_cql))
+        session = get_session()
+        query = SimpleStatement(u"""UPDATE {}.data_object SET acl = acl + {}
+            WHERE uuid=%s""".format(get_keyspace(), acl_cql))
         session.execute(query, (self.uuid,))
 
 
@@ -0,0 +1,24 @@
+"""Subtree Delete Model
+
+Progress of the subtree delete jobs (see drastic.subtree_delete).
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from datetime import datetime
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+
+
+class DeleteFrontier(Model):
+    """A collection found by a subtree delete job. It's recorded before the
+    partition of its parent is deleted, so an interrupted job can find the
+    collections it still has to delete"""
+    # The path of the root of the subtree being deleted
+    job = columns.Text(partition_key=True)
+    path = columns.Text(primary_key=True)
+    # True when the partition of the collection has been deleted
+    done = columns.Boolean(default=False)
+    updated_ts = columns.DateTime(default=datetime.now)
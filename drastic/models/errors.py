@@ -106,3 +106,37 @@ class UndiagnosedModelError(ModelError):
 class UniqueError(BaseError):
     """Uniqueness error"""
     pass
+
+
+class NoSuchUploadError(ModelError):
+    """No such upload session Exception"""
+
+    def __str__(self):
+        return "Upload '{}' does not exist".format(self.obj_str)
+
+
+class UploadClosedError(ModelError):
+    """Upload session already finalized or aborted Exception"""
+
+    def __str__(self):
+        return "Upload '{}' doesn't accept parts anymore".format(self.obj_str)
+
+
+class IncompleteUploadError(ModelError):
+    """Upload session finalized with missing parts Exception"""
+
+    def __init__(self, obj_str, missing):
+        self.obj_str = obj_str
+        # Sequence numbers of the missing parts
+        self.missing = missing
+
+    def __str__(self):
+        return "Upload '{}' is missing parts {}".format(self.obj_str,
+                                                        self.missing)
+
+
+class InvalidMoveError(ModelError):
+    """Move of a collection inside itself Exception"""
+
+    def __str__(self):
+        return "Cannot move '{}' inside itself".format(self.obj_str)
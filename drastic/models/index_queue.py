@@ -0,0 +1,185 @@
+"""Index Queue Model
+
+Outbox of the objects whose terms have to be indexed, processed in the
+background by drastic.indexer so the creation and the update of resources
+and collections don't wait for the search index.
+
+The queue is split in INDEX_QUEUE_BUCKETS buckets, a path always goes to the
+same one so it's only indexed by one worker at a time. Each bucket is
+partitioned by windows of QUEUE_WINDOW seconds, the entries are ordered by
+the time they were queued. An entry only records the path, the worker
+indexes the current state of the object, so an entry processed twice or
+several entries for the same object don't change the result.
+
+The entries aren't deleted one by one: the indexer records how far it has
+read each bucket in index_checkpoint, reads the entries after this point
+only, and deletes the partition of a window once it's done with it. The
+reads never go through the tombstones of the processed entries.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import logging
+import threading
+import time
+import zlib
+
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+from cassandra.util import uuid_from_time
+
+from drastic import get_config
+from drastic.models.cql import (
+    get_session,
+    prepare,
+)
+
+
+DEFAULT_BUCKETS = 16
+# Number of seconds of entries in a partition of a bucket
+QUEUE_WINDOW = 600
+# Minimum number of seconds between two reads of the lag by a process
+LAG_CHECK_INTERVAL = 10
+
+# Last lag read by this process, see current_lag
+_lag_lock = threading.Lock()
+_lag = {"value": None, "checked": 0.0}
+
+
+def queue_buckets():
+    """Return the number of buckets of the queue"""
+    return max(get_config(None).get('INDEX_QUEUE_BUCKETS', DEFAULT_BUCKETS), 1)
+
+
+def queue_bucket(path, buckets):
+    """Return the bucket of the queue of a path"""
+    return (zlib.crc32(path.encode('utf-8')) & 0xffffffff) % buckets
+
+
+def queue_window(timestamp):
+    """Return the window of the queue of a time in seconds"""
+    return int(timestamp // QUEUE_WINDOW)
+
+
+def current_lag():
+    """Return the lag of the queue in seconds (see IndexQueue.lag), read
+    again at most every LAG_CHECK_INTERVAL seconds. The last value is kept
+    if it can't be read"""
+    with _lag_lock:
+        if time.time() - _lag['checked'] < LAG_CHECK_INTERVAL:
+            return _lag['value']
+        _lag['checked'] = time.time()
+    try:
+        value = IndexQueue.lag()
+    except Exception:
+        logging.warning(u"Problem while reading the lag of the index queue",
+                        exc_info=True)
+        with _lag_lock:
+            return _lag['value']
+    with _lag_lock:
+        _lag['value'] = value
+    return value
+
+
+def queue_index(obj):
+    """Index a resource or a collection in the background.
+
+    The object is indexed at once if INDEX_ASYNC isn't set, or if the
+    indexer is more than INDEX_MAX_LAG seconds behind (or has never run):
+    the writes are slowed down until it catches up."""
+    cfg = get_config(None)
+    if not cfg.get('INDEX_ASYNC', True):
+        obj.index()
+        return
+    max_lag = cfg.get('INDEX_MAX_LAG', 0)
+    if max_lag:
+        lag = current_lag()
+        if lag is None or lag > max_lag:
+            obj.index()
+            return
+    IndexQueue.enqueue(obj.path, obj.__class__.__name__)
+
+
+class IndexQueue(Model):
+    """An object to index"""
+    bucket = columns.Integer(partition_key=True)
+    window = columns.Integer(partition_key=True)
+    queued = columns.TimeUUID(primary_key=True)
+    object_path = columns.Text()
+    # Resource or Collection
+    object_type = columns.Text()
+
+    @classmethod
+    def enqueue(cls, object_path, object_type):
+        """Add an object to the queue"""
+        query = prepare(u"""INSERT INTO {keyspace}.index_queue
+            (bucket, window, queued, object_path, object_type)
+            VALUES (?, ?, ?, ?, ?)""")
+        now = time.time()
+        get_session().execute(query, (queue_bucket(object_path,
+                                                   queue_buckets()),
+                                      queue_window(now),
+                                      uuid_from_time(now),
+                                      object_path, object_type))
+
+    @classmethod
+    def read(cls, bucket, window, after, before, limit=100):
+        """Return the oldest entries of a window of a bucket which were
+        queued after the entry 'after' (if it's set) and before the timeuuid
+        'before'"""
+        if after is None:
+            query = prepare(u"""SELECT queued, object_path, object_type
+                FROM {keyspace}.index_queue WHERE bucket=? AND window=?
+                AND queued < ? LIMIT ?""")
+            values = (bucket, window, before, limit)
+        else:
+            query = prepare(u"""SELECT queued, object_path, object_type
+                FROM {keyspace}.index_queue WHERE bucket=? AND window=?
+                AND queued > ? AND queued < ? LIMIT ?""")
+            values = (bucket, window, after, before, limit)
+        return list(get_session().execute(query, values))
+
+    @classmethod
+    def drop(cls, bucket, window):
+        """Delete a window of a bucket which has been processed"""
+        query = prepare(u"""DELETE FROM {keyspace}.index_queue
+            WHERE bucket=? AND window=?""")
+        get_session().execute(query, (bucket, window))
+
+    @classmethod
+    def lag(cls):
+        """Return the number of seconds since the oldest time up to which
+        the indexer has processed a bucket, None if the indexer hasn't
+        processed all the buckets yet"""
+        checkpoints = IndexCheckpoint.read_all()
+        if len(checkpoints) < queue_buckets():
+            return None
+        oldest = min(checkpoint['updated'] or 0
+                     for checkpoint in checkpoints.itervalues())
+        return max(time.time() - oldest, 0.0)
+
+
+class IndexCheckpoint(Model):
+    """Progress of the indexer in a bucket of the queue"""
+    bucket = columns.Integer(partition_key=True)
+    # The window being read and the last entry processed in it
+    window = columns.Integer()
+    queued = columns.TimeUUID()
+    # Time in seconds up to which all the entries have been processed
+    updated = columns.Double()
+
+    @classmethod
+    def read_all(cls):
+        """Return the checkpoints of all the buckets in a dictionary"""
+        query = prepare(u"""SELECT bucket, window, queued, updated
+            FROM {keyspace}.index_checkpoint""")
+        return dict((row['bucket'], row)
+                    for row in get_session().execute(query))
+
+    @classmethod
+    def save(cls, bucket, window, queued, updated):
+        query = prepare(u"""INSERT INTO {keyspace}.index_checkpoint
+            (bucket, window, queued, updated) VALUES (?, ?, ?, ?)""")
+        get_session().execute(query, (bucket, window, queued, updated))
@@ -118,6 +118,19 @@ TEMPLATES[OP_UPDATE][OBJ_GROUP] = """
 <span class="activity-timespan">{{ when|date:"M d, Y - P" }}</span>
 """
 
+TEMPLATES[OP_MOVE][OBJ_RESOURCE] = """
+{% load gravatar %}
+{% gravatar user.email 40 %}
+<span class="activity-message">{{ user.name }} moved the item '<a href='{% url "archive:resource_view" path=object.path %}'>{{ object.name }}</a>'</span>
+<span class="activity-timespan">{{ when|date:"M d, Y - P" }}</span>
+"""
+TEMPLATES[OP_MOVE][OBJ_COLLECTION] = """
+{% load gravatar %}
+{% gravatar user.email 40 %}
+<span class="activity-message">{{ user.name }} moved the collection '<a href='{% url "archive:view" path=object.path %}'>{{ object.name }}</a>'</span>
+<span class="activity-timespan">{{ when|date:"M d, Y - P" }}</span>
+"""
+
 
 class Notification(Model):
     """Notification Model"""
@@ -250,6 +263,34 @@ class Notification(Model):
         cls.mqtt_publish(new, OP_DELETE, OBJ_USER, uuid, payload)
         return new
 
+    @classmethod
+    def move_collection(cls, username, path, uuid, payload):
+        """Move a collection and publish the message on MQTT, 'path' is the
+        new path, the previous one is in the payload"""
+        new = cls.new(operation=OP_MOVE,
+                      object_type=OBJ_COLLECTION,
+                      object_uuid=uuid,
+                      object_path=path,
+                      username=username,
+                      processed=True,
+                      payload=payload)
+        cls.mqtt_publish(new, OP_MOVE, OBJ_COLLECTION, uuid, payload, path=path)
+        return new
+
+    @classmethod
+    def move_resource(cls, username, path, uuid, payload):
+        """Move a resource and publish the message on MQTT, 'path' is the
+        new path, the previous one is in the payload"""
+        new = cls.new(operation=OP_MOVE,
+                      object_type=OBJ_RESOURCE,
+                      object_uuid=uuid,
+                      object_path=path,
+                      username=username,
+                      processed=True,
+                      payload=payload)
+        cls.mqtt_publish(new, OP_MOVE, OBJ_RESOURCE, uuid, payload, path=path)
+        return new
+
     def tmpl(self):
         return TEMPLATES[self.operation][self.object_type]
 
@@ -263,6 +304,15 @@ class Notification(Model):
         # script is set to run on such a collection name. But that's what you get if you use stupid names for things.
         topic = topic.replace('#', '').replace('+', '')
         logging.info(u'Publishing on topic "{0}"'.format(topic))
+        if path and object_type in (OBJ_COLLECTION, OBJ_RESOURCE):
+            from drastic.models.tree_cache import (
+                invalidate_moved,
+                tree_cache,
+            )
+            tree_cache.invalidate_path(path, object_type == OBJ_COLLECTION,
+                                       operation != OP_UPDATE)
+            if operation == OP_MOVE:
+                invalidate_moved(payload, object_type == OBJ_COLLECTION)
         try:
             publish.single(topic, payload)
         except Exception as e:
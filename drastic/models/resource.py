@@ -11,11 +11,16 @@ from drastic.models import (
     DataObject,
     TreeEntry
 )
+from drastic.models.collection_stats import CollectionStats
+from drastic.models.index_queue import queue_index
 from drastic.models.acl import (
+    ALL_ACTIONS,
     acemask_to_str,
+    acl_to_actions,
     serialize_acl_metadata
 )
 from drastic.models.errors import (
+    CollectionConflictError,
     NoSuchCollectionError,
     ResourceConflictError
 )
@@ -54,19 +59,61 @@ class Resource(object):
         self.uuid = self.entry.uuid
         if not self.is_reference:
             self.obj_id = self.url.replace("cassandra://", "")
-            self.obj = DataObject.find(self.obj_id)
-        else:
-            self.obj = None
+        # The data object is read the first time it's needed
+        self._obj = obj
+        self._obj_loaded = obj is not None or self.is_reference
+
+
+    @property
+    def obj(self):
+        """The data object of the resource, None for a reference"""
+        if not self._obj_loaded:
+            self._obj = DataObject.find(self.obj_id)
+            self._obj_loaded = True
+        return self._obj
+
+
+    @obj.setter
+    def obj(self, value):
+        self._obj = value
+        self._obj_loaded = True
 
 
     def __unicode__(self):
         return self.path
 
 
-    def chunk_content(self):
-        """Get a chunk of the data object"""
+    def chunk_content(self, **kwargs):
+        """Get a chunk of the data object, see DataObject.chunk_content for
+        the prefetch options"""
+        if self.obj:
+            return self.obj.chunk_content(**kwargs)
+        else:
+            return None
+
+
+    def open(self):
+        """Return a file-like object reading the content of the data object,
+        see DataObject.open"""
+        if self.obj:
+            return self.obj.open()
+        else:
+            return None
+
+
+    def range_content(self, offset, length=None):
+        """Get the content of the data object between offset and
+        offset + length, a chunk at a time"""
+        if self.obj:
+            return self.obj.range_content(offset, length)
+        else:
+            return None
+
+
+    def read_range(self, offset, length=None):
+        """Read a range of bytes of the data object"""
         if self.obj:
-            return self.obj.chunk_content()
+            return self.obj.read_range(offset, length)
         else:
             return None
 
@@ -100,6 +147,7 @@ class Resource(object):
             "url": url,
             "uuid": uuid,
         }
+        data_obj = None
         if is_reference(url):
             kwargs["create_ts"] = create_ts
             kwargs["modified_ts"] = modified_ts
@@ -109,22 +157,23 @@ class Resource(object):
         else:
             obj_id = url.replace("cassandra://", "")
             data_obj = DataObject.find(obj_id)
+            values = {}
             if metadata:
-                data_obj.update(mimetype=mimetype,
-                                metadata=metadata)
-            else:
-                if mimetype:
-                    data_obj.update(mimetype=mimetype)
-                if size:
-                    data_obj.update(size=size)
+                values['metadata'] = metadata
+            if mimetype:
+                values['mimetype'] = mimetype
+            if size:
+                values['size'] = size
+            data_obj.update(**values)
 
         data_entry = TreeEntry.create(**kwargs)
-        new = Resource(data_entry)
+        new = Resource(data_entry, data_obj)
+        CollectionStats.add(container, 1, 1, new.get_size())
         state = new.mqtt_get_state()
         payload = new.mqtt_payload({}, state)
         Notification.create_resource(username, path, new.uuid, payload)
         # Index the resource
-        new.index()
+        queue_index(new)
         return new
 
 
@@ -148,14 +197,32 @@ class Resource(object):
         """Delete the resource in the tree_entry table and all the corresponding
         blobs"""
         from drastic.models import Notification
+        size = self.get_size()
         self.delete_blobs()
         self.entry.delete()
+        CollectionStats.add(self.container, -1, -1, -size)
         state = self.mqtt_get_state()
         payload = self.mqtt_payload(state, {})
         Notification.delete_resource(username, self.path, self.uuid, payload)
         self.reset()
 
 
+    @classmethod
+    def load_many(cls, entries):
+        """Return the resources of a list of tree entries, the data objects
+        are read together (see DataObject.find_many)"""
+        obj_ids = [entry.url.replace("cassandra://", "") for entry in entries
+                   if not is_reference(entry.url)]
+        objects = DataObject.find_many(obj_ids)
+        resources = []
+        for entry in entries:
+            obj = None
+            if not is_reference(entry.url):
+                obj = objects.get(entry.url.replace("cassandra://", ""))
+            resources.append(cls(entry, obj))
+        return resources
+
+
     def delete_blobs(self):
         """Delete all blobs of the corresponding uuid"""
         if not self.is_reference:
@@ -166,11 +233,11 @@ class Resource(object):
     def find(cls, path):
         """Return a resource from a path"""
         coll_name, resc_name = split(path)
-        entries = TreeEntry.objects.filter(container=coll_name, name=resc_name)
-        if not entries:
+        entry = TreeEntry.find(coll_name, resc_name)
+        if entry is None:
             return None
         else:
-            return cls(entries.first())
+            return cls(entry)
 
 
     def full_dict(self, user=None):
@@ -193,10 +260,11 @@ class Resource(object):
             data["checksum"] = self.get_checksum()
             data["size"] = self.get_size()
         if user:
-            data['can_read'] = self.user_can(user, "read")
-            data['can_write'] = self.user_can(user, "write")
-            data['can_edit'] = self.user_can(user, "edit")
-            data['can_delete'] = self.user_can(user, "delete")
+            actions = self.user_actions(user)
+            data['can_read'] = "read" in actions
+            data['can_write'] = "write" in actions
+            data['can_edit'] = "edit" in actions
+            data['can_delete'] = "delete" in actions
         return data
 
 
@@ -204,10 +272,8 @@ class Resource(object):
         if self.is_reference:
             return self.entry.acl
         else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.acl
+            if self.obj is None:
+                return self.entry.acl
             return self.obj.acl
 
 
@@ -218,30 +284,15 @@ class Resource(object):
 
     def get_authorized_actions(self, user):
         """"Get available actions for user according to a group"""
-        # Check permission on the parent container if there's no action
-        # defined at this level
+        # Use the ACL of the parent container if there's no action defined
+        # at this level
         acl = self.get_acl()
         if not acl:
-            from drastic.models import Collection
-            parent_container = Collection.find(self.container)
-            return parent_container.get_authorized_actions(user)
-        actions = set([])
-        for gid in user.groups:
-            if gid in acl:
-                ace = acl[gid]
-                level = acemask_to_str(ace.acemask, True)
-                if level == "read":
-                    actions.add("read")
-                elif level == "write":
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-                elif level == "read/write":
-                    actions.add("read")
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-        return actions
+            from drastic.models.collection import effective_acl
+            acl = effective_acl(self.container)
+            return acl_to_actions(acl, user.groups + ["AUTHENTICATED@"],
+                                  False)
+        return acl_to_actions(acl, user.groups, True)
 
 
     def get_cdmi_metadata(self):
@@ -254,10 +305,8 @@ class Resource(object):
         if self.is_reference:
             return None
         else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return None
+            if self.obj is None:
+                return None
             return self.obj.checksum
 
 
@@ -265,10 +314,8 @@ class Resource(object):
         if self.is_reference:
             return self.entry.create_ts
         else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.create_ts
+            if self.obj is None:
+                return self.entry.create_ts
             return self.obj.create_ts
 
 
@@ -281,10 +328,8 @@ class Resource(object):
         if self.is_reference:
             return self.entry.metadata
         else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.metadata
+            if self.obj is None:
+                return self.entry.metadata
             return self.obj.metadata
 
 
@@ -302,10 +347,8 @@ class Resource(object):
         if self.is_reference:
             return self.entry.mimetype
         else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.mimetype
+            if self.obj is None:
+                return self.entry.mimetype
             return self.obj.mimetype
 
 
@@ -313,10 +356,8 @@ class Resource(object):
         if self.is_reference:
             return self.entry.modified_ts
         else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.modified_ts
+            if self.obj is None:
+                return self.entry.modified_ts
             return self.obj.modified_ts
 
 
@@ -339,19 +380,55 @@ class Resource(object):
         if self.is_reference:
             return 0
         else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return 0
+            if self.obj is None:
+                return 0
             return self.obj.size
 
 
     def index(self):
+        """Index the name and the metadata, only the terms which changed are
+        written"""
         from drastic.models import SearchIndex
-        self.reset()
         SearchIndex.index(self, ['name', 'metadata'])
 
 
+    def move(self, path, username=None):
+        """Move or rename the resource, return the resource at its new path.
+        Only the tree_entry row is rewritten, the url still points to the
+        same data object"""
+        from drastic.models import (
+            Collection,
+            Notification,
+            SearchIndex,
+        )
+        container, name = split(path)
+        if Collection.find(container) is None:
+            raise NoSuchCollectionError(container)
+        if Collection.find(path) is not None:
+            raise CollectionConflictError(path)
+        if Resource.find(path) is not None:
+            raise ResourceConflictError(path)
+        pre_state = self.mqtt_get_state()
+        pre_state['path'] = self.path
+        entry = self.entry.move(container, name)
+        new = Resource(entry, self._obj if self._obj_loaded else None)
+        if container != self.container:
+            size = self.get_size()
+            CollectionStats.add(self.container, -1, -1, -size)
+            CollectionStats.add(container, 1, 1, size)
+        if name == self.name:
+            SearchIndex.move_many([(self.path, new.path, 'Resource')])
+        else:
+            # The terms of the name have changed
+            self.reset()
+            queue_index(new)
+        post_state = new.mqtt_get_state()
+        post_state['path'] = new.path
+        payload = new.mqtt_payload(pre_state, post_state)
+        Notification.move_resource(username, new.path, new.uuid, payload)
+        return new
+
+
     def mqtt_get_state(self):
         """Get the resource state for the payload"""
         payload = dict()
@@ -409,10 +486,11 @@ class Resource(object):
             "type": self.get_mimetype(),
         }
         if user:
-            data['can_read'] = self.user_can(user, "read")
-            data['can_write'] = self.user_can(user, "write")
-            data['can_edit'] = self.user_can(user, "edit")
-            data['can_delete'] = self.user_can(user, "delete")
+            actions = self.user_actions(user)
+            data['can_read'] = "read" in actions
+            data['can_write'] = "write" in actions
+            data['can_edit'] = "edit" in actions
+            data['can_delete'] = "delete" in actions
         return data
 
 
@@ -424,6 +502,7 @@ class Resource(object):
         """Update a resource"""
         from drastic.models import Notification
         pre_state = self.mqtt_get_state()
+        pre_size = self.get_size()
         kwargs['modified_ts'] = datetime.now()
         # print kwargs
 
@@ -446,17 +525,26 @@ class Resource(object):
             if 'url' in kwargs:
                 self.entry.update(url=kwargs['url'])
                 del kwargs['url']
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
             self.obj.update(**kwargs)
 
-        resc = Resource.find(self.path)
+        # The entry and the data object are updated in place, if the url
+        # changed we need to reload the resource
+        if self.entry.url != self.url:
+            resc = Resource(self.entry)
+        else:
+            resc = self
+        size = resc.get_size()
+        if size != pre_size:
+            CollectionStats.add(self.container, 0, 0, (size or 0) - (pre_size or 0))
         post_state = resc.mqtt_get_state()
         payload = resc.mqtt_payload(pre_state, post_state)
         Notification.update_resource(username, resc.path, resc.uuid, payload)
 
-        # Index the resource
-        resc.index()
+        # Index the resource, the terms only depend on the name and the
+        # metadata
+        if (post_state['name'] != pre_state['name'] or
+                post_state['metadata'] != pre_state['metadata']):
+            queue_index(resc)
 
 
     def update_acl_cdmi(self, cdmi_acl):
@@ -477,15 +565,18 @@ class Resource(object):
                 self.obj.update_acl_cdmi(read_access, write_access)
 
 
+    def user_actions(self, user):
+        """Return the set of actions the user can perform, the ACL are only
+        checked once"""
+        if user.administrator:
+            # An administrator can do anything
+            return ALL_ACTIONS
+        return self.get_authorized_actions(user)
+
+
     def user_can(self, user, action):
         """
         User can perform the action if any of the user's group IDs
         appear in this list for 'action'_access in this object.
         """
-        if user.administrator:
-            # An administrator can do anything
-            return True
-        actions = self.get_authorized_actions(user)
-        if action in actions:
-            return True
-        return False
+        return action in self.user_actions(user)
@@ -0,0 +1,50 @@
+"""Scrubber Models
+
+Checkpoints and results of the integrity scrubber (see drastic.scrub).
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from datetime import datetime
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+
+
+class ScrubCheckpoint(Model):
+    """Progress of a scrub job in each of its token range segments"""
+    # The name of the scrub job
+    name = columns.Text(partition_key=True)
+    segment = columns.Integer(primary_key=True)
+    # The last data object verified in the segment
+    last_uuid = columns.Text()
+    done = columns.Boolean(default=False)
+    updated_ts = columns.DateTime(default=datetime.now)
+
+
+class ScrubMismatch(Model):
+    """A data object whose content doesn't match its checksum or its size"""
+    uuid = columns.Text(partition_key=True)
+    when = columns.DateTime(primary_key=True, default=datetime.now,
+                            clustering_order="DESC")
+    treepath = columns.Text()
+    expected_checksum = columns.Text()
+    computed_checksum = columns.Text()
+    expected_size = columns.BigInt()
+    computed_size = columns.BigInt()
+    # Set if the content couldn't be read at all
+    error = columns.Text()
+
+    def to_dict(self):
+        """Return a dictionary which describes a mismatch"""
+        return {
+            'uuid': self.uuid,
+            'when': self.when,
+            'treepath': self.treepath,
+            'expected_checksum': self.expected_checksum,
+            'computed_checksum': self.computed_checksum,
+            'expected_size': self.expected_size,
+            'computed_size': self.computed_size,
+            'error': self.error,
+        }
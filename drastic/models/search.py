@@ -9,6 +9,13 @@ provides a simple index (and very, very simple retrieval algorithm) for
 matching words with resources and collections.  It does *not* search the
 data itself.
 
+SearchIndex.query evaluates boolean queries (see
+drastic.models.search_query): the posting lists of the terms are read from
+the rarest to the most frequent (see TermStats) and intersected, once the
+candidates are few their remaining terms and phrases are checked in the
+idsearch table instead. The wildcards are expanded to the matching terms
+with SearchGram.
+
 """
 __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
@@ -16,11 +23,279 @@ __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 from cassandra.cqlengine import columns
 from cassandra.cqlengine.models import Model
+from cassandra.query import (
+    BatchStatement,
+    BatchType,
+)
+from collections import deque
+import base64
+import heapq
+import json
 import logging
 
+from drastic.models.cql import (
+    get_session,
+    prepare,
+    wait_futures,
+)
+from drastic.models.search_query import (
+    AND,
+    NOT,
+    OR,
+    PHRASE,
+    TERM,
+    WILDCARD,
+    normalize,
+    parse_query,
+    query_terms,
+)
+from drastic.models.search_gram import (
+    SearchGram,
+    ngram_settings,
+)
+from drastic.models.term_stats import TermStats
 from drastic.util import default_uuid
 
 
+# Number of concurrent deletions when the index of several objects is reset
+RESET_WINDOW = 32
+# Number of idsearch rows of an object written in a batch
+ID_BATCH = 100
+# Maximum length of an indexed term. A term is a partition key of
+# search_index and term_stats, the longer values (free text) aren't indexed
+# whole and a phrase can only be found in the shorter ones
+MAX_TERM_LENGTH = 256
+# Number of results returned by SearchIndex.find
+DEFAULT_SEARCH_LIMIT = 100
+# Number of index rows fetched per page when the hits are counted
+HITS_FETCH_SIZE = 5000
+# Number of candidates of a query below which the remaining terms are
+# checked for each candidate rather than read in the index
+VERIFY_LIMIT = 500
+# Number of concurrent reads of the terms of the candidates, or of the
+# partitions of the terms a wildcard expands to
+VERIFY_WINDOW = 32
+
+
+def encode_search_cursor(count, path):
+    """Return the opaque cursor of the results following the object at
+    'path' with 'count' hits"""
+    value = json.dumps([count, path])
+    return base64.urlsafe_b64encode(value.encode('utf-8'))
+
+
+def decode_search_cursor(cursor):
+    """Return the (count, path) of a cursor, raise ValueError if it isn't
+    valid"""
+    try:
+        count, path = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError(u"Invalid cursor {}".format(cursor))
+    if not isinstance(count, int):
+        raise ValueError(u"Invalid cursor {}".format(cursor))
+    return count, path
+
+
+def rank(hits, after=None):
+    """Generate (count, path, object type) for the objects of a dictionary
+    of hit counts (see SearchIndex.count_hits), by decreasing count then by
+    path. Only the objects ranked after 'after', a (count, path) pair, are
+    generated. A heap is used so the objects only need to be sorted as far
+    as they are consumed"""
+    heap = []
+    for (path, object_type), count in hits.iteritems():
+        if after is not None and (-count, path) <= (-after[0], after[1]):
+            continue
+        heap.append((-count, path, object_type))
+    heapq.heapify(heap)
+    while heap:
+        count, path, object_type = heapq.heappop(heap)
+        yield -count, path, object_type
+
+
+def intersect(hits, other):
+    """Return the objects of two dictionaries of hit counts which are in
+    both, with the sum of their counts"""
+    if len(other) < len(hits):
+        hits, other = other, hits
+    return dict((key, count + other[key])
+                for key, count in hits.iteritems() if key in other)
+
+
+class QueryEvaluator(object):
+    """Compute the hit counts of the objects matching a parsed query.
+
+    The terms of an AND are read from the rarest to the most frequent and
+    the lists intersected, until the candidates are fewer than
+    'verify_limit' or than the rows of the next term. The terms of each
+    candidate are then read in the idsearch table to check the remaining
+    terms, the excluded terms and the phrases."""
+
+    def __init__(self, verify_limit=VERIFY_LIMIT):
+        self.verify_limit = verify_limit
+        self.session = get_session()
+        self.postings_query = prepare(u"""SELECT object_path, object_type
+            FROM {keyspace}.search_index WHERE term=?""")
+        self.terms_query = prepare(u"""SELECT term FROM {keyspace}.idsearch
+            WHERE object_path=?""")
+        self.frequencies = {}
+        # Terms of the candidates read in the idsearch table, by path
+        self.object_terms = {}
+        # Number of rows read, for the logs and the tests
+        self.rows_read = 0
+
+    def evaluate(self, node):
+        """Return the hit counts of the objects matching a query, in a
+        dictionary indexed by (object_path, object_type)"""
+        self.frequencies = TermStats.get_many(query_terms(node))
+        return self.match(node)
+
+    def match(self, node):
+        kind = node[0]
+        if kind == TERM:
+            return self.read_postings(node[1])
+        if kind == WILDCARD:
+            return self.read_postings_many(SearchGram.expand(node[1]))
+        if kind == OR:
+            hits = {}
+            for child in node[1]:
+                for key, count in self.match(child).iteritems():
+                    hits[key] = hits.get(key, 0) + count
+            return hits
+        if kind in (AND, PHRASE):
+            return self.match_all(node)
+        raise ValueError(u"NOT has to be combined with other terms by AND")
+
+    def match_all(self, node):
+        """Return the hits of an AND or of a phrase"""
+        terms = set()
+        phrases = []
+        others = []
+        excluded_terms = []
+        excluded = []
+        children = [node] if node[0] == PHRASE else node[1]
+        for child in children:
+            kind = child[0]
+            if kind == TERM:
+                terms.add(child[1])
+            elif kind == PHRASE:
+                terms.update(child[1])
+                phrases.append(child[2])
+            elif kind == NOT and child[1][0] == TERM:
+                excluded_terms.append(child[1][1])
+            elif kind == NOT:
+                excluded.append(child[1])
+            else:
+                others.append(child)
+        terms = sorted(terms, key=lambda t: self.frequencies.get(t, 0))
+        hits = None
+        for child in others:
+            found = self.match(child)
+            hits = found if hits is None else intersect(hits, found)
+            if not hits:
+                return {}
+        while terms and (hits is None or
+                         len(hits) > self.verify_limit or
+                         self.frequencies.get(terms[0], 0) < len(hits)):
+            found = self.read_postings(terms.pop(0))
+            hits = found if hits is None else intersect(hits, found)
+            if not hits:
+                return {}
+        for child in excluded:
+            for key in self.match(child):
+                hits.pop(key, None)
+        # An excluded term is read in the index too when it's cheaper than
+        # checking each candidate
+        for term in list(excluded_terms):
+            if (len(hits) > self.verify_limit or
+                    self.frequencies.get(term, 0) < len(hits)):
+                for key in self.read_postings(term):
+                    hits.pop(key, None)
+                excluded_terms.remove(term)
+        if terms or excluded_terms or phrases:
+            hits = self.verify(hits, terms, excluded_terms, phrases)
+        return hits
+
+    def read_postings(self, term):
+        """Return the hits of a single term"""
+        bound = self.postings_query.bind((term,))
+        bound.fetch_size = HITS_FETCH_SIZE
+        hits = {}
+        for row in self.session.execute(bound):
+            key = (row['object_path'], row['object_type'])
+            hits[key] = hits.get(key, 0) + 1
+            self.rows_read += 1
+        return hits
+
+    def read_postings_many(self, terms):
+        """Return the hits of any of several terms, their counts added. The
+        partitions of the terms are read concurrently"""
+        pending = deque()
+        hits = {}
+
+        def collect():
+            for row in pending.popleft().result():
+                key = (row['object_path'], row['object_type'])
+                hits[key] = hits.get(key, 0) + 1
+                self.rows_read += 1
+
+        for term in terms:
+            bound = self.postings_query.bind((term,))
+            bound.fetch_size = HITS_FETCH_SIZE
+            pending.append(self.session.execute_async(bound))
+            if len(pending) >= VERIFY_WINDOW:
+                collect()
+        while pending:
+            collect()
+        return hits
+
+    def read_object_terms(self, paths):
+        """Read the terms of several objects in the idsearch table, they're
+        kept in self.object_terms"""
+        pending = deque()
+
+        def collect():
+            path, future = pending.popleft()
+            terms = [row['term'] for row in future.result()]
+            self.rows_read += len(terms)
+            self.object_terms[path] = terms
+
+        for path in paths:
+            if path in self.object_terms:
+                continue
+            pending.append((path, self.session.execute_async(
+                self.terms_query, (path,))))
+            if len(pending) >= VERIFY_WINDOW:
+                collect()
+        while pending:
+            collect()
+
+    def verify(self, hits, terms, excluded_terms, phrases):
+        """Keep the candidates which have all the terms, none of the
+        excluded terms and a field value containing each phrase. The hits of
+        the terms are added to their counts"""
+        self.read_object_terms([path for path, _ in hits])
+        result = {}
+        for key, count in hits.iteritems():
+            object_terms = self.object_terms.get(key[0], [])
+            counts = {}
+            for term in object_terms:
+                counts[term] = counts.get(term, 0) + 1
+            if not all(term in counts for term in terms):
+                continue
+            if any(term in counts for term in excluded_terms):
+                continue
+            if phrases:
+                values = [u" {} ".format(normalize(term))
+                          for term in object_terms]
+                if not all(any(u" {} ".format(phrase) in value
+                               for value in values)
+                           for phrase in phrases):
+                    continue
+            result[key] = count + sum(counts[term] for term in terms)
+        return result
+
+
 class SearchIndex(Model):
     """SearchIndex Model"""
     term = columns.Text(required=True, primary_key=True)
@@ -42,64 +317,97 @@ class SearchIndex(Model):
         return idx
 
     @classmethod
-    def find(cls, termstrings, user):
-        from drastic.models.collection import Collection
-        from drastic.models.resource import Resource
-
-        def get_object(obj, user):
-            """Return the object corresponding to the SearchIndex object"""
-            if obj.object_type == 'Collection':
-                result_obj = Collection.find(obj.object_path)
-                if not result_obj or not result_obj.user_can(user, "read"):
-                    return None
-                result_obj = result_obj.to_dict(user)
-                result_obj['result_type'] = 'Collection'
-                return result_obj
-            elif obj.object_type == 'Resource':
-                result_obj = Resource.find(obj.object_path)
-                # Check the resource's collection for read permission
-                if not result_obj or not result_obj.user_can(user, "read"):
-                    return None
-                result_obj = result_obj.to_dict(user)
-                result_obj['result_type'] = 'Resource'
-                return result_obj
-            return None
-
-        result_objects = []
-        for t in termstrings:
-            if cls.is_stop_word(t):
+    def count_hits(cls, termstrings):
+        """Return the number of index rows matching the terms for each
+        object, in a dictionary indexed by (object_path, object_type). The
+        partitions of the terms are read concurrently"""
+        session = get_session()
+        query = prepare(u"""SELECT object_path, object_type
+            FROM {keyspace}.search_index WHERE term=?""")
+        futures = []
+        for term in set(termstrings):
+            if cls.is_stop_word(term):
                 continue
-            result_objects.extend(cls.objects.filter(term=t).all())
+            bound = query.bind((term,))
+            bound.fetch_size = HITS_FETCH_SIZE
+            futures.append(session.execute_async(bound))
+        hits = {}
+        for future in futures:
+            for row in future.result():
+                key = (row['object_path'], row['object_type'])
+                hits[key] = hits.get(key, 0) + 1
+        return hits
+
+    @classmethod
+    def find(cls, termstrings, user, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+        """Return the objects matching the terms which the user can read,
+        the ones with the most hits first (see search)"""
+        results, _ = cls.search(termstrings, user, limit, offset)
+        return results
+
+    @classmethod
+    def search(cls, termstrings, user, limit=DEFAULT_SEARCH_LIMIT, offset=0,
+               cursor=None):
+        """Return a page of at most 'limit' objects matching the terms,
+        which the user can read, and the cursor of the next page (None if
+        it's the last one). The objects are ordered by number of hits, then
+        by path. 'offset' readable objects are skipped after the cursor.
+
+        The hits are counted for all the objects but only the objects of the
+        page are read and checked for permission."""
+        return cls.page(cls.count_hits(termstrings), user, limit, offset,
+                        cursor)
 
+    @classmethod
+    def query(cls, text, user, limit=DEFAULT_SEARCH_LIMIT, offset=0,
+              cursor=None):
+        """Return a page of the objects matching a boolean query (see
+        drastic.models.search_query) which the user can read, and the cursor
+        of the next page. Raise ValueError if the query isn't valid"""
+        node = parse_query(text, cls.is_stop_word)
+        if node is None:
+            return [], None
+        evaluator = QueryEvaluator()
+        hits = evaluator.evaluate(node)
+        logging.debug(u"Query '{}' read {} rows for {} hits".format(
+            text, evaluator.rows_read, len(hits)))
+        return cls.page(hits, user, limit, offset, cursor)
+
+    @classmethod
+    def page(cls, hits, user, limit, offset, cursor):
+        """Return a page of the ranked hits which the user can read, and the
+        cursor of the next page"""
+        from drastic.models.collection import Collection
+        from drastic.models.resource import Resource
+        after = decode_search_cursor(cursor) if cursor else None
         results = []
-        for result in result_objects:
+        last = None
+        for count, path, object_type in rank(hits, after):
             try:
-                results.append(get_object(result, user))
+                if object_type == 'Collection':
+                    obj = Collection.find(path)
+                elif object_type == 'Resource':
+                    obj = Resource.find(path)
+                else:
+                    obj = None
+                if obj is None or not obj.user_can(user, "read"):
+                    continue
             except AttributeError:
-                logging.warning(u"Problem with SearchIndex('{}','{}','{}','{}')".format(
-                                result.uuid,
-                                result.term,
-                                result.object_type,
-                                result.uuid))
-        results = [x for x in results if x]
-
-        # Do some sane ordering here to group together by ID and
-        # order by frequency. Add the hit_count to the object dictionary
-        # and then we can order on that
-        keys = set(r['id'] for r in results)
-
-        result_list = []
-        for k in keys:
-            # get each element with this key, count them, store the hit
-            # count and only add one to results
-            matches = [x for x in results if x['id'] == k]
-            match = matches[0]
-            match['hit_count'] = len(matches)
-            result_list.append(match)
-
-        return sorted(result_list,
-                      key=lambda res: res.get('hit_count', 0),
-                      reverse=True)
+                logging.warning(u"Problem with SearchIndex('{}','{}')".format(
+                                path, object_type))
+                continue
+            if offset:
+                offset -= 1
+                continue
+            if len(results) == limit:
+                # There's at least one more result
+                return results, encode_search_cursor(last[0], last[1])
+            result = obj.to_dict(user)
+            result['result_type'] = object_type
+            result['hit_count'] = count
+            results.append(result)
+            last = (count, path)
+        return results, None
 
     @classmethod
     def is_stop_word(cls, term):
@@ -112,20 +420,74 @@ class SearchIndex(Model):
     @classmethod
     def reset(cls, object_path):
         """Delete objects from the SearchIndex"""
-        from drastic.models import IDSearch
-        rows = IDSearch.find(object_path)
-        for id_obj in rows:
-            obj = cls.objects.filter(term=id_obj.term,
-                                     term_type=id_obj.term_type,
-                                     object_path=id_obj.object_path).first()
-            if obj:
-                obj.delete()
-            id_obj.delete()
+        cls.reset_many([object_path])
 
     @classmethod
-    def index(cls, object, fields=['name']):
-        """Index"""
-        result_count = 0
+    def reset_many(cls, object_paths, window=RESET_WINDOW):
+        """Delete the terms of several objects from the SearchIndex. The
+        terms are read concurrently and the rows deleted 'window' at a
+        time, the idsearch partition of each object is deleted at once"""
+        session = get_session()
+        query = prepare(u"""SELECT term, term_type FROM {keyspace}.idsearch
+            WHERE object_path=?""")
+        reads = [(path, session.execute_async(query, (path,)))
+                 for path in object_paths]
+        delete_term = prepare(u"""DELETE FROM {keyspace}.search_index
+            WHERE term=? AND term_type=? AND object_path=?""")
+        delete_ids = prepare(u"""DELETE FROM {keyspace}.idsearch
+            WHERE object_path=?""")
+        futures = deque()
+        removed = {}
+        for path, future in reads:
+            for row in future.result():
+                futures.append(session.execute_async(
+                    delete_term, (row['term'], row['term_type'], path)))
+                removed[row['term']] = removed.get(row['term'], 0) - 1
+                wait_futures(futures, window)
+            futures.append(session.execute_async(delete_ids, (path,)))
+            wait_futures(futures, window)
+        wait_futures(futures)
+        TermStats.add(removed)
+
+    @classmethod
+    def move_many(cls, moves, window=RESET_WINDOW):
+        """Change the path of the terms of several objects, 'moves' is a
+        list of (old path, new path, object type). The terms themselves
+        aren't recomputed"""
+        session = get_session()
+        query = prepare(u"""SELECT term, term_type FROM {keyspace}.idsearch
+            WHERE object_path=?""")
+        reads = [(move, session.execute_async(query, (move[0],)))
+                 for move in moves]
+        insert_term = prepare(u"""INSERT INTO {keyspace}.search_index
+            (term, term_type, object_path, object_type, uuid)
+            VALUES (?, ?, ?, ?, ?)""")
+        insert_id = prepare(u"""INSERT INTO {keyspace}.idsearch
+            (object_path, term, term_type) VALUES (?, ?, ?)""")
+        delete_term = prepare(u"""DELETE FROM {keyspace}.search_index
+            WHERE term=? AND term_type=? AND object_path=?""")
+        delete_ids = prepare(u"""DELETE FROM {keyspace}.idsearch
+            WHERE object_path=?""")
+        futures = deque()
+        for (old_path, new_path, object_type), future in reads:
+            for row in future.result():
+                term, term_type = row['term'], row['term_type']
+                futures.append(session.execute_async(
+                    insert_term, (term, term_type, new_path, object_type,
+                                  default_uuid())))
+                futures.append(session.execute_async(
+                    insert_id, (new_path, term, term_type)))
+                futures.append(session.execute_async(
+                    delete_term, (term, term_type, old_path)))
+                wait_futures(futures, window)
+            futures.append(session.execute_async(delete_ids, (old_path,)))
+            wait_futures(futures, window)
+        wait_futures(futures)
+
+    @classmethod
+    def terms(cls, object, fields=['name']):
+        """Return the set of (term type, term) indexed for the fields of an
+        object"""
 
         def clean(t):
             """Clean a term"""
@@ -151,11 +513,15 @@ class SearchIndex(Model):
                 if isinstance(v, list):
                     for vv in v:
                         terms.extend([('metadata', el) for el in clean(vv.strip())])
+                        # The whole value is kept for the phrase queries
+                        terms.append(('metadata', clean_full(vv.strip())))
                 else:
                     v = str(v)
                     terms.extend([('metadata', el) for el in clean(v.strip())])
-            fields.remove('metadata')
+                    terms.append(('metadata', clean_full(v.strip())))
         for f in fields:
+            if f == 'metadata':
+                continue
             attr = getattr(object, f)
             if isinstance(attr, dict):
                 for k, v in attr.iteritems():
@@ -164,20 +530,79 @@ class SearchIndex(Model):
             else:
                 terms.extend([(f, el) for el in clean(attr)])
                 terms.append((f, clean_full(attr)))
+        return set((term_type, term) for term_type, term in terms
+                   if 2 <= len(term) <= MAX_TERM_LENGTH and
+                   not cls.is_stop_word(term))
 
+    @classmethod
+    def index(cls, object, fields=['name']):
+        """Index the fields of an object, return the number of terms. The
+        terms are compared with the ones already indexed for its path and
+        only the difference is written"""
+        query = prepare(u"""SELECT term, term_type FROM {keyspace}.idsearch
+            WHERE object_path=?""")
+        current = set((row['term_type'], row['term'])
+                      for row in get_session().execute(query, (object.path,)))
+        terms = cls.terms(object, fields)
+        cls.update_terms(object.path, object.__class__.__name__,
+                         terms - current, current - terms)
+        return len(terms)
 
-        object_type = object.__class__.__name__
-        for term_type, term in terms:
-            if cls.is_stop_word(term):
-                continue
-            if len(term) < 2:
-                continue
-            SearchIndex.create(term=term,
-                               term_type=term_type,
-                               object_type=object_type,
-                               object_path=object.path)
-            result_count += 1
-        return result_count
+    @classmethod
+    def update_terms(cls, object_path, object_type, added, removed,
+                     window=RESET_WINDOW):
+        """Add and remove terms of an object, sets of (term type, term). The
+        rows of each search_index partition are written in an unlogged
+        batch, the idsearch rows of the object in batches of ID_BATCH"""
+        if not added and not removed:
+            return
+        session = get_session()
+        insert_term = prepare(u"""INSERT INTO {keyspace}.search_index
+            (term, term_type, object_path, object_type, uuid)
+            VALUES (?, ?, ?, ?, ?)""")
+        delete_term = prepare(u"""DELETE FROM {keyspace}.search_index
+            WHERE term=? AND term_type=? AND object_path=?""")
+        insert_id = prepare(u"""INSERT INTO {keyspace}.idsearch
+            (object_path, term, term_type) VALUES (?, ?, ?)""")
+        delete_id = prepare(u"""DELETE FROM {keyspace}.idsearch
+            WHERE object_path=? AND term=? AND term_type=?""")
+        partitions = {}
+        ids = []
+        counts = {}
+        for term_type, term in added:
+            partitions.setdefault(term, []).append(
+                (insert_term, (term, term_type, object_path, object_type,
+                               default_uuid())))
+            ids.append((insert_id, (object_path, term, term_type)))
+            counts[term] = counts.get(term, 0) + 1
+        for term_type, term in removed:
+            partitions.setdefault(term, []).append(
+                (delete_term, (term, term_type, object_path)))
+            ids.append((delete_id, (object_path, term, term_type)))
+            counts[term] = counts.get(term, 0) - 1
+        batches = [ids[i:i + ID_BATCH] for i in xrange(0, len(ids), ID_BATCH)]
+        batches.extend(partitions.itervalues())
+        futures = deque()
+        for statements in batches:
+            if len(statements) == 1:
+                futures.append(session.execute_async(*statements[0]))
+            else:
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for statement, values in statements:
+                    batch.add(statement, values)
+                futures.append(session.execute_async(batch))
+            wait_futures(futures, window)
+        wait_futures(futures)
+        enabled, min_length, max_grams = ngram_settings()
+        if enabled and added:
+            # The grams are only written for the terms which weren't indexed
+            # yet
+            new_terms = set(term for _, term in added)
+            known = TermStats.get_many(new_terms)
+            SearchGram.add_terms([term for term in new_terms
+                                  if known.get(term, 0) <= 0],
+                                 min_length, max_grams)
+        TermStats.add(counts)
 
     def __unicode__(self):
         return unicode("".format(self.term, self.object_type))
@@ -0,0 +1,181 @@
+"""Search Gram Model
+
+Prefixes and n-grams of the search terms, for the queries with wildcards
+(see drastic.models.search_query). It's an index of the terms rather than of
+the objects: a term is added once, when it's first indexed, and a wildcard
+is expanded to the terms which match it before their rows are read in the
+search index.
+
+A term has two kinds of grams:
+
+    prefix   its prefixes, from NGRAM_MIN_LENGTH characters
+    ngram    its substrings of NGRAM_MIN_LENGTH characters
+
+At most NGRAM_MAX_GRAMS grams of each kind are indexed for a term, which
+bounds the size of the table. The longer prefixes are looked up with the
+longest indexed one, the substrings far in long terms can't be found.
+
+A pattern like "repo*" reads a single prefix partition, "*port*" reads the
+partitions of the n-grams of "port" and intersects them. The terms found are
+then checked against the pattern. The grams of terms which aren't indexed
+anymore are kept, they don't match any object.
+
+The table is only maintained when SEARCH_NGRAMS is set in the
+configuration, SearchGram.rebuild adds the grams of the terms indexed
+before.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from collections import deque
+import re
+
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+
+from drastic import get_config
+from drastic.models.cql import (
+    get_session,
+    prepare,
+    wait_futures,
+)
+
+
+PREFIX = 'prefix'
+NGRAM = 'ngram'
+# Maximum number of terms a wildcard is expanded to
+MAX_EXPANSIONS = 100
+# Number of concurrent writes of grams
+GRAM_WINDOW = 32
+# Number of rows fetched per page in the gram partitions
+GRAM_FETCH_SIZE = 5000
+
+
+def ngram_settings():
+    """Return (enabled, minimum length, maximum number of grams) from the
+    configuration"""
+    cfg = get_config(None)
+    return (cfg.get('SEARCH_NGRAMS', False),
+            max(cfg.get('NGRAM_MIN_LENGTH', 3), 1),
+            max(cfg.get('NGRAM_MAX_GRAMS', 24), 1))
+
+
+def term_grams(term, min_length, max_grams):
+    """Return the set of (kind, gram) of a term"""
+    grams = set()
+    longest = min(len(term), min_length + max_grams - 1)
+    for length in xrange(min_length, longest + 1):
+        grams.add((PREFIX, term[:length]))
+    for i in xrange(0, min(len(term) - min_length + 1, max_grams)):
+        grams.add((NGRAM, term[i:i + min_length]))
+    return grams
+
+
+def pattern_regex(pattern):
+    """Return the compiled regular expression of a pattern where '*'
+    matches any characters"""
+    return re.compile(u".*".join(re.escape(part)
+                                for part in pattern.split('*')) + u"$")
+
+
+class SearchGram(Model):
+    """A term which has a prefix or an n-gram"""
+    kind = columns.Text(partition_key=True)
+    gram = columns.Text(partition_key=True)
+    term = columns.Text(primary_key=True)
+
+    @classmethod
+    def add_terms(cls, terms, min_length=None, max_grams=None):
+        """Index the grams of several terms"""
+        if min_length is None or max_grams is None:
+            _, min_length, max_grams = ngram_settings()
+        session = get_session()
+        query = prepare(u"""INSERT INTO {keyspace}.search_gram
+            (kind, gram, term) VALUES (?, ?, ?)""")
+        futures = deque()
+        for term in terms:
+            for kind, gram in term_grams(term, min_length, max_grams):
+                futures.append(session.execute_async(query,
+                                                     (kind, gram, term)))
+                wait_futures(futures, GRAM_WINDOW)
+        wait_futures(futures)
+
+    @classmethod
+    def read(cls, kind, gram):
+        """Generate the terms which have a gram"""
+        query = prepare(u"""SELECT term FROM {keyspace}.search_gram
+            WHERE kind=? AND gram=?""")
+        bound = query.bind((kind, gram))
+        bound.fetch_size = GRAM_FETCH_SIZE
+        for row in get_session().execute(bound):
+            yield row['term']
+
+    @classmethod
+    def expand(cls, pattern, limit=MAX_EXPANSIONS):
+        """Return the terms which match a pattern where '*' matches any
+        characters, at most 'limit' of them. Raise ValueError if the pattern
+        has no part long enough to be looked up, or if the grams aren't
+        indexed"""
+        enabled, min_length, max_grams = ngram_settings()
+        if not enabled:
+            raise ValueError(u"Wildcards need SEARCH_NGRAMS in the "
+                             "configuration")
+        regex = pattern_regex(pattern)
+        prefix = pattern.split('*')[0]
+        if len(prefix) >= min_length:
+            candidates = cls.read(PREFIX,
+                                  prefix[:min_length + max_grams - 1])
+        else:
+            part = max(pattern.split('*'), key=len)
+            if len(part) < min_length:
+                raise ValueError(u"'{}' needs at least {} characters "
+                                 "between the wildcards".format(pattern,
+                                                                min_length))
+            candidates = cls.intersect_ngrams(part, min_length)
+        terms = []
+        for term in candidates:
+            if regex.match(term):
+                terms.append(term)
+                if len(terms) >= limit:
+                    break
+        return terms
+
+    @classmethod
+    def intersect_ngrams(cls, part, min_length):
+        """Return the terms which have all the n-grams of a string, sorted.
+        The partitions are read concurrently"""
+        session = get_session()
+        query = prepare(u"""SELECT term FROM {keyspace}.search_gram
+            WHERE kind=? AND gram=?""")
+        futures = []
+        for gram in set(part[i:i + min_length]
+                        for i in xrange(len(part) - min_length + 1)):
+            bound = query.bind((NGRAM, gram))
+            bound.fetch_size = GRAM_FETCH_SIZE
+            futures.append(session.execute_async(bound))
+        terms = None
+        for future in futures:
+            found = set(row['term'] for row in future.result())
+            terms = found if terms is None else terms & found
+        return sorted(terms or [])
+
+    @classmethod
+    def rebuild(cls):
+        """Index the grams of all the terms counted in the term_stats table,
+        return the number of terms"""
+        query = prepare(u"""SELECT term, postings FROM {keyspace}.term_stats""")
+        bound = query.bind(())
+        bound.fetch_size = GRAM_FETCH_SIZE
+        terms = []
+        count = 0
+        for row in get_session().execute(bound):
+            if row['postings'] > 0:
+                terms.append(row['term'])
+            if len(terms) >= GRAM_FETCH_SIZE:
+                cls.add_terms(terms)
+                count += len(terms)
+                terms = []
+        cls.add_terms(terms)
+        return count + len(terms)
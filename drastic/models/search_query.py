@@ -0,0 +1,197 @@
+"""Search Query Parser
+
+Parses the queries of SearchIndex.query into a tree of nodes:
+
+    report 2016          objects with both words (implicit AND)
+    report AND 2016      the same
+    report OR summary    objects with one of the words
+    report NOT draft     objects with 'report' but not 'draft'
+    "annual report"      objects with a field containing these words in
+                         this order
+    repo* or *port*      objects with a term matching the pattern, '*'
+                         matches any characters (see SearchGram)
+    (a OR b) AND c       parentheses group the operators
+
+The operators are uppercase, NOT binds tighter than AND which binds tighter
+than OR. The words are cut like the indexed values (on spaces, dots and
+underscores) and lowercased, the words which aren't indexed (stop words,
+single letters) are dropped.
+
+A node is a tuple: (TERM, term), (PHRASE, words, text), (WILDCARD,
+pattern), (AND, children), (OR, children) or (NOT, child). The pattern of a
+wildcard isn't cut into words, so it can match the whole name of an
+object.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import re
+
+
+TERM = 'term'
+PHRASE = 'phrase'
+WILDCARD = 'wildcard'
+AND = 'and'
+OR = 'or'
+NOT = 'not'
+
+# A quoted phrase (the closing quote can be missing), a parenthesis or a word
+TOKEN_RE = re.compile(r'"[^"]*"?|\(|\)|[^\s()"]+')
+
+
+def split_words(text):
+    """Split a value into lowercase words, the way the index does"""
+    return text.lower().replace('.', ' ').replace('_', ' ').split()
+
+
+def normalize(text):
+    """Return a value with its words separated by single spaces, so phrases
+    can be found in it"""
+    return u" ".join(split_words(text))
+
+
+def combine(operator, nodes):
+    """Return a node which applies an operator to a list of nodes. Missing
+    nodes are dropped and the nested nodes with the same operator are
+    flattened"""
+    children = []
+    for node in nodes:
+        if node is None:
+            continue
+        if node[0] == operator:
+            children.extend(node[1])
+        else:
+            children.append(node)
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return (operator, tuple(children))
+
+
+def is_positive(node):
+    """Check that a node matches a set of objects which can be found in the
+    index, a NOT has to be combined with other nodes by an AND"""
+    kind = node[0]
+    if kind == NOT:
+        return False
+    if kind == OR:
+        return all(is_positive(child) for child in node[1])
+    if kind == AND:
+        positives = [child for child in node[1] if child[0] != NOT]
+        negatives = [child[1] for child in node[1] if child[0] == NOT]
+        return (bool(positives) and
+                all(is_positive(child) for child in positives + negatives))
+    return True
+
+
+def query_terms(node):
+    """Return the set of the terms of a node"""
+    kind = node[0]
+    if kind == TERM:
+        return set([node[1]])
+    if kind == PHRASE:
+        return set(node[1])
+    if kind == WILDCARD:
+        return set()
+    if kind == NOT:
+        return query_terms(node[1])
+    terms = set()
+    for child in node[1]:
+        terms.update(query_terms(child))
+    return terms
+
+
+class QueryParser(object):
+    """Recursive descent parser for a list of tokens. 'ignore' is a function
+    which returns True for the words which aren't indexed"""
+
+    def __init__(self, tokens, ignore):
+        self.tokens = tokens
+        self.ignore = ignore
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError(u"Incomplete query")
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(u"Unexpected '{}' in query".format(self.peek()))
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.pos += 1
+            nodes.append(self.parse_and())
+        return combine(OR, nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek() not in (None, 'OR', ')'):
+            if self.peek() == 'AND':
+                self.pos += 1
+            nodes.append(self.parse_not())
+        return combine(AND, nodes)
+
+    def parse_not(self):
+        if self.peek() != 'NOT':
+            return self.parse_primary()
+        self.pos += 1
+        node = self.parse_not()
+        if node is None:
+            return None
+        if node[0] == NOT:
+            return node[1]
+        return (NOT, node)
+
+    def parse_primary(self):
+        token = self.next()
+        if token == '(':
+            node = self.parse_or()
+            if self.next() != ')':
+                raise ValueError(u"Missing ')' in query")
+            return node
+        if token in (')', 'AND', 'OR'):
+            raise ValueError(u"Unexpected '{}' in query".format(token))
+        if token.startswith('"'):
+            return self.phrase(token.strip('"'))
+        if '*' in token:
+            return (WILDCARD, token.lower())
+        return combine(AND, [(TERM, word) for word in split_words(token)
+                             if not self.ignore(word)])
+
+    def phrase(self, text):
+        words = split_words(text)
+        terms = tuple(word for word in words if not self.ignore(word))
+        if not terms:
+            return None
+        if len(words) == 1:
+            return (TERM, terms[0])
+        return (PHRASE, terms, u" ".join(words))
+
+
+def parse_query(text, ignore=None):
+    """Parse a query, return its root node or None if it has no indexed
+    word. Raise ValueError if the query isn't valid, or if it can only
+    exclude objects"""
+    if ignore is None:
+        ignore = lambda word: False
+    skip = lambda word: len(word) < 2 or ignore(word)
+    node = QueryParser(TOKEN_RE.findall(text), skip).parse()
+    if node is not None and not is_positive(node):
+        raise ValueError(u"The query has to match some terms, NOT only "
+                         "excludes objects")
+    return node
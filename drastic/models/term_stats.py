@@ -0,0 +1,62 @@
+"""Term Statistics Model
+
+Number of rows of each term in the search index, the length of its posting
+list. The boolean queries (see drastic.models.search_query) read the
+rarest terms first and only check the others on the candidates they found.
+
+The counters are updated by SearchIndex when terms are indexed or removed.
+Terms indexed before the table existed count as 0, they're read first which
+is slower but still correct.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+from cassandra.query import (
+    BatchStatement,
+    BatchType,
+)
+
+from drastic.models.cql import (
+    get_session,
+    prepare,
+)
+
+
+# Number of counters updated in a batch
+STATS_BATCH = 50
+
+
+class TermStats(Model):
+    """Number of index rows of a term"""
+    term = columns.Text(partition_key=True)
+    postings = columns.Counter()
+
+    @classmethod
+    def add(cls, counts):
+        """Add values to the counters of several terms, 'counts' is a
+        dictionary indexed by term (negative values remove rows)"""
+        query = prepare(u"""UPDATE {keyspace}.term_stats
+            SET postings = postings + ? WHERE term=?""")
+        session = get_session()
+        items = [(term, count) for term, count in counts.iteritems() if count]
+        for i in xrange(0, len(items), STATS_BATCH):
+            batch = BatchStatement(batch_type=BatchType.COUNTER)
+            for term, count in items[i:i + STATS_BATCH]:
+                batch.add(query, (count, term))
+            session.execute(batch)
+
+    @classmethod
+    def get_many(cls, terms):
+        """Return the number of rows of several terms in a dictionary, the
+        unknown terms aren't in it"""
+        terms = list(set(terms))
+        if not terms:
+            return {}
+        query = prepare(u"""SELECT term, postings FROM {keyspace}.term_stats
+            WHERE term IN ?""")
+        return dict((row['term'], row['postings'] or 0)
+                    for row in get_session().execute(query, (terms,)))
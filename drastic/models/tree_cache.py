@@ -0,0 +1,306 @@
+"""Path Resolution Cache
+
+Collection.find and Resource.find resolve a path to a row of the tree_entry
+table, most requests start with a few of them. The rows are kept in an
+in-process LRU cache for TREE_CACHE_TTL seconds (TREE_CACHE_SIZE entries at
+most, 0 disables the cache).
+
+The rows are invalidated by the TreeEntry methods which modify them and by
+the notifications published on MQTT, locally in Notification.mqtt_publish
+and for the changes made by other processes by a listener. When
+TREE_CACHE_LISTENER is set the listener is started by the first use of the
+cache, otherwise the rows changed by other processes are only refreshed when
+they expire. A move invalidates the previous path of the object too, it's
+found in the payload of the notification.
+
+The effective ACL of the collections, their own or the one inherited from
+their closest ancestor, are cached in the same way by path (ACL_CACHE_SIZE
+and ACL_CACHE_TTL). They are invalidated for a collection and its whole
+subtree when its container_acl is written, or when it's created, moved or
+deleted, not by the other changes of its partition.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+
+from drastic import get_config
+from drastic.util import split
+
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 5
+
+
+class TreeCache(object):
+    """LRU cache with a time to live, for the values of the tree_entry rows
+    indexed by (container, name). The size and the time to live are read
+    from the configuration on first use if they aren't given.
+
+    The subtrees of the collections whose partition is invalidated are
+    invalidated in the 'dependent' cache, if any"""
+    size_setting = 'TREE_CACHE_SIZE'
+    ttl_setting = 'TREE_CACHE_TTL'
+
+    def __init__(self, max_size=None, ttl=None, dependent=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.dependent = dependent
+        self.entries = OrderedDict()
+        # Keys of the entries indexed by container, so a partition is
+        # invalidated without scanning the whole cache
+        self.containers = {}
+        self.lock = threading.Lock()
+        # Incremented by each invalidation, a value read from Cassandra
+        # before an invalidation may be stale and isn't cached
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _configure(self):
+        if self.max_size is None:
+            cfg = get_config(None)
+            self.ttl = cfg.get(self.ttl_setting, DEFAULT_CACHE_TTL)
+            self.max_size = cfg.get(self.size_setting, DEFAULT_CACHE_SIZE)
+            if self.max_size and cfg.get('TREE_CACHE_LISTENER', False):
+                start_listener()
+
+    def _container(self, key):
+        """Return the container of the row of a key"""
+        return key[0]
+
+    def _index(self, key):
+        container = self._container(key)
+        if container is not None:
+            self.containers.setdefault(container, set()).add(key)
+
+    def _unindex(self, key):
+        container = self._container(key)
+        keys = self.containers.get(container)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.containers[container]
+
+    def _discard(self, key):
+        """Remove an entry, called with the lock held"""
+        if self.entries.pop(key, None) is not None:
+            self._unindex(key)
+
+    def get(self, key):
+        """Return the cached value for a key, None if it's not cached"""
+        self._configure()
+        if not self.max_size:
+            return None
+        with self.lock:
+            cached = self.entries.pop(key, None)
+            if cached is None or cached[0] < time.time():
+                if cached is not None:
+                    self._unindex(key)
+                self.misses += 1
+                return None
+            # Move the entry to the end, the most recently used
+            self.entries[key] = cached
+            self.hits += 1
+            return cached[1]
+
+    def put(self, key, value, version):
+        """Cache a value read when the cache was at 'version'"""
+        self._configure()
+        if not self.max_size:
+            return
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            self._index(key)
+            while len(self.entries) > self.max_size:
+                oldest, _ = self.entries.popitem(last=False)
+                self._unindex(oldest)
+
+    def invalidate(self, container, name):
+        """Forget a row"""
+        with self.lock:
+            self.version += 1
+            self._discard((container, name))
+
+    def invalidate_container(self, container, acl=False):
+        """Forget all the rows of a container partition, they share the
+        static columns. 'acl' is True if the ACL of the collection may have
+        changed, the subtree is then invalidated in the dependent cache"""
+        with self.lock:
+            self.version += 1
+            for key in self.containers.pop(container, ()):
+                self.entries.pop(key, None)
+        if acl and self.dependent is not None:
+            self.dependent.invalidate_subtree(container)
+
+    def invalidate_path(self, path, is_collection, acl=False):
+        """Forget the rows describing the object at 'path'"""
+        container, name = split(path)
+        if is_collection:
+            self.invalidate_container(path, acl)
+            self.invalidate(container, name + '/')
+        else:
+            self.invalidate(container, name)
+
+    def invalidate_subtree(self, path):
+        """Forget the rows of a collection and of everything below it"""
+        container, name = split(path)
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            self.version += 1
+            for child in [c for c in self.containers
+                          if c == path or c.startswith(prefix)]:
+                for key in self.containers.pop(child):
+                    self.entries.pop(key, None)
+            self._discard((container, name + '/'))
+        if self.dependent is not None:
+            self.dependent.invalidate_subtree(path)
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+            self.containers.clear()
+        if self.dependent is not None:
+            self.dependent.clear()
+
+    def stats(self):
+        """Return the hit and miss counters and the number of entries"""
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self.entries)}
+
+
+class AclCache(TreeCache):
+    """Cache of the effective ACL of the collections indexed by path. A
+    collection inherits the ACL of its ancestors, so a change invalidates
+    the whole subtree.
+
+    The paths are indexed as a tree: 'containers' holds the child paths of
+    each path which is cached or has cached descendants, so a subtree is
+    invalidated without scanning the whole cache"""
+    size_setting = 'ACL_CACHE_SIZE'
+    ttl_setting = 'ACL_CACHE_TTL'
+
+    def _index(self, key):
+        path = key
+        while True:
+            parent, _ = split(path)
+            if parent == path:
+                return
+            children = self.containers.setdefault(parent, set())
+            if path in children:
+                return
+            children.add(path)
+            path = parent
+
+    def _unindex(self, key):
+        # Remove the paths left without a cached value or descendant
+        path = key
+        while path not in self.entries and path not in self.containers:
+            parent, _ = split(path)
+            children = self.containers.get(parent)
+            if parent == path or children is None:
+                return
+            children.discard(path)
+            if children:
+                return
+            del self.containers[parent]
+            path = parent
+
+    def invalidate_subtree(self, path):
+        """Forget the ACL of a collection and of the collections below it"""
+        with self.lock:
+            self.version += 1
+            stack = [path]
+            while stack:
+                current = stack.pop()
+                self.entries.pop(current, None)
+                stack.extend(self.containers.pop(current, ()))
+            self._unindex(path)
+
+
+acl_cache = AclCache()
+tree_cache = TreeCache(dependent=acl_cache)
+
+# MQTT client of the listener of the process, see start_listener
+_listener_lock = threading.Lock()
+_listener = {"client": None}
+
+
+def invalidate_moved(payload, is_collection):
+    """Invalidate the rows of the previous path of a moved object, given the
+    payload of the move notification"""
+    path = (json.loads(payload).get('pre') or {}).get('path')
+    if not path:
+        return
+    if is_collection:
+        tree_cache.invalidate_subtree(path)
+    else:
+        tree_cache.invalidate_path(path, False)
+
+
+def invalidate_topic(topic, payload=None):
+    """Invalidate the rows of the object of a notification topic
+    (operation/object_type/uuid/path, see Notification.mqtt_publish)"""
+    from drastic.models.notification import (
+        OBJ_COLLECTION,
+        OBJ_RESOURCE,
+        OP_MOVE,
+        OP_UPDATE,
+    )
+    parts = topic.split('/')
+    if len(parts) < 3 or parts[1] not in (OBJ_COLLECTION, OBJ_RESOURCE):
+        return
+    path = u'/' + u'/'.join(parts[3:])
+    # The ACL aren't written by the updates
+    tree_cache.invalidate_path(path, parts[1] == OBJ_COLLECTION,
+                               parts[0] != OP_UPDATE)
+    if parts[0] == OP_MOVE and payload:
+        invalidate_moved(payload, parts[1] == OBJ_COLLECTION)
+
+
+def start_listener(host='localhost', port=1883):
+    """Subscribe to the notifications of the other processes and invalidate
+    the rows they modify, the broker is the one Notification.mqtt_publish
+    uses by default. The MQTT client runs in a background thread and
+    reconnects when the connection is lost. A process has one listener,
+    its client is returned"""
+    import paho.mqtt.client as mqtt
+
+    def on_connect(client, userdata, flags, rc):
+        # The notifications sent while we weren't connected are lost
+        tree_cache.clear()
+        client.subscribe([('create/#', 0), ('update/#', 0), ('delete/#', 0),
+                          ('move/#', 0)])
+
+    def on_message(client, userdata, msg):
+        topic = msg.topic
+        if isinstance(topic, str):
+            topic = topic.decode('utf-8')
+        try:
+            invalidate_topic(topic, msg.payload)
+        except Exception:
+            logging.exception(u'Problem while invalidating "{0}"'.format(
+                msg.topic))
+            tree_cache.clear()
+
+    with _listener_lock:
+        if _listener['client'] is None:
+            client = mqtt.Client()
+            client.on_connect = on_connect
+            client.on_message = on_message
+            client.connect_async(host, port, 60)
+            client.loop_start()
+            _listener['client'] = client
+        return _listener['client']
@@ -5,15 +5,23 @@ __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
+import copy
 from cassandra.cqlengine.models import Model
-from cassandra.query import SimpleStatement
-from cassandra.cqlengine import (
-    columns,
-    connection
+from cassandra.query import (
+    UNSET_VALUE,
+    BatchStatement,
+    SimpleStatement,
 )
+from cassandra.cqlengine import columns
 from datetime import datetime
 
-from drastic import get_config
+from drastic.models.cql import (
+    execute_update,
+    get_keyspace,
+    get_session,
+    prepare,
+)
+from drastic.models.tree_cache import tree_cache
 from drastic.util import (
     default_cdmi_id,
     merge,
@@ -37,6 +45,31 @@ static_fields = ["container_metadata",
                  "container_modified_ts",
                  "container_acl"]
 
+# The columns of a row which aren't shared by the partition
+entry_fields = ["metadata",
+                "create_ts",
+                "modified_ts",
+                "acl",
+                "mimetype",
+                "url",
+                "uuid"]
+
+
+def insert_entry_query(names, if_not_exists=False):
+    """Return the prepared statement which inserts a row with the columns
+    in 'names', after the primary key. A None value should be bound as
+    UNSET_VALUE so it doesn't write a tombstone"""
+    columns = u", ".join(["container", "name"] + names)
+    markers = u", ".join(["?"] * (len(names) + 2))
+    condition = u" IF NOT EXISTS" if if_not_exists else u""
+    return prepare(u"""INSERT INTO {{keyspace}}.tree_entry ({0})
+        VALUES ({1}){2}""".format(columns, markers, condition))
+
+
+def unset_nulls(values):
+    """Replace the None values to bind by UNSET_VALUE"""
+    return [UNSET_VALUE if value is None else value for value in values]
+
 class TreeEntry(Model):
     """TreeEntry model"""
 
@@ -95,19 +128,22 @@ class TreeEntry(Model):
 #             kwargs['metadata'] = meta_cdmi_to_cassandra(metadata)
 #             del kwargs['mimetype']
         new = super(TreeEntry, cls).create(**kwargs)
+        if any(name in static_fields for name in kwargs):
+            tree_cache.invalidate_container(new.container,
+                                            'container_acl' in kwargs)
+        else:
+            tree_cache.invalidate(new.container, new.name)
         return new
 
 
     def create_container_acl(self, acl_cql):
         """Replace the static acl with the given cql string
         """
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET container_acl={}
-            WHERE container=%s""".format(acl_cql))
+        session = get_session()
+        query = SimpleStatement(u"""UPDATE {}.tree_entry SET container_acl={}
+            WHERE container=%s""".format(get_keyspace(), acl_cql))
         session.execute(query, (self.container,))
+        tree_cache.invalidate_container(self.container, True)
 
 
     def create_container_acl_cdmi(self, cdmi_acl):
@@ -125,13 +161,11 @@ class TreeEntry(Model):
     def create_entry_acl(self, acl_cql):
         """Replace the acl with the given cql string
         """
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET acl={}
-            WHERE container=%s and name=%s""".format(acl_cql))
+        session = get_session()
+        query = SimpleStatement(u"""UPDATE {}.tree_entry SET acl={}
+            WHERE container=%s and name=%s""".format(get_keyspace(), acl_cql))
         session.execute(query, (self.container, self.name,))
+        tree_cache.invalidate(self.container, self.name)
 
 
     def create_entry_acl_list(self, read_access, write_access):
@@ -146,39 +180,90 @@ class TreeEntry(Model):
         self.create_entry_acl(cql_string)
 
 
+    def delete(self):
+        """Delete the row"""
+        super(TreeEntry, self).delete()
+        tree_cache.invalidate(self.container, self.name)
+
+
+    @classmethod
+    def find(cls, container, name):
+        """Return the row of an entry, from the path cache if possible (see
+        drastic.models.tree_cache)"""
+        key = (container, name)
+        values = tree_cache.get(key)
+        if values is not None:
+            # The maps of the cached row aren't shared with the instances
+            return cls._construct_instance(copy.deepcopy(values))
+        version = tree_cache.version
+        entry = cls.objects.filter(container=container, name=name).first()
+        if entry is not None:
+            tree_cache.put(key, copy.deepcopy(entry._as_dict()), version)
+        return entry
+
+
+    def move(self, container, name):
+        """Write the row under a new container and name and delete the
+        previous one, in a logged batch. The static columns of the
+        partition aren't copied. Return the new row"""
+        values = [getattr(self, field) for field in entry_fields]
+        batch = BatchStatement()
+        batch.add(insert_entry_query(entry_fields),
+                  [container, name] + unset_nulls(values))
+        batch.add(prepare(u"""DELETE FROM {keyspace}.tree_entry
+                             WHERE container=? AND name=?"""),
+                  (self.container, self.name))
+        get_session().execute(batch)
+        tree_cache.invalidate(self.container, self.name)
+        tree_cache.invalidate(container, name)
+        return TreeEntry(container=container, name=name,
+                         **dict(zip(entry_fields, values)))
+
+
     def path(self):
         """Get the full path of the specific entry"""
         return merge(self.container, self.name)
 
 
+    def _update(self, values, conditions=None):
+        """Write the columns in 'values' with a single statement, static
+        columns can be set in the same statement as the per-row columns"""
+        keys = [("container", self.container)]
+        if any(name not in static_fields for name in values):
+            keys.append(("name", self.name))
+        applied = execute_update("tree_entry", keys, values, conditions)
+        if applied:
+            for name, value in values.items():
+                setattr(self, name, value)
+        if any(name in static_fields for name in values):
+            tree_cache.invalidate_container(self.container,
+                                            'container_acl' in values)
+        else:
+            tree_cache.invalidate(self.container, self.name)
+        return applied
+
+
     def update(self, **kwargs):
         """Update a collection"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        for arg in kwargs:
-            # For static fields we can't use the name in the where condition
-            if arg in static_fields:
-                query = SimpleStatement(u"""UPDATE tree_entry SET {}=%s
-                    WHERE container=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.container))
-            else:
-                query = SimpleStatement(u"""UPDATE tree_entry SET {}=%s
-                    WHERE container=%s and name=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.container, self.name))
+        if kwargs:
+            self._update(kwargs)
         return self
 
 
+    def update_if(self, conditions, **kwargs):
+        """Update an entry if the current values of the columns in
+        'conditions' match (compare and set). Return True if the update has
+        been applied"""
+        return self._update(kwargs, conditions)
+
+
     def update_container_acl(self, acl_cql):
         """Update the static acl with the given cql string"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET container_acl=container_acl+{}
-            WHERE container=%s""".format(acl_cql))
+        session = get_session()
+        query = SimpleStatement(u"""UPDATE {}.tree_entry SET container_acl=container_acl+{}
+            WHERE container=%s""".format(get_keyspace(), acl_cql))
         session.execute(query, (self.container,))
+        tree_cache.invalidate_container(self.container, True)
 
 
     def update_container_acl_cdmi(self, cdmi_acl):
@@ -195,13 +280,11 @@ class TreeEntry(Model):
 
     def update_entry_acl(self, acl_cql):
         """Update the acl with the given cql string"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'drastic')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET acl=acl+{}
-            WHERE container=%s and name=%s""".format(acl_cql))
+        session = get_session()
+        query = SimpleStatement(u"""UPDATE {}.tree_entry SET acl=acl+{}
+            WHERE container=%s and name=%s""".format(get_keyspace(), acl_cql))
         session.execute(query, (self.container, self.name,))
+        tree_cache.invalidate(self.container, self.name)
 
 
     def update_entry_acl_list(self, read_access, write_access):
@@ -0,0 +1,430 @@
+"""Upload Session Model
+
+An upload session builds a data object from parts sent in any order, possibly
+by several clients at the same time. Each part is a chunk of the object
+identified by its sequence number. It is written in the data_object partition
+first and then recorded in the upload_session partition, so a part listed in
+the session is known to be stored. An interrupted upload is resumed by
+sending the parts which aren't listed yet.
+
+finalize() checks that the parts are contiguous and match what was recorded,
+computes the size and the checksum of the object and writes them with the
+other static columns of the data object in a single statement. A lightweight
+transaction on the state of the session makes sure only one client
+finalizes it.
+
+Sessions are meant for the uploads which may have to be resumed, a file
+uploaded in one go is faster with DataObject.create_from_stream. The
+sessions which were started more than UPLOAD_SESSION_MAX_AGE seconds ago
+are removed by UploadSession.reap, with the parts of the ones which were
+never completed.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from collections import deque
+import hashlib
+from datetime import (
+    datetime,
+    timedelta,
+)
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+
+from drastic import get_config
+from drastic.compression import choose_codec
+from drastic.models.chunk_store import (
+    ChunkStore,
+    ChunkStoreWriter,
+    chunk_hash,
+)
+from drastic.models.cql import (
+    execute_update,
+    get_session,
+    prepare,
+    wait_futures,
+    wait_futures_quietly,
+)
+from drastic.models.data_object import (
+    CHECKSUM_ALGORITHM,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_WRITE_WINDOW,
+    ChunkWriter,
+    DataObject,
+    read_chunk,
+)
+from drastic.models.errors import (
+    IncompleteUploadError,
+    NoSuchUploadError,
+    UploadClosedError,
+)
+from drastic.util import default_cdmi_id
+
+
+STATE_OPEN = "open"
+STATE_FINALIZING = "finalizing"
+STATE_COMPLETE = "complete"
+# Default number of seconds after which a session is removed by reap
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+# Number of sessions fetched per page by reap
+REAP_FETCH_SIZE = 1000
+
+RECORD_PART = u"""INSERT INTO {keyspace}.upload_session
+    (uuid, sequence_number, part_size, part_hash, committed_ts)
+    VALUES (?, ?, ?, ?, ?)"""
+
+
+class UploadSession(Model):
+    """A data object being uploaded in parts. The static columns describe
+    the session, there's one row per committed part"""
+    # The uuid of the data object being built
+    uuid = columns.Text(default=default_cdmi_id, required=True,
+                        partition_key=True)
+    state = columns.Text(static=True, default=STATE_OPEN)
+    # Maximum size of a part, all the parts but the last one should have
+    # this size for range reads to be efficient
+    chunk_size = columns.Integer(static=True)
+    mimetype = columns.Text(static=True)
+    metadata = columns.Map(columns.Text, columns.Text, static=True)
+    # True if the parts go to the content addressed chunk store
+    dedup = columns.Boolean(static=True, default=False)
+    # Bucket size of the data object (see drastic.models.data_chunk)
+    bucket_size = columns.Integer(static=True)
+    create_ts = columns.DateTime(default=datetime.now, static=True)
+    #####################
+    sequence_number = columns.Integer(primary_key=True, partition_key=False)
+    part_size = columns.Integer()
+    # Hash of the content of the part (see chunk_store.chunk_hash)
+    part_hash = columns.Text()
+    committed_ts = columns.DateTime()
+
+    @classmethod
+    def start(cls, chunk_size=DEFAULT_CHUNK_SIZE, mimetype=None,
+              metadata=None, dedup=None, bucket_size=None):
+        """Open a new upload session. The data object will have the same
+        uuid as the session"""
+        cfg = get_config(None)
+        if dedup is None:
+            dedup = cfg.get('CHUNK_DEDUP', False)
+        if bucket_size is None:
+            bucket_size = cfg.get('CHUNK_BUCKET_SIZE') or None
+        values = {
+            "state": STATE_OPEN,
+            "chunk_size": chunk_size,
+            "dedup": dedup,
+            "create_ts": datetime.now(),
+        }
+        if mimetype:
+            values['mimetype'] = mimetype
+        if metadata:
+            values['metadata'] = metadata
+        new_id = default_cdmi_id()
+        if bucket_size:
+            values['bucket_size'] = bucket_size
+            # Set before the first part so the partial object can be read
+            # and deleted like any other
+            execute_update("data_object", [("uuid", new_id)],
+                           {"bucket_size": bucket_size})
+        execute_update("upload_session", [("uuid", new_id)], values)
+        return cls(uuid=new_id, **values)
+
+    @classmethod
+    def find(cls, uuid):
+        """Find an upload session by uuid"""
+        query = prepare(u"""SELECT uuid, state, chunk_size, mimetype, metadata,
+            dedup, bucket_size, create_ts FROM {keyspace}.upload_session
+            WHERE uuid=? LIMIT 1""")
+        rows = list(get_session().execute(query, (uuid,)))
+        if not rows or not rows[0]['state']:
+            return None
+        return cls(**rows[0])
+
+    def current_state(self):
+        """Read the state of the session, it may have been changed by
+        another client"""
+        query = prepare(u"""SELECT state FROM {keyspace}.upload_session
+            WHERE uuid=? LIMIT 1""")
+        rows = list(get_session().execute(query, (self.uuid,)))
+        if not rows or not rows[0]['state']:
+            raise NoSuchUploadError(self.uuid)
+        self.state = rows[0]['state']
+        return self.state
+
+    def parts(self):
+        """Return the committed parts, a dictionary of sizes and hashes
+        indexed by sequence number"""
+        query = prepare(u"""SELECT sequence_number, part_size, part_hash
+            FROM {keyspace}.upload_session WHERE uuid=?""")
+        parts = {}
+        for row in get_session().execute(query, (self.uuid,)):
+            if row['sequence_number'] is not None:
+                parts[row['sequence_number']] = {"size": row['part_size'],
+                                                 "hash": row['part_hash']}
+        return parts
+
+    def put_part(self, sequence_number, data):
+        """Store a part of the object. Sending a part again replaces it"""
+        if sequence_number < 0 or len(data) > self.chunk_size:
+            raise ValueError("Invalid part {} ({} bytes)".format(
+                sequence_number, len(data)))
+        if self.current_state() != STATE_OPEN:
+            raise UploadClosedError(self.uuid)
+        # A replaced part keeps its reference in the chunk store, the chunk
+        # is leaked rather than released while it may still be used
+        writer = self._writer(1)
+        writer.put(sequence_number, data, choose_codec(self.mimetype, data))
+        writer.close()
+        get_session().execute(prepare(RECORD_PART),
+                              (self.uuid, sequence_number, len(data),
+                               chunk_hash(data), datetime.now()))
+
+    def _writer(self, window):
+        """Return a writer for the chunks of the object"""
+        if self.dedup:
+            return ChunkStoreWriter(self.uuid, window, self.bucket_size)
+        return ChunkWriter(self.uuid, window, self.bucket_size)
+
+    def upload_stream(self, fileobj, window=DEFAULT_WRITE_WINDOW):
+        """Send the content of a file-like object, skipping the parts which
+        are already committed with the same content, and finalize the
+        session. Used to resume an interrupted upload.
+
+        The state is checked once. The parts are written with at most
+        'window' inserts in flight and recorded by groups of 'window', once
+        the chunks of the group are stored. The content is hashed as it's
+        read so finalize doesn't read it again."""
+        state = self.current_state()
+        if state == STATE_COMPLETE:
+            return DataObject.find(self.uuid)
+        if state != STATE_OPEN:
+            raise UploadClosedError(self.uuid)
+        window = max(window, 1)
+        parts = self.parts()
+        writer = self._writer(window)
+        record = prepare(RECORD_PART)
+        futures = deque()
+        # Parts written but not recorded yet
+        pending = []
+        checksum = hashlib.new(CHECKSUM_ALGORITHM)
+        hashes = []
+        codec = None
+        sequence_number = 0
+        try:
+            # An empty file still has one (empty) part
+            data = read_chunk(fileobj, self.chunk_size)
+            while True:
+                checksum.update(data)
+                part_hash = chunk_hash(data)
+                hashes.append(part_hash)
+                part = parts.get(sequence_number)
+                if (not part or part['size'] != len(data) or
+                        part['hash'] != part_hash):
+                    if codec is None:
+                        codec = choose_codec(self.mimetype, data)
+                    writer.put(sequence_number, data, codec)
+                    pending.append((sequence_number, len(data), part_hash))
+                    if len(pending) >= window:
+                        self._record_parts(writer, record, pending, futures)
+                sequence_number += 1
+                data = read_chunk(fileobj, self.chunk_size)
+                if not data:
+                    break
+            self._record_parts(writer, record, pending, futures)
+            wait_futures(futures)
+        except Exception:
+            # The parts recorded so far are kept for the next attempt
+            writer.abort()
+            wait_futures_quietly(futures)
+            raise
+        return self.finalize(checksum.hexdigest(), hashes)
+
+    def _record_parts(self, writer, record, pending, futures):
+        """Wait for the chunks of the pending parts and record the parts"""
+        writer.close()
+        session = get_session()
+        now = datetime.now()
+        for sequence_number, size, part_hash in pending:
+            futures.append(session.execute_async(
+                record, (self.uuid, sequence_number, size, part_hash, now)))
+        wait_futures(futures, len(pending))
+        del pending[:]
+
+    def finalize(self, checksum=None, hashes=None):
+        """Write the static columns of the data object and close the
+        session. Return the data object.
+
+        If the caller sent the whole object it gives its checksum and the
+        hashes of its parts (see upload_stream): the parts are checked
+        against their recorded hash and the content isn't read again.
+        Otherwise the content is read to compute the checksum.
+
+        IncompleteUploadError is raised if parts are missing or don't match
+        their recorded hash, the session is then open again for the missing
+        parts."""
+        if not execute_update("upload_session", [("uuid", self.uuid)],
+                              {"state": STATE_FINALIZING},
+                              {"state": STATE_OPEN}):
+            if self.current_state() == STATE_COMPLETE:
+                # Finalized by another client
+                return DataObject.find(self.uuid)
+            raise UploadClosedError(self.uuid)
+        try:
+            parts = self.parts()
+            if hashes is not None:
+                count = len(hashes)
+            else:
+                count = max(parts) + 1 if parts else 1
+            missing = [n for n in xrange(count) if n not in parts]
+            if missing:
+                raise IncompleteUploadError(self.uuid, missing)
+            self._delete_chunks_from(count, parts)
+            if hashes is not None:
+                # Replaced by another client since we sent them
+                changed = [n for n in xrange(count)
+                           if parts[n]['hash'] != hashes[n]]
+                if changed:
+                    raise IncompleteUploadError(self.uuid, changed)
+                size = sum(parts[n]['size'] for n in xrange(count))
+            else:
+                checksum, size = self._read_checksum(parts)
+            statics = {
+                "checksum": checksum,
+                "size": size,
+                "create_ts": self.create_ts or datetime.now(),
+                "modified_ts": datetime.now(),
+            }
+            # Range reads need every chunk but the last one to be full
+            if all(parts[n]['size'] == self.chunk_size
+                   for n in xrange(count - 1)):
+                statics['chunk_size'] = self.chunk_size
+            if self.mimetype:
+                statics['mimetype'] = self.mimetype
+            if self.metadata:
+                statics['metadata'] = self.metadata
+            execute_update("data_object", [("uuid", self.uuid)], statics)
+        except Exception:
+            execute_update("upload_session", [("uuid", self.uuid)],
+                           {"state": STATE_OPEN}, {"state": STATE_FINALIZING})
+            raise
+        # The parts aren't needed anymore, the static columns are kept so a
+        # client retrying finalize gets the data object
+        self.state = STATE_COMPLETE
+        execute_update("upload_session", [("uuid", self.uuid)],
+                       {"state": STATE_COMPLETE})
+        query = prepare(u"""DELETE FROM {keyspace}.upload_session
+            WHERE uuid=? AND sequence_number >= 0""")
+        get_session().execute(query, (self.uuid,))
+        return DataObject.find(self.uuid)
+
+    def _read_checksum(self, parts):
+        """Read the content of the object, return its checksum and its size.
+        Each chunk is checked against its recorded part"""
+        checksum = hashlib.new(CHECKSUM_ALGORITHM)
+        size = 0
+        data_object = DataObject(uuid=self.uuid, bucket_size=self.bucket_size)
+        for sequence_number, data in enumerate(data_object.chunk_content()):
+            part = parts.get(sequence_number)
+            # The chunk may have been replaced by a client after the part
+            # was recorded
+            if (not part or part['size'] != len(data) or
+                    part['hash'] != chunk_hash(data)):
+                raise IncompleteUploadError(self.uuid, [sequence_number])
+            checksum.update(data)
+            size += len(data)
+        return checksum.hexdigest(), size
+
+    def _delete_chunks_from(self, first, parts=None):
+        """Delete the chunks written for the parts from 'first', the
+        recorded ones and the ones a client may have sent after we listed
+        the parts. 'parts' are the recorded parts if they're known"""
+        session = get_session()
+        if self.bucket_size:
+            if parts is None:
+                parts = self.parts()
+            last = max(parts) if parts else first
+            futures = deque()
+            query = prepare(u"""DELETE FROM {keyspace}.data_chunk
+                WHERE uuid=? AND bucket=? AND sequence_number >= ?""")
+            for bucket, hashes in self._bucket_hashes(first, last):
+                ChunkStore.release(hashes)
+                futures.append(session.execute_async(
+                    query, (self.uuid, bucket, first)))
+                wait_futures(futures, DEFAULT_WRITE_WINDOW)
+            wait_futures(futures)
+            return
+        query = prepare(u"""SELECT chunk_hash FROM {keyspace}.data_object
+            WHERE uuid=? AND sequence_number >= ?""")
+        rows = list(session.execute(query, (self.uuid, first)))
+        if not rows:
+            return
+        ChunkStore.release(row['chunk_hash'] for row in rows
+                           if row['chunk_hash'])
+        query = prepare(u"""DELETE FROM {keyspace}.data_object
+            WHERE uuid=? AND sequence_number >= ?""")
+        session.execute(query, (self.uuid, first))
+
+    def _bucket_hashes(self, first, last):
+        """Generate the non-empty buckets holding chunks from 'first', with
+        the chunk store hashes of their chunks. The parts are sent in any
+        order so a bucket may have holes: every bucket up to the one of the
+        part 'last' is read, then the next ones until an empty one"""
+        query = prepare(u"""SELECT chunk_hash FROM {keyspace}.data_chunk
+            WHERE uuid=? AND bucket=? AND sequence_number >= ?""")
+        session = get_session()
+        bucket = first // self.bucket_size
+        while True:
+            rows = list(session.execute(query, (self.uuid, bucket, first)))
+            if rows:
+                yield bucket, [row['chunk_hash'] for row in rows
+                               if row['chunk_hash']]
+            elif bucket > last // self.bucket_size:
+                return
+            bucket += 1
+
+    def _delete_parts(self):
+        """Delete the data object of a session which wasn't completed"""
+        self._delete_chunks_from(0)
+        DataObject.delete_partition(self.uuid)
+
+    def abort(self):
+        """Delete the session and the parts sent so far"""
+        if self.current_state() == STATE_COMPLETE:
+            raise UploadClosedError(self.uuid)
+        self._delete_parts()
+        self.delete_session(self.uuid)
+
+    @classmethod
+    def delete_session(cls, uuid):
+        """Forget an upload session, the data object isn't deleted"""
+        query = prepare(u"""DELETE FROM {keyspace}.upload_session WHERE uuid=?""")
+        get_session().execute(query, (uuid,))
+
+    @classmethod
+    def reap(cls, max_age=None):
+        """Remove the sessions started more than 'max_age' seconds ago
+        (UPLOAD_SESSION_MAX_AGE by default). The parts of the sessions which
+        weren't completed are deleted, the data objects of the completed
+        ones are kept. Return the number of sessions removed"""
+        if max_age is None:
+            max_age = get_config(None).get('UPLOAD_SESSION_MAX_AGE',
+                                           DEFAULT_MAX_AGE)
+        oldest = datetime.now() - timedelta(seconds=max_age)
+        query = prepare(u"""SELECT DISTINCT uuid, state, bucket_size, create_ts
+            FROM {keyspace}.upload_session""")
+        bound = query.bind(())
+        bound.fetch_size = REAP_FETCH_SIZE
+        count = 0
+        for row in get_session().execute(bound):
+            if row['create_ts'] and row['create_ts'] > oldest:
+                continue
+            if row['state'] != STATE_COMPLETE:
+                # The static columns of the session may be missing
+                bucket_size = (row['bucket_size'] or
+                               DataObject._read_bucket_size(row['uuid']))
+                upload = cls(uuid=row['uuid'], bucket_size=bucket_size)
+                upload._delete_parts()
+            cls.delete_session(row['uuid'])
+            count += 1
+        return count
@@ -0,0 +1,166 @@
+"""Collection statistics reconciliation
+
+Rebuilds the counters of the collection_stats table from a scan of the
+tree, when they have drifted (failed requests, or data created before the
+counters existed).
+
+The partitions of the collections are scanned breadth-first by a pool of
+threads, counting their children and the resources they contain. The sizes
+of the resources are read with DataObject.find_many. The recursive counters
+are then summed bottom-up and the difference with the stored counters is
+added to each of them. The changes made to the tree while the job runs may
+be counted twice or not at all, the job should run when the tree is quiet.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import threading
+from collections import deque
+from Queue import Queue
+
+from drastic.models import DataObject
+from drastic.models.collection import LIST_FETCH_SIZE
+from drastic.models.collection_stats import (
+    CollectionStats,
+    ancestors,
+    increment_query,
+)
+from drastic.models.cql import (
+    get_session,
+    prepare,
+    wait_futures,
+)
+from drastic.models.resource import is_reference
+from drastic.util import (
+    merge,
+    split,
+)
+import log
+
+logger = log.init_log('reconcile')
+
+DEFAULT_WORKERS = 4
+# Number of data objects whose size is read together
+SIZE_BATCH = 100
+# Number of counters updated concurrently
+UPDATE_WINDOW = 32
+
+
+class StatsReconciler(object):
+    """Rebuild the counters of the collection at 'path' and below it. The
+    counters of its ancestors are corrected by the same difference"""
+
+    def __init__(self, path='/', workers=DEFAULT_WORKERS):
+        self.path = path
+        self.workers = max(workers, 1)
+        self.lock = threading.Lock()
+        # Counters computed for each collection, the recursive ones only
+        # count the resources of the collection itself until they're summed
+        self.counts = {}
+        self.failed = 0
+
+    def run(self):
+        """Scan the subtree and fix the counters, return the counters of the
+        collection at 'path'. Nothing is written if the scan fails"""
+        queue = Queue()
+        queue.put(self.path)
+        threads = []
+        for _ in xrange(self.workers):
+            t = threading.Thread(target=self.work, args=(queue,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        queue.join()
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        if self.failed:
+            raise RuntimeError(u"{} collections couldn't be scanned".format(
+                self.failed))
+        self.sum_subtrees()
+        self.write()
+        logger.info(u"Counters of '{}' reconciled for {} collections".format(
+            self.path, len(self.counts)))
+        return self.counts[self.path]
+
+    def work(self, queue):
+        while True:
+            path = queue.get()
+            if path is None:
+                return
+            try:
+                for child in self.scan_collection(path):
+                    queue.put(child)
+            except Exception:
+                logger.exception(u"Problem while scanning '{}'".format(path))
+                with self.lock:
+                    self.failed += 1
+            finally:
+                queue.task_done()
+
+    def scan_collection(self, path):
+        """Count the children and the resources of a collection, return the
+        paths of its child collections"""
+        query = prepare(u"""SELECT name, url FROM {keyspace}.tree_entry
+            WHERE container=?""")
+        bound = query.bind((path,))
+        bound.fetch_size = LIST_FETCH_SIZE
+        counts = {"children": 0, "resources": 0, "size": 0}
+        children = []
+        obj_ids = []
+        for row in get_session().execute(bound):
+            name = row['name']
+            if name == '.':
+                continue
+            counts['children'] += 1
+            if name.endswith('/'):
+                children.append(merge(path, name[:-1]))
+                continue
+            counts['resources'] += 1
+            url = row['url']
+            if url and not is_reference(url):
+                obj_ids.append(url.replace("cassandra://", ""))
+        for i in xrange(0, len(obj_ids), SIZE_BATCH):
+            objects = DataObject.find_many(obj_ids[i:i + SIZE_BATCH])
+            counts['size'] += sum(obj.size or 0 for obj in objects.values())
+        with self.lock:
+            self.counts[path] = counts
+        return children
+
+    def sum_subtrees(self):
+        """Add the resources of each collection to its ancestors in the
+        subtree, the deepest collections first"""
+        for path in sorted(self.counts, key=lambda p: p.count('/'),
+                           reverse=True):
+            if path == self.path:
+                continue
+            parent, _ = split(path)
+            self.counts[parent]['resources'] += self.counts[path]['resources']
+            self.counts[parent]['size'] += self.counts[path]['size']
+
+    def write(self):
+        """Add the difference between the computed and the stored counters
+        to each collection"""
+        session = get_session()
+        query = increment_query()
+        futures = deque()
+        root_delta = None
+        for path, counts in self.counts.iteritems():
+            stored = CollectionStats.get(path)
+            delta = dict((key, counts[key] - stored[key]) for key in counts)
+            if path == self.path:
+                root_delta = delta
+            if any(delta.values()):
+                futures.append(session.execute_async(
+                    query, (delta['children'], delta['resources'],
+                            delta['size'], path)))
+                wait_futures(futures, UPDATE_WINDOW)
+        wait_futures(futures)
+        # The ancestors contain the subtree
+        if root_delta and (root_delta['resources'] or root_delta['size']):
+            for path in ancestors(self.path)[1:]:
+                session.execute(query, (0, root_delta['resources'],
+                                        root_delta['size'], path))
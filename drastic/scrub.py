@@ -0,0 +1,252 @@
+"""Integrity scrubber
+
+Verifies the content of the data objects stored in Cassandra against their
+checksum static column.
+
+The data_object table is split in token range segments which are scanned in
+parallel by a pool of threads. The chunks of each object are streamed through
+a hash, never held in memory all together, and the result is compared with
+the stored checksum. Mismatches are recorded in the scrub_mismatch table.
+
+Reads are throttled to a number of bytes per second so the scrubber can run
+continuously next to the foreground traffic, and a checkpoint is recorded for
+each segment so an interrupted scrub resumes where it stopped.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import hashlib
+import threading
+import time
+from datetime import datetime
+from Queue import (
+    Empty,
+    Queue
+)
+
+from drastic.models import DataObject
+from drastic.models.cql import (
+    get_session,
+    prepare,
+)
+from drastic.models.data_object import CHECKSUM_ALGORITHM
+from drastic.models.scrub_log import (
+    ScrubCheckpoint,
+    ScrubMismatch,
+)
+import log
+
+logger = log.init_log('scrub')
+
+# Bounds of the Murmur3 token ring
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+DEFAULT_SEGMENTS = 64
+DEFAULT_WORKERS = 4
+# Minimum number of seconds between two checkpoints of a segment
+CHECKPOINT_INTERVAL = 10
+# Chunks fetched ahead while reading an object, kept low to limit the load
+SCRUB_PREFETCH = 2
+# Number of data objects listed per page
+SCAN_PAGE_SIZE = 100
+# Minimum number of seconds between the starts of two passes, in continuous
+# mode
+PASS_INTERVAL = 3600
+
+
+def token_segments(count):
+    """Split the token ring in 'count' (start, end] ranges"""
+    step = (MAX_TOKEN - MIN_TOKEN) // count
+    bounds = [MIN_TOKEN + i * step for i in xrange(count)] + [MAX_TOKEN]
+    return zip(bounds[:-1], bounds[1:])
+
+
+class RateLimiter(object):
+    """Token bucket shared by the scrub threads, 'rate' is a number of bytes
+    per second (no limit if it's not set)"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.allowance = rate or 0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Account for 'amount' bytes read, sleep if we're reading too fast"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate,
+                                 self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= amount
+            wait = -float(self.allowance) / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Scrubber(object):
+    """Verify the checksums of all the data objects.
+
+    The progress of the job called 'name' is recorded in scrub_checkpoint,
+    run() resumes from the last checkpoints unless 'restart' is set."""
+
+    def __init__(self, name="default", workers=DEFAULT_WORKERS, rate=None,
+                 segments=DEFAULT_SEGMENTS):
+        self.name = name
+        self.workers = max(workers, 1)
+        self.segments = max(segments, 1)
+        self.limiter = RateLimiter(rate)
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def load_checkpoints(self):
+        """Return the checkpoints of the current pass indexed by segment"""
+        checkpoints = {}
+        for checkpoint in ScrubCheckpoint.objects.filter(name=self.name):
+            checkpoints[checkpoint.segment] = checkpoint
+        if checkpoints and len(checkpoints) != self.segments:
+            logger.warning(u"Scrub '{}' was started with {} segments, "
+                           "restarting".format(self.name, len(checkpoints)))
+            self.reset_checkpoints()
+            return {}
+        return checkpoints
+
+    def reset_checkpoints(self):
+        """Forget the progress of the job, the next run starts a new pass"""
+        query = prepare(u"""DELETE FROM {keyspace}.scrub_checkpoint
+            WHERE name=?""")
+        get_session().execute(query, (self.name,))
+
+    def save_checkpoint(self, segment, last_uuid, done):
+        ScrubCheckpoint.create(name=self.name,
+                               segment=segment,
+                               last_uuid=last_uuid,
+                               done=done,
+                               updated_ts=datetime.now())
+
+    def run(self, restart=False):
+        """Verify every data object once, return statistics about the pass"""
+        if restart:
+            self.reset_checkpoints()
+        checkpoints = self.load_checkpoints()
+        if not checkpoints:
+            # Create all the checkpoints so the number of segments is known
+            # if we need to resume
+            for segment in xrange(self.segments):
+                self.save_checkpoint(segment, None, False)
+        self.stats = {}
+        queue = Queue()
+        for segment, (start, end) in enumerate(token_segments(self.segments)):
+            checkpoint = checkpoints.get(segment)
+            if checkpoint and checkpoint.done:
+                continue
+            last_uuid = checkpoint.last_uuid if checkpoint else None
+            queue.put((segment, start, end, last_uuid))
+        threads = []
+        for _ in xrange(self.workers):
+            t = threading.Thread(target=self.work, args=(queue,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        logger.info(u"Scrub '{}' pass finished: {}".format(self.name, self.stats))
+        return self.stats
+
+    def run_forever(self, restart=False, interval=PASS_INTERVAL):
+        """Scrub continuously, a new pass starts when the previous one is
+        finished and at least 'interval' seconds after it started, so a small
+        archive isn't read again and again"""
+        while True:
+            started = time.time()
+            self.run(restart)
+            self.reset_checkpoints()
+            restart = False
+            time.sleep(max(started + interval - time.time(), 0))
+
+    def work(self, queue):
+        """Scrub segments until the queue is empty"""
+        while True:
+            try:
+                segment, start, end, last_uuid = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                self.scrub_segment(segment, start, end, last_uuid)
+            except Exception:
+                # The segment will be resumed on the next run
+                logger.exception(u"Problem while scrubbing segment {}".format(segment))
+                self.count('failed_segments')
+
+    def scrub_segment(self, segment, start, end, last_uuid=None):
+        """Verify the data objects of a token range, after 'last_uuid' if
+        we're resuming"""
+        if last_uuid:
+            query = prepare(u"""SELECT DISTINCT uuid, checksum, size, treepath,
+                bucket_size FROM {keyspace}.data_object
+                WHERE token(uuid) > token(?) AND token(uuid) <= ?""")
+            bound = query.bind((last_uuid, end))
+        else:
+            query = prepare(u"""SELECT DISTINCT uuid, checksum, size, treepath,
+                bucket_size FROM {keyspace}.data_object
+                WHERE token(uuid) > ? AND token(uuid) <= ?""")
+            bound = query.bind((start, end))
+        bound.fetch_size = SCAN_PAGE_SIZE
+        last_checkpoint = time.time()
+        for row in get_session().execute(bound):
+            self.scrub_object(row)
+            last_uuid = row['uuid']
+            if time.time() - last_checkpoint > CHECKPOINT_INTERVAL:
+                self.save_checkpoint(segment, last_uuid, False)
+                last_checkpoint = time.time()
+        self.save_checkpoint(segment, last_uuid, True)
+
+    def scrub_object(self, row):
+        """Verify one data object, 'row' has its uuid, checksum, size,
+        treepath and bucket_size. Return False if a mismatch has been
+        recorded"""
+        self.count('objects')
+        expected = row['checksum']
+        digest = hashlib.new(CHECKSUM_ALGORITHM)
+        if not expected or len(expected) != digest.digest_size * 2:
+            # No checksum, or one we didn't compute
+            self.count('unverified')
+            return True
+        obj = DataObject(uuid=row['uuid'], bucket_size=row['bucket_size'])
+        size = 0
+        try:
+            for data in obj.chunk_content(prefetch=SCRUB_PREFETCH):
+                digest.update(data)
+                size += len(data)
+                self.limiter.consume(len(data))
+        except Exception as e:
+            self.record_mismatch(row, None, size, error=unicode(e))
+            return False
+        self.count('bytes', size)
+        computed = digest.hexdigest()
+        if computed != expected or (row['size'] is not None and
+                                    size != row['size']):
+            self.record_mismatch(row, computed, size)
+            return False
+        return True
+
+    def record_mismatch(self, row, computed, size, error=None):
+        self.count('mismatches')
+        logger.warning(u"Data object {} ({}) doesn't match its checksum".format(
+            row['uuid'], row['treepath']))
+        ScrubMismatch.create(uuid=row['uuid'],
+                             treepath=row['treepath'],
+                             expected_checksum=row['checksum'],
+                             computed_checksum=computed,
+                             expected_size=row['size'],
+                             computed_size=size,
+                             error=error)
@@ -0,0 +1,236 @@
+"""Subtree delete
+
+Deletes a collection and everything below it.
+
+The collections are visited breadth-first by a pool of threads. For each
+collection the rows of its tree_entry partition are streamed once: the data
+objects of the resources are deleted, their terms are removed from the
+search index in batches and the child collections are recorded in the
+delete_frontier table. The whole partition is then deleted with a single
+statement and one notification summarises the collection.
+
+A child collection is recorded before the partition which links to it is
+deleted, so an interrupted job resumes from the collections of the frontier
+which aren't done yet.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import json
+import threading
+from datetime import datetime
+from Queue import Queue
+
+from drastic.models import (
+    DataObject,
+    Notification,
+    SearchIndex,
+    TreeEntry,
+)
+from drastic.models.collection import (
+    LIST_FETCH_SIZE,
+    Collection,
+)
+from drastic.models.collection_stats import CollectionStats
+from drastic.models.cql import (
+    get_session,
+    prepare,
+)
+from drastic.models.delete_job import DeleteFrontier
+from drastic.models.resource import is_reference
+from drastic.models.tree_cache import tree_cache
+from drastic.util import (
+    datetime_serializer,
+    merge,
+    split,
+)
+import log
+
+logger = log.init_log('subtree_delete')
+
+DEFAULT_WORKERS = 4
+# Number of resources whose search terms are removed together
+RESET_BATCH = 100
+
+
+class SubtreeDelete(object):
+    """Delete the collection at 'path' and its content.
+
+    The job is identified by the path, run() resumes an interrupted job
+    unless 'restart' is set."""
+
+    def __init__(self, path, username=None, workers=DEFAULT_WORKERS):
+        self.path = path
+        self.username = username
+        self.workers = max(workers, 1)
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def pending(self):
+        """Return the paths of the collections which aren't deleted yet"""
+        return [frontier.path
+                for frontier in DeleteFrontier.objects.filter(job=self.path)
+                if not frontier.done]
+
+    def reset_frontier(self):
+        """Forget the progress of the job"""
+        query = prepare(u"""DELETE FROM {keyspace}.delete_frontier
+            WHERE job=?""")
+        get_session().execute(query, (self.path,))
+
+    def record(self, path, done=False):
+        DeleteFrontier.create(job=self.path,
+                              path=path,
+                              done=done,
+                              updated_ts=datetime.now())
+
+    def run(self, restart=False):
+        """Delete the subtree, return statistics about the job"""
+        if restart:
+            self.reset_frontier()
+        paths = self.pending()
+        if not paths:
+            if Collection.find(self.path) is None:
+                return {}
+            self.record(self.path)
+            paths = [self.path]
+            if self.path != '/':
+                CollectionStats.remove_subtree(self.path)
+        self.unlink()
+        self.stats = {}
+        queue = Queue()
+        for path in paths:
+            queue.put(path)
+        threads = []
+        for _ in xrange(self.workers):
+            t = threading.Thread(target=self.work, args=(queue,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        queue.join()
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        if self.stats.get('failed_collections'):
+            logger.warning(u"Delete of '{}' incomplete, run it again to "
+                           "resume: {}".format(self.path, self.stats))
+        else:
+            self.reset_frontier()
+            logger.info(u"Delete of '{}' finished: {}".format(self.path,
+                                                               self.stats))
+        return self.stats
+
+    def unlink(self):
+        """Delete the row which describes the root of the subtree in its
+        parent, so it isn't listed anymore"""
+        if self.path == '/':
+            return
+        container, name = split(self.path)
+        query = prepare(u"""DELETE FROM {keyspace}.tree_entry
+            WHERE container=? AND name=?""")
+        get_session().execute(query, (container, name + u'/'))
+        tree_cache.invalidate(container, name + u'/')
+
+    def work(self, queue):
+        """Delete collections until a None path is received. The child
+        collections are added to the queue"""
+        while True:
+            path = queue.get()
+            if path is None:
+                return
+            try:
+                for child in self.delete_collection(path):
+                    queue.put(child)
+            except Exception:
+                # The collection is still in the frontier, it will be
+                # resumed on the next run
+                logger.exception(u"Problem while deleting collection "
+                                 "'{}'".format(path))
+                self.count('failed_collections')
+            finally:
+                queue.task_done()
+
+    def delete_collection(self, path):
+        """Delete the content and the partition of a collection, return the
+        paths of its child collections"""
+        session = get_session()
+        query = prepare(u"""SELECT * FROM {keyspace}.tree_entry
+            WHERE container=?""")
+        bound = query.bind((path,))
+        bound.fetch_size = LIST_FETCH_SIZE
+        entry = None
+        children = []
+        batch = []
+        resources = 0
+        for row in session.execute(bound):
+            name = row['name']
+            if name == '.':
+                entry = TreeEntry._construct_instance(row)
+            elif name.endswith('/'):
+                child = merge(path, name[:-1])
+                self.record(child)
+                children.append(child)
+            else:
+                batch.append(row)
+                if len(batch) >= RESET_BATCH:
+                    self.delete_resources(path, batch)
+                    resources += len(batch)
+                    batch = []
+        self.delete_resources(path, batch)
+        resources += len(batch)
+        if path != '/':
+            SearchIndex.reset_many([path])
+        if entry is not None:
+            self.notify(Collection(entry), resources, len(children))
+        self.delete_partition(path)
+        CollectionStats.reset(path)
+        self.record(path, done=True)
+        self.count('collections')
+        return children
+
+    def delete_resources(self, path, rows):
+        """Delete the data objects of a batch of resources and their terms
+        in the search index. The tree_entry rows are deleted with the
+        partition"""
+        for row in rows:
+            url = row['url']
+            if url and not is_reference(url):
+                DataObject.delete_id(url.replace("cassandra://", ""))
+        SearchIndex.reset_many([merge(path, row['name']) for row in rows])
+        self.count('resources', len(rows))
+
+    def delete_partition(self, path):
+        """Delete the tree_entry partition of a collection. The row which
+        describes the root collection is kept"""
+        session = get_session()
+        if path == '/':
+            for query in (u"""DELETE FROM {keyspace}.tree_entry
+                              WHERE container=? AND name < '.'""",
+                          u"""DELETE FROM {keyspace}.tree_entry
+                              WHERE container=? AND name > '.'"""):
+                session.execute(prepare(query), (path,))
+        else:
+            query = prepare(u"""DELETE FROM {keyspace}.tree_entry
+                WHERE container=?""")
+            session.execute(query, (path,))
+        tree_cache.invalidate_container(path, True)
+
+    def notify(self, collection, resources, collections):
+        """Publish a single notification for a deleted collection, with the
+        number of resources and collections it contained"""
+        if collection.is_root:
+            return
+        payload = json.dumps({'pre': collection.mqtt_get_state(),
+                              'post': {},
+                              'deleted': {'resources': resources,
+                                          'collections': collections}},
+                             default=datetime_serializer)
+        Notification.delete_collection(self.username, collection.path,
+                                       collection.uuid, payload)
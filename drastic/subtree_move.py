@@ -0,0 +1,231 @@
+"""Subtree move
+
+Moves or renames a collection with everything below it.
+
+Only the tree_entry rows are rewritten: the url of a resource points to its
+data object by uuid, the chunks aren't touched. The partitions of the
+collections are copied breadth-first by a pool of threads, with unlogged
+batches of rows of the same partition.
+
+The copy isn't visible until the row which links the collection to its
+parent is moved, in a single logged batch. The previous partitions are then
+deleted and the paths of the search index updated. If the copy fails the
+source is left as it was.
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import threading
+from collections import deque
+from Queue import Queue
+
+from cassandra.query import (
+    BatchStatement,
+    BatchType,
+)
+
+from drastic.models import (
+    Notification,
+    SearchIndex,
+    TreeEntry,
+)
+from drastic.models.collection import (
+    LIST_FETCH_SIZE,
+    Collection,
+)
+from drastic.models.collection_stats import CollectionStats
+from drastic.models.cql import (
+    get_session,
+    prepare,
+    wait_futures,
+    wait_futures_quietly,
+)
+from drastic.models.data_object import DEFAULT_WRITE_WINDOW
+from drastic.models.index_queue import queue_index
+from drastic.models.tree_cache import tree_cache
+from drastic.models.tree_entry import (
+    entry_fields,
+    insert_entry_query,
+    static_fields,
+    unset_nulls,
+)
+from drastic.util import (
+    merge,
+    split,
+)
+import log
+
+logger = log.init_log('subtree_move')
+
+DEFAULT_WORKERS = 4
+# Number of rows written in a batch, and of paths moved together in the
+# search index
+MOVE_BATCH = 100
+
+
+class SubtreeMove(object):
+    """Move the collection at 'source' to 'destination'. The destination
+    is checked by Collection.move"""
+
+    def __init__(self, source, destination, username=None,
+                 workers=DEFAULT_WORKERS):
+        self.source = source
+        self.destination = destination
+        self.username = username
+        self.workers = max(workers, 1)
+        self.lock = threading.Lock()
+        # (old path, new path, names of the resources) of each collection
+        self.partitions = []
+        self.errors = []
+
+    def new_path(self, path):
+        """Return the path of a collection of the subtree after the move"""
+        return self.destination + path[len(self.source):]
+
+    def run(self):
+        """Move the subtree, return the collection at its new path"""
+        collection = Collection.find(self.source)
+        self.run_pool(self.copy_partition, [self.source])
+        if self.errors:
+            error = self.errors[0]
+            logger.warning(u"Move of '{}' failed, deleting the copy".format(
+                self.source))
+            self.run_pool(self.delete_copy, list(self.partitions))
+            raise error
+        container, name = split(self.destination)
+        link = TreeEntry.find(collection.container, collection.name + u'/')
+        link.move(container, name + u'/')
+        if container != collection.container:
+            stats = CollectionStats.get(self.source)
+            CollectionStats.add(collection.container, -1, -stats['resources'],
+                                -stats['size'])
+            CollectionStats.add(container, 1, stats['resources'], stats['size'])
+        self.run_pool(self.clean_partition, list(self.partitions))
+        if self.errors:
+            logger.warning(u"Some partitions of '{}' haven't been deleted "
+                           "after its move".format(self.source))
+        new = Collection.find(self.destination)
+        if name == collection.name:
+            SearchIndex.move_many([(self.source, self.destination,
+                                    'Collection')])
+        else:
+            # The terms of the name have changed
+            collection.reset()
+            queue_index(new)
+        pre_state = collection.mqtt_get_state()
+        pre_state['path'] = self.source
+        post_state = new.mqtt_get_state()
+        post_state['path'] = self.destination
+        payload = new.mqtt_payload(pre_state, post_state)
+        Notification.move_collection(self.username, self.destination,
+                                     new.uuid, payload)
+        return new
+
+    def run_pool(self, func, items):
+        """Call 'func' on each item with the pool of threads, the items it
+        returns are processed too. Errors are collected in self.errors"""
+        self.errors = []
+        queue = Queue()
+        for item in items:
+            queue.put(item)
+        threads = []
+        for _ in xrange(self.workers):
+            t = threading.Thread(target=self.work, args=(queue, func))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        queue.join()
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+
+    def work(self, queue, func):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            try:
+                for child in func(item) or []:
+                    queue.put(child)
+            except Exception as e:
+                logger.exception(u"Problem while moving '{}'".format(
+                    self.source))
+                with self.lock:
+                    self.errors.append(e)
+            finally:
+                queue.task_done()
+
+    def copy_partition(self, path):
+        """Copy the rows of a collection to its new path, return the paths
+        of its child collections"""
+        session = get_session()
+        new_path = self.new_path(path)
+        query = prepare(u"""SELECT * FROM {keyspace}.tree_entry
+            WHERE container=?""")
+        bound = query.bind((path,))
+        bound.fetch_size = LIST_FETCH_SIZE
+        insert_first = insert_entry_query(entry_fields + static_fields)
+        insert = insert_entry_query(entry_fields)
+        resources = []
+        with self.lock:
+            self.partitions.append((path, new_path, resources))
+        children = []
+        first = True
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        batch_size = 0
+        futures = deque()
+        try:
+            for row in session.execute(bound):
+                name = row['name']
+                # The static columns are written once for the partition
+                if first:
+                    batch.add(insert_first, [new_path, name] + unset_nulls(
+                        [row[f] for f in entry_fields + static_fields]))
+                    first = False
+                else:
+                    batch.add(insert, [new_path, name] + unset_nulls(
+                        [row[f] for f in entry_fields]))
+                batch_size += 1
+                if name.endswith('/'):
+                    children.append(merge(path, name[:-1]))
+                elif name != '.':
+                    resources.append(name)
+                if batch_size >= MOVE_BATCH:
+                    futures.append(session.execute_async(batch))
+                    wait_futures(futures, DEFAULT_WRITE_WINDOW)
+                    batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                    batch_size = 0
+            if batch_size:
+                futures.append(session.execute_async(batch))
+            wait_futures(futures)
+        except Exception:
+            wait_futures_quietly(futures)
+            raise
+        return children
+
+    def delete_copy(self, partition):
+        """Delete the copy of a partition after a failed move"""
+        path, new_path, _ = partition
+        query = prepare(u"""DELETE FROM {keyspace}.tree_entry
+            WHERE container=?""")
+        get_session().execute(query, (new_path,))
+        tree_cache.invalidate_container(new_path, True)
+
+    def clean_partition(self, partition):
+        """Delete a partition which has been copied and move the terms of
+        its objects in the search index"""
+        path, new_path, resources = partition
+        moves = [(merge(path, name), merge(new_path, name), 'Resource')
+                 for name in resources]
+        if path != self.source:
+            moves.append((path, new_path, 'Collection'))
+        for i in xrange(0, len(moves), MOVE_BATCH):
+            SearchIndex.move_many(moves[i:i + MOVE_BATCH])
+        query = prepare(u"""DELETE FROM {keyspace}.tree_entry
+            WHERE container=?""")
+        get_session().execute(query, (path,))
+        tree_cache.invalidate_container(path, True)
+        CollectionStats.transfer(path, new_path)
@@ -7,6 +7,7 @@ __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 import collections
 import functools
+import io
 import uuid
 from crcmod.predefined import mkPredefinedCrcFun
 import struct
@@ -30,41 +31,85 @@ IDENT_LEN = 24
 log = logging.getLogger(__name__)
 
 
-class IterStreamer(object):
+class IterStreamer(io.RawIOBase):
     """
      File-like streaming iterator.
+
+     Reads are served from the chunks of the iterator without concatenating
+     them: readinto copies straight from a memoryview of the current chunk
+     into the caller's buffer, read returns slices of the chunks (a whole
+     chunk isn't copied). Iterating yields the remaining chunks as is.
     """
     def __init__(self, generator):
+        io.RawIOBase.__init__(self)
         self.generator = generator
         self.iterator = iter(generator)
-        self.leftover = ''
+        self.chunk = ''
+        # The part of the current chunk which hasn't been read yet
+        self.leftover = memoryview('')
 
     def __len__(self):
         return self.generator.__len__()
 
     def __iter__(self):
-        return self.iterator
+        return self
 
     def next(self):
-        print "Asked for next...."
-        return self.iterator.next()
-
-    def read(self, size):
-        data = self.leftover
-        count = len(self.leftover)
-        try:
-            while count < size:
-                chunk = self.next()
-                data += chunk
-                count += len(chunk)
-        except StopIteration:
-            self.leftover = ''
+        if len(self.leftover):
+            data = self.leftover.tobytes()
+            self.leftover = memoryview('')
             return data
+        return self.iterator.next()
 
-        if count > size:
-            self.leftover = data[size:]
+    def readable(self):
+        return True
 
-        return data[:size]
+    def _fill(self):
+        """Make sure the current chunk isn't empty, return False at the end
+        of the iterator"""
+        while not len(self.leftover):
+            try:
+                self.chunk = self.iterator.next()
+            except StopIteration:
+                return False
+            self.leftover = memoryview(self.chunk)
+        return True
+
+    def _take(self, n):
+        """Return a view of at most n bytes of the current chunk, they are
+        consumed"""
+        view = self.leftover[:n]
+        self.leftover = self.leftover[n:]
+        return view
+
+    def readinto(self, b):
+        """Read at most len(b) bytes into b, from a single chunk"""
+        if not self._fill():
+            return 0
+        view = self._take(len(b))
+        memoryview(b)[:len(view)] = view
+        return len(view)
+
+    def read(self, size=-1):
+        """Read 'size' bytes, fewer only at the end of the iterator"""
+        if size is None or size < 0:
+            return self.readall()
+        parts = []
+        count = 0
+        while count < size and self._fill():
+            view = self._take(size - count)
+            if len(view) == len(self.chunk):
+                parts.append(self.chunk)
+            else:
+                parts.append(view.tobytes())
+            count += len(view)
+        if len(parts) == 1:
+            return parts[0]
+        return ''.join(parts)
+
+    def readall(self):
+        """Read until the end of the iterator"""
+        return ''.join(self)
 
 
 class log_with(object):
@@ -25,6 +25,36 @@ LOG_LEVEL = os.getenv('DRASTIC_LOG_LEVEL', 'WARN')
 CASSANDRA_HOSTS = ips(os.getenv('CASSANDRA_HOSTNAMES', 'cassandra-1'))
 REPLICATION_FACTOR = int(os.getenv('CASSANDRA_REPLICATION_FACTOR', '2'))
 CONSISTENCY_LEVEL = int(os.getenv('CASSANDRA_CONSISTENCY_LEVEL', '2'))
+# Store the chunks of new data objects in the content addressed chunk store
+CHUNK_DEDUP = os.getenv('DRASTIC_CHUNK_DEDUP', 'false').lower() == 'true'
+# Spread the chunks of new data objects over partitions of this many chunks,
+# 0 keeps all the chunks of an object in a single partition
+CHUNK_BUCKET_SIZE = int(os.getenv('DRASTIC_CHUNK_BUCKET_SIZE', '0'))
+# Number of seconds after which the upload sessions are removed by
+# drastic upload-reap, with the parts of the ones which weren't completed
+UPLOAD_SESSION_MAX_AGE = int(os.getenv('DRASTIC_UPLOAD_SESSION_MAX_AGE', '604800'))
+# In-process cache of the tree entries resolved by path (0 disables it)
+TREE_CACHE_SIZE = int(os.getenv('DRASTIC_TREE_CACHE_SIZE', '10000'))
+TREE_CACHE_TTL = float(os.getenv('DRASTIC_TREE_CACHE_TTL', '5'))
+# Invalidate the caches on the MQTT notifications of the other processes
+TREE_CACHE_LISTENER = os.getenv('DRASTIC_TREE_CACHE_LISTENER', 'true').lower() == 'true'
+# In-process cache of the effective ACL of the collections (0 disables it)
+ACL_CACHE_SIZE = int(os.getenv('DRASTIC_ACL_CACHE_SIZE', '10000'))
+ACL_CACHE_TTL = float(os.getenv('DRASTIC_ACL_CACHE_TTL', '5'))
+# Index the prefixes and the n-grams of the search terms, for the prefix and
+# substring queries
+SEARCH_NGRAMS = os.getenv('DRASTIC_SEARCH_NGRAMS', 'false').lower() == 'true'
+# Length of the shortest indexed prefix and of the n-grams
+NGRAM_MIN_LENGTH = int(os.getenv('DRASTIC_NGRAM_MIN_LENGTH', '3'))
+# Maximum number of grams indexed for a term
+NGRAM_MAX_GRAMS = int(os.getenv('DRASTIC_NGRAM_MAX_GRAMS', '24'))
+# Index the created and updated objects in the background (drastic index)
+INDEX_ASYNC = os.getenv('DRASTIC_INDEX_ASYNC', 'true').lower() == 'true'
+# Number of partitions of the index queue
+INDEX_QUEUE_BUCKETS = int(os.getenv('DRASTIC_INDEX_QUEUE_BUCKETS', '16'))
+# Index synchronously when the queue is more than this many seconds behind
+# (0 never does)
+INDEX_MAX_LAG = float(os.getenv('DRASTIC_INDEX_MAX_LAG', '300'))
 
 if __name__ == '__main__':
     print('hosts: {0}'.format(str(CASSANDRA_HOSTS)))
@@ -16,7 +16,11 @@ setup(
     name='drastic',
     version="1.1",
     description='Drastic core library',
-    extras_require={},
+    extras_require={
+        # Optional chunk compression codecs, zlib is always available
+        "lz4": ["lz4<3"],
+        "zstd": ["zstandard<0.15"],
+    },
     long_description="Core library for Drastic development",
     author='Archive Analytics',
     maintainer_email='jansen@umd.edu',
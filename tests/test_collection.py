@@ -1,6 +1,10 @@
 import unittest
 
-from drastic.models.collection import Collection
+from drastic.models.collection import (
+    Collection,
+    decode_cursor,
+    encode_cursor,
+)
 from drastic.models.user import User
 from drastic.models.group import Group
 
@@ -70,3 +74,15 @@ class NodeTest(unittest.TestCase):
 
         # User can read collection coll if user is in a group also in coll's read_access
         assert coll.user_can(user, "read") == True
+
+
+class CursorTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_roundtrip(self):
+        for name in [u"a.txt", u"sub/", u"\xe9t\xe9 2016.csv"]:
+            self.assertEqual(decode_cursor(encode_cursor(name)), name)
+
+    @raises(ValueError)
+    def test_invalid_cursor(self):
+        decode_cursor("not a cursor!")
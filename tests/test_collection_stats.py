@@ -0,0 +1,20 @@
+"""unittest class for the collection counters
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import unittest
+
+from drastic.models.collection_stats import ancestors
+
+
+class AncestorsTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_root(self):
+        self.assertEqual(ancestors("/"), ["/"])
+
+    def test_nested(self):
+        self.assertEqual(ancestors("/a/b"), ["/a/b", "/a", "/"])
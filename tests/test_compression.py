@@ -0,0 +1,47 @@
+"""unittest class for the chunk compression codecs
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import os
+import unittest
+import zipfile
+from cStringIO import StringIO
+
+from drastic.compression import (
+    CODEC_NONE,
+    available_codecs,
+    choose_codec,
+    decode_chunk,
+    encode_chunk,
+)
+
+
+TEXT = "a,b,c,some repeated text\n" * 4096
+
+
+class CompressionTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_roundtrip(self):
+        for codec in available_codecs():
+            blob, used = encode_chunk(TEXT, codec)
+            self.assertEqual(decode_chunk(blob, used), TEXT)
+
+    def test_legacy_zip_chunk(self):
+        buf = StringIO()
+        z = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr("data", TEXT)
+        z.close()
+        self.assertEqual(decode_chunk(buf.getvalue(), None, True), TEXT)
+
+    def test_choose_codec(self):
+        self.assertEqual(choose_codec("image/jpeg", TEXT), CODEC_NONE)
+        self.assertEqual(choose_codec(None, os.urandom(4096)), CODEC_NONE)
+        self.assertNotEqual(choose_codec("text/csv", TEXT), CODEC_NONE)
+
+    def test_incompressible_chunk_stored_as_is(self):
+        data = os.urandom(4096)
+        self.assertEqual(encode_chunk(data, "zlib"), (data, CODEC_NONE))
@@ -0,0 +1,59 @@
+"""unittest class for the data object helpers
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import unittest
+from StringIO import StringIO
+
+from drastic.models.data_object import (
+    DataObject,
+    chunk_key,
+    chunk_range,
+    read_chunk,
+    slice_chunks,
+)
+
+from nose.tools import raises
+
+
+class SlowFile(StringIO):
+    """File-like object which never returns more than 3 bytes per read"""
+
+    def read(self, n=-1):
+        return StringIO.read(self, min(n, 3))
+
+
+class DataObjectHelpersTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_read_chunk_fills_short_reads(self):
+        f = SlowFile("abcdefghij")
+        self.assertEqual(read_chunk(f, 8), "abcdefgh")
+        self.assertEqual(read_chunk(f, 8), "ij")
+        self.assertEqual(read_chunk(f, 8), "")
+
+    def test_chunk_range(self):
+        self.assertEqual(chunk_range(0, 10, 10), (0, 0, 0))
+        self.assertEqual(chunk_range(5, 10, 10), (0, 1, 5))
+        self.assertEqual(chunk_range(25, 1, 10), (2, 2, 5))
+        self.assertEqual(chunk_range(25, None, 10), (2, None, 5))
+
+    def test_chunk_key(self):
+        self.assertEqual(chunk_key("id", 5, None), ("id", 5))
+        self.assertEqual(chunk_key("id", 5, 4), ("id", 1, 5))
+        self.assertEqual(chunk_key("id", 3, 4), ("id", 0, 3))
+
+    def test_slice_chunks(self):
+        chunks = ["0123", "4567", "89"]
+        self.assertEqual("".join(slice_chunks(chunks, 0, None)), "0123456789")
+        self.assertEqual("".join(slice_chunks(chunks, 3, 4)), "3456")
+        self.assertEqual("".join(slice_chunks(chunks, 8, 10)), "89")
+        self.assertEqual("".join(slice_chunks(chunks, 12, 2)), "")
+
+    @raises(ValueError)
+    def test_update_without_sequence_number(self):
+        # The row of a chunk can't be identified, nothing is written
+        DataObject(uuid=u"no_sequence").update(blob="abc")
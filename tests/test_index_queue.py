@@ -0,0 +1,34 @@
+"""unittest class for the index queue
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import unittest
+
+from drastic.models.index_queue import (
+    QUEUE_WINDOW,
+    queue_bucket,
+    queue_window,
+)
+
+
+class QueueBucketTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_range(self):
+        for path in (u"/", u"/a", u"/a/b.txt", u"/\xe9t\xe9"):
+            assert 0 <= queue_bucket(path, 16) < 16
+
+    def test_stable(self):
+        self.assertEqual(queue_bucket(u"/a/b.txt", 16),
+                         queue_bucket(u"/a/b.txt", 16))
+
+
+class QueueWindowTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_window(self):
+        self.assertEqual(queue_window(QUEUE_WINDOW * 3), 3)
+        self.assertEqual(queue_window(QUEUE_WINDOW * 4 - 0.5), 3)
@@ -1,6 +1,27 @@
 import unittest
 
-from drastic.models.search import SearchIndex
+from drastic.models.search import (
+    MAX_TERM_LENGTH,
+    SearchIndex,
+    decode_search_cursor,
+    encode_search_cursor,
+    rank,
+)
+from drastic.models.search_query import (
+    AND,
+    NOT,
+    OR,
+    PHRASE,
+    TERM,
+    WILDCARD,
+    parse_query,
+)
+from drastic.models.search_gram import (
+    NGRAM,
+    PREFIX,
+    pattern_regex,
+    term_grams,
+)
 from drastic.models.collection import Collection
 from drastic.models.user import User
 from drastic.models.group import Group
@@ -49,3 +70,125 @@ class SearchTest(unittest.TestCase):
 
         results = SearchIndex.find(["protected"], reading_user)
         assert len(results) == 0, results
+
+
+class FakeObject(object):
+
+    def __init__(self, name, metadata):
+        self.name = name
+        self.metadata = metadata
+
+    def get_cdmi_metadata(self):
+        return self.metadata
+
+
+class TermsTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_name(self):
+        terms = SearchIndex.terms(FakeObject("Annual_Report.pdf", {}))
+        self.assertEqual(terms, set([("name", "annual"), ("name", "report"),
+                                     ("name", "pdf"),
+                                     ("name", "annual_report.pdf")]))
+
+    def test_metadata_phrase(self):
+        # The whole value is indexed so a phrase can be found in it
+        obj = FakeObject("x", {"title": "The Annual Report",
+                               "tags": ["draft copy"]})
+        terms = SearchIndex.terms(obj, ['metadata'])
+        assert ("metadata", "annual") in terms
+        assert ("metadata", "the annual report") in terms
+        assert ("metadata", "draft copy") in terms
+
+    def test_long_value(self):
+        # A long value is only indexed by its words
+        text = " ".join(["word{}".format(i) for i in xrange(100)])
+        obj = FakeObject("x", {"description": text, "blob": "x" * 70000})
+        terms = SearchIndex.terms(obj, ['metadata'])
+        assert ("metadata", "word42") in terms
+        assert ("metadata", text) not in terms
+        assert all(len(term) <= MAX_TERM_LENGTH for _, term in terms)
+
+
+class RankTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_order(self):
+        hits = {("/b", "Resource"): 2, ("/a", "Collection"): 2,
+                ("/c", "Resource"): 3, ("/d", "Resource"): 1}
+        self.assertEqual([path for _, path, _ in rank(hits)],
+                         ["/c", "/a", "/b", "/d"])
+
+    def test_after(self):
+        hits = {("/b", "Resource"): 2, ("/a", "Collection"): 2,
+                ("/c", "Resource"): 3, ("/d", "Resource"): 1}
+        self.assertEqual([path for _, path, _ in rank(hits, (2, "/a"))],
+                         ["/b", "/d"])
+
+    def test_cursor(self):
+        cursor = encode_search_cursor(2, u"/a/\xe9")
+        self.assertEqual(decode_search_cursor(cursor), (2, u"/a/\xe9"))
+
+    @raises(ValueError)
+    def test_invalid_cursor(self):
+        decode_search_cursor("not a cursor")
+
+
+class QueryParserTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_implicit_and(self):
+        self.assertEqual(parse_query("annual report.pdf"),
+                         (AND, ((TERM, "annual"), (TERM, "report"),
+                                (TERM, "pdf"))))
+
+    def test_precedence(self):
+        self.assertEqual(parse_query("aa OR bb cc NOT dd"),
+                         (OR, ((TERM, "aa"),
+                               (AND, ((TERM, "bb"), (TERM, "cc"),
+                                      (NOT, (TERM, "dd")))))))
+
+    def test_phrase(self):
+        self.assertEqual(parse_query('"The Annual_Report" 2016',
+                                     SearchIndex.is_stop_word),
+                         (AND, ((PHRASE, ("annual", "report"),
+                                 "the annual report"),
+                                (TERM, "2016"))))
+
+    def test_stop_words(self):
+        self.assertEqual(parse_query("the AND (of OR a)",
+                                     SearchIndex.is_stop_word), None)
+
+    def test_wildcard(self):
+        self.assertEqual(parse_query("My_Fi* report"),
+                         (AND, ((WILDCARD, "my_fi*"), (TERM, "report"))))
+
+    @raises(ValueError)
+    def test_only_not(self):
+        parse_query("NOT draft")
+
+    @raises(ValueError)
+    def test_missing_parenthesis(self):
+        parse_query("(report OR summary")
+
+
+class GramTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_term_grams(self):
+        self.assertEqual(term_grams("report", 3, 24),
+                         set([(PREFIX, "rep"), (PREFIX, "repo"),
+                              (PREFIX, "repor"), (PREFIX, "report"),
+                              (NGRAM, "rep"), (NGRAM, "epo"), (NGRAM, "por"),
+                              (NGRAM, "ort")]))
+
+    def test_max_grams(self):
+        grams = term_grams("abcdefghij", 3, 2)
+        self.assertEqual(grams, set([(PREFIX, "abc"), (PREFIX, "abcd"),
+                                     (NGRAM, "abc"), (NGRAM, "bcd")]))
+
+    def test_pattern(self):
+        regex = pattern_regex("*port*.pdf")
+        assert regex.match("annual_report_2016.pdf")
+        assert not regex.match("annual_report_2016xpdf")
+        assert not regex.match("annual_report_2016.pdf.gz")
@@ -0,0 +1,131 @@
+"""unittest class for the path resolution cache
+
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import unittest
+
+from drastic.models.tree_cache import (
+    AclCache,
+    TreeCache,
+    tree_cache,
+)
+from drastic.models.tree_entry import TreeEntry
+
+
+class TreeCacheTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_lru_eviction(self):
+        cache = TreeCache(2, 60)
+        cache.put(("/a", "x"), 1, cache.version)
+        cache.put(("/a", "y"), 2, cache.version)
+        self.assertEqual(cache.get(("/a", "x")), 1)
+        cache.put(("/b", "z"), 3, cache.version)
+        self.assertEqual(cache.get(("/a", "y")), None)
+        self.assertEqual(cache.get(("/a", "x")), 1)
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "size": 2})
+
+    def test_expired(self):
+        cache = TreeCache(2, -1)
+        cache.put(("/a", "x"), 1, cache.version)
+        self.assertEqual(cache.get(("/a", "x")), None)
+
+    def test_invalidate_container(self):
+        cache = TreeCache(10, 60)
+        version = cache.version
+        cache.put(("/a", "x"), 1, version)
+        cache.put(("/", "a/"), 2, version)
+        cache.invalidate_path("/a", True)
+        self.assertEqual(cache.get(("/a", "x")), None)
+        self.assertEqual(cache.get(("/", "a/")), None)
+        # A value read before the invalidation isn't cached
+        cache.put(("/a", "x"), 1, version)
+        self.assertEqual(cache.get(("/a", "x")), None)
+
+    def test_invalidate_subtree(self):
+        cache = TreeCache(10, 60)
+        version = cache.version
+        cache.put(("/a", "x"), 1, version)
+        cache.put(("/a/b", "y"), 2, version)
+        cache.put(("/", "a/"), 3, version)
+        cache.put(("/ab", "z"), 4, version)
+        cache.invalidate_subtree("/a")
+        self.assertEqual(cache.get(("/a", "x")), None)
+        self.assertEqual(cache.get(("/a/b", "y")), None)
+        self.assertEqual(cache.get(("/", "a/")), None)
+        self.assertEqual(cache.get(("/ab", "z")), 4)
+
+    def test_container_index(self):
+        cache = TreeCache(2, 60)
+        cache.put(("/a", "x"), 1, cache.version)
+        cache.put(("/a", "y"), 2, cache.version)
+        cache.put(("/b", "z"), 3, cache.version)
+        # The evicted entry isn't indexed anymore
+        self.assertEqual(cache.containers, {"/a": set([("/a", "y")]),
+                                            "/b": set([("/b", "z")])})
+        cache.invalidate_container("/a")
+        self.assertEqual(cache.get(("/a", "y")), None)
+        self.assertEqual(cache.get(("/b", "z")), 3)
+        cache.invalidate("/b", "z")
+        self.assertEqual(cache.containers, {})
+
+    def test_acl_subtree(self):
+        acl = AclCache(10, 60)
+        cache = TreeCache(10, 60, dependent=acl)
+        acl.put("/a", {}, acl.version)
+        acl.put("/a/b", {}, acl.version)
+        acl.put("/ab", {}, acl.version)
+        cache.invalidate_container("/a", True)
+        self.assertEqual(acl.get("/a"), None)
+        self.assertEqual(acl.get("/a/b"), None)
+        self.assertEqual(acl.get("/ab"), {})
+
+    def test_acl_metadata_update(self):
+        acl = AclCache(10, 60)
+        cache = TreeCache(10, 60, dependent=acl)
+        acl.put("/", {}, acl.version)
+        acl.put("/a/b", {}, acl.version)
+        # A write of the metadata doesn't change the ACL
+        cache.invalidate_container("/a")
+        cache.invalidate_path("/", True)
+        self.assertEqual(acl.get("/"), {})
+        self.assertEqual(acl.get("/a/b"), {})
+
+    def test_acl_index(self):
+        acl = AclCache(10, 60)
+        acl.put("/a/b/c", {}, acl.version)
+        acl.put("/a/d", {}, acl.version)
+        acl.put("/e", {}, acl.version)
+        # "/a/b" isn't cached, its descendants are still found
+        acl.invalidate_subtree("/a/b")
+        self.assertEqual(acl.get("/a/b/c"), None)
+        self.assertEqual(acl.get("/a/d"), {})
+        self.assertEqual(acl.containers, {"/": set(["/a", "/e"]),
+                                          "/a": set(["/a/d"])})
+        acl.invalidate_subtree("/a")
+        acl.invalidate_subtree("/e")
+        self.assertEqual(acl.containers, {})
+
+
+class TreeEntryCacheTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_find_copy(self):
+        TreeEntry.create(container=u"/cache_copy", name=u"x",
+                         container_metadata={u"a": u"1"},
+                         metadata={u"b": u"2"})
+        tree_cache.clear()
+        entry = TreeEntry.find(u"/cache_copy", u"x")
+        entry.container_metadata[u"a"] = u"3"
+        entry.metadata[u"b"] = u"4"
+        entry = TreeEntry.find(u"/cache_copy", u"x")
+        self.assertEqual(entry.container_metadata, {u"a": u"1"})
+        self.assertEqual(entry.metadata, {u"b": u"2"})
+        # The entry returned by the second find comes from the cache
+        entry.metadata[u"b"] = u"4"
+        self.assertEqual(TreeEntry.find(u"/cache_copy", u"x").metadata,
+                         {u"b": u"2"})
+        entry.delete()
@@ -5,9 +5,12 @@ __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
+import shutil
 import unittest
+from cStringIO import StringIO
 
 from common import *
+from drastic.util import IterStreamer
 from drastic.util_archive import (
     path_exists,
     is_resource,
@@ -36,11 +39,40 @@ class TestUtil(DrasticTestCase):
         self.delete_collection("/unittest")
 
 
+class TestIterStreamer(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_read(self):
+        s = IterStreamer(iter(["abc", "", "defgh", "ij"]))
+        self.assertEqual(s.read(2), "ab")
+        self.assertEqual(s.read(5), "cdefg")
+        self.assertEqual(s.read(10), "hij")
+        self.assertEqual(s.read(3), "")
+
+    def test_read_whole_chunk(self):
+        chunk = "defgh"
+        s = IterStreamer(iter(["abc", chunk]))
+        self.assertEqual(s.read(3), "abc")
+        # A chunk read at once isn't copied
+        assert s.read(5) is chunk
+
+    def test_iterate_after_read(self):
+        s = IterStreamer(iter(["abc", "defgh"]))
+        self.assertEqual(s.read(1), "a")
+        self.assertEqual(list(s), ["bc", "defgh"])
+
+    def test_copyfileobj(self):
+        out = StringIO()
+        shutil.copyfileobj(IterStreamer(iter(["abc", "defgh"] * 100)), out)
+        self.assertEqual(out.getvalue(), "abcdefgh" * 100)
+
+
 def suite():
     import logger
     logger.setLevel(logger.ERROR)
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestUtil))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestIterStreamer))
     return suite
 
 